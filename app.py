@@ -1,33 +1,65 @@
 import os
+import uuid
+from datetime import datetime, timedelta
 
-from flask import Flask, request, jsonify
+from flask import (
+    Flask, Response, request, jsonify, stream_with_context
+)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 from flask_jwt_extended import (
     JWTManager, jwt_required, create_access_token,
     get_jwt_identity, get_jwt_claims
 )
-from werkzeug.utils import secure_filename
 from flask_cors import CORS
 
 from upload_functions import (
-    allowed_file, upload_file_obj, create_presigned_url
+    allowed_file, create_presigned_url, create_presigned_post, head_object,
+    image_dimensions, ALLOWED_CONTENT_TYPES
+)
+from image_store import (
+    HashingRequest, acquire_upload, release_object, store_image,
+    store_images
 )
 
-from forms import (
-    UserSignUpForm,
-    UserLoginForm,
-    UserEditForm,
-    ListingSearchForm,
-    ListingCreateForm,
-    ListingEditForm,
-    MessageCreateForm,
+from schemas import (
+    USER_SIGNUP,
+    USER_LOGIN,
+    USER_EDIT,
+    LISTING_SEARCH,
+    LISTING_CREATE,
+    LISTING_EDIT,
+    MESSAGE_CREATE,
+    MESSAGE_BROADCAST,
+    errors_response,
+)
+from models import (
+    db, connect_db, reaches_archive, User, Listing, ListingPhoto, Message,
+    DEFAULT_LOCATION_IMAGE, MESSAGES_PAGE_SIZE, USER_FIELDS, USER_INCLUDES,
+    LISTING_FIELDS, LISTING_BRIEF_FIELDS, LISTING_INCLUDES
+)
+from metrics import init_metrics, timed
+from profiling import init_profiling
+from stats import init_stats
+from similar import init_similar
+from sync import init_sync
+from outbox import init_outbox
+from clusters import init_clusters
+from compression import init_compression, DEFAULT_LEVELS
+from cache import init_cache, cached, invalidate
+from ratelimit import init_rate_limits, limits_from_json
+from warmup import init_warmup
+from reaper import soft_delete_listing, soft_delete_user
+from idempotency import after_commit, commit, idempotent
+from notifications import notify_messages
+from bulk_listings import (
+    BulkImportError, import_listings, export_listings
 )
-from models import db, connect_db, User, Listing, Message
-from botocore.exceptions import ClientError
 
 # CURR_USER_KEY = "curr_user"
 app = Flask(__name__)
+# Hashes uploaded files as they stream in, for content-addressed storage.
+app.request_class = HashingRequest
 CORS(app)
 
 UPLOAD_FOLDER = os.path.join(app.root_path, "upload")
@@ -47,14 +79,125 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', "shhhhh!")
 jwt = JWTManager(app)
 
-app.config['WTF_CSRF_ENABLED'] = False
+# Log requests slower than this (in ms) along with their SQL; unset disables.
+app.config['SLOW_REQUEST_MS'] = (
+    float(os.environ['SLOW_REQUEST_MS'])
+    if os.environ.get('SLOW_REQUEST_MS') else None
+)
+
+# Per-request profiling: admins can send `X-Profile: 1`; a fraction of all
+# requests can also be sampled. PROFILER is "cprofile" or "pyinstrument".
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0)
+)
+app.config['PROFILER'] = os.environ.get('PROFILER', 'cprofile')
+app.config['PROFILE_DIR'] = os.environ.get(
+    'PROFILE_DIR', '/tmp/sharebnb-profiles'
+)
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 200))
+
+# Each worker's similar-listings index polls for changed listings at most
+# this often, and is rebuilt from scratch (dropping deleted ones) this often.
+app.config['SIMILAR_REFRESH_SECONDS'] = float(
+    os.environ.get('SIMILAR_REFRESH_SECONDS', 5)
+)
+app.config['SIMILAR_RELOAD_SECONDS'] = float(
+    os.environ.get('SIMILAR_RELOAD_SECONDS', 3600)
+)
+
+# How long (in seconds) an Idempotency-Key's stored response is replayed.
+app.config['IDEMPOTENCY_TTL'] = int(
+    os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60)
+)
+
+# Where `python outbox.py` publishes change events: "log", or
+# "file:<path>" for one JSON event per line.
+app.config['OUTBOX_SINK'] = os.environ.get('OUTBOX_SINK', 'log')
+
+# Messages older than this many days are moved to the archive table by
+# archive.py.
+app.config['MESSAGE_HOT_DAYS'] = int(os.environ.get('MESSAGE_HOT_DAYS', 90))
+
+# JSON and text responses at least this many bytes long are compressed
+# (br, zstd or gzip, as the client accepts) at these levels.
+app.config['COMPRESS_MIN_SIZE'] = int(
+    os.environ.get('COMPRESS_MIN_SIZE', 1024)
+)
+app.config['COMPRESS_LEVELS'] = {
+    encoding: int(os.environ.get(f'COMPRESS_{encoding.upper()}_LEVEL', level))
+    for encoding, level in DEFAULT_LEVELS.items()
+}
+
+# Seconds a cached GET response (listings, messages) is served from this
+# worker's memory; 0 disables the response cache.
+app.config['RESPONSE_CACHE_TTL'] = float(
+    os.environ.get('RESPONSE_CACHE_TTL', 0)
+)
+app.config['RESPONSE_CACHE_SIZE'] = int(
+    os.environ.get('RESPONSE_CACHE_SIZE', 1000)
+)
+
+# Requests each worker handles at once when served through asgi.py.
+app.config['ASGI_THREADS'] = int(os.environ.get('ASGI_THREADS', 32))
+
+# Warm-up (see warmup.py): each worker replays the WARMUP_KEYS most
+# requested listing and user GETs from the hot-key list at HOT_KEYS_PATH
+# before GET /ready reports it ready, giving up after WARMUP_BUDGET_SECONDS.
+app.config['WARMUP_ENABLED'] = os.environ.get('WARMUP_ENABLED', '1') != '0'
+app.config['WARMUP_KEYS'] = int(os.environ.get('WARMUP_KEYS', 200))
+app.config['WARMUP_BUDGET_SECONDS'] = float(
+    os.environ.get('WARMUP_BUDGET_SECONDS', 30)
+)
+app.config['HOT_KEYS_PATH'] = os.environ.get(
+    'HOT_KEYS_PATH', '/tmp/sharebnb-hot-keys.json'
+)
+app.config['HOT_KEYS_SAVE_SECONDS'] = float(
+    os.environ.get('HOT_KEYS_SAVE_SECONDS', 60)
+)
+
+# Admission control (see ratelimit.py): per-route and per-user token
+# buckets, overridable per endpoint with a JSON object such as
+# {"login": {"user_rate": 1, "user_burst": 5}}, and the most requests a
+# worker runs at once (0 for no limit) before answering 503.
+app.config['RATE_LIMITS_ENABLED'] = (
+    os.environ.get('RATE_LIMITS_ENABLED', '1') != '0'
+)
+app.config['RATE_LIMITS'] = limits_from_json(
+    os.environ.get('RATE_LIMITS', '{}')
+)
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get(
+    'RATE_LIMIT_BACKEND', 'memory'
+)
+app.config['MAX_CONCURRENT_REQUESTS'] = int(
+    os.environ.get('MAX_CONCURRENT_REQUESTS', 64)
+)
 
 BUCKET = "sharebnb-aw-dev"
+MAX_PHOTOS_PER_UPLOAD = 20
+# Most ids one GET /listings/batch or /users/batch request may ask for.
+MAX_BATCH_SIZE = 100
+
+# Browser uploads that go straight to S3 with a presigned POST.
+DIRECT_UPLOAD_MAX_BYTES = 16 * 1000 * 1000
+DIRECT_UPLOAD_EXPIRATION = 600
+# Enough of the object to find the image dimensions in its header.
+DIRECT_UPLOAD_HEAD_BYTES = 128 * 1024
 # BUCKET = "sharebnb-wchou"
 
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_metrics(app)
+init_rate_limits(app)
+init_profiling(app)
+init_stats(app)
+init_similar(app)
+init_sync(app)
+init_outbox(app)
+init_clusters(app)
+init_cache(app)
+init_compression(app)
+init_warmup(app)
 
 
 #########################################
@@ -131,6 +274,7 @@ def do_login(user):
 
 
 @app.route('/signup', methods=["POST"])
+@idempotent
 def signup():
     """ Handle user signup. Create new user and add to DB.
         Takes in { user: {
@@ -148,34 +292,31 @@ def signup():
 
     user_data = request.form
     file = request.files.get('image_url')
-    form = UserSignUpForm(formdata=user_data)
+    values, errors = USER_SIGNUP.validate(user_data)
 
-    if form.validate():
+    if not errors:
         try:
-            user = User.signup(form)
+            user = User.signup(values)
             if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                upload_file_obj(file, BUCKET, filename)
+                key = store_image(file, BUCKET)
+                if key is None:
+                    db.session.rollback()
+                    errors = ["Failure to upload image"]
+                    return (jsonify(errors=errors), 400)
 
-                url = create_presigned_url(BUCKET, filename)
-                user.image_url = url
+                user.image_key = key
+                user.image_url = create_presigned_url(BUCKET, key)
 
-            db.session.commit()
+            commit()
 
             return do_login(user)
 
         except IntegrityError:
+            db.session.rollback()
             errors = ["Username already taken"]
             return (jsonify(errors=errors), 400)
-        except ClientError:
-            errors = ["Failure to upload image"]
-            return (jsonify(errors=errors), 400)
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
-        return (jsonify(errors=errors), 400)
+        return errors_response(errors)
 
 
 @app.route('/login', methods=["POST"])
@@ -187,31 +328,108 @@ def login():
     """
 
     user_data = request.json.get("user")
-    form = UserLoginForm(data=user_data)
+    values, errors = USER_LOGIN.validate(user_data)
 
-    if form.validate():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+    if not errors:
+        user = User.authenticate(values["username"],
+                                 values["password"])
 
         if user:
             return do_login(user)
 
         return (jsonify(errors=["Invalid credentials."]), 401)
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
-        return (jsonify(errors=errors), 400)
+        return errors_response(errors)
 
 
 ##############################################################################
 # General user routes:
 
+def _fieldset_args(allowed_fields, default_fields, allowed_includes):
+    """ Parse the comma-separated `fields` and `include` query parameters.
+        Returns (fields, includes, errors).
+    """
+
+    errors = []
+    selections = {}
+    for name, allowed, default in (("fields", allowed_fields, default_fields),
+                                   ("include", allowed_includes, ())):
+        value = request.args.get(name)
+        if value is None:
+            selections[name] = tuple(default)
+            continue
+        requested = tuple(dict.fromkeys(
+            item.strip() for item in value.split(",") if item.strip()
+        ))
+        unknown = [item for item in requested if item not in allowed]
+        if unknown:
+            errors.append(f"Unknown {name}: {', '.join(unknown)} "
+                          f"(choose from {', '.join(allowed)})")
+        selections[name] = requested
+    return selections["fields"], selections["include"], errors
+
+
+def _batch_keys(name, convert=str):
+    """ Parse a comma-separated list of ids from query parameter `name`,
+        dropping duplicates. Returns (keys, errors).
+    """
+
+    keys = []
+    errors = []
+    for item in request.args.get(name, "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            keys.append(convert(item))
+        except ValueError:
+            errors.append(f"Invalid {name}: {item}")
+    keys = list(dict.fromkeys(keys))
+    if not keys and not errors:
+        errors.append(f"{name} is required")
+    if len(keys) > MAX_BATCH_SIZE:
+        errors.append(f"At most {MAX_BATCH_SIZE} {name} per request")
+    return keys, errors
+
+
+@app.route('/users/batch')
+@jwt_required
+@cached("user")
+def users_batch():
+    """ Show many users at once.
+        Query parameters:
+            usernames: comma-separated, at most MAX_BATCH_SIZE
+            fields: comma-separated keys to return (default: all)
+        Returns => {
+                    users: { username: { username, bio, ... }, ... },
+                    missing: [username, ...]
+                    }
+        Auth required: user logged in
+    """
+
+    usernames, errors = _batch_keys("usernames")
+    fields, _, fieldset_errors = _fieldset_args(USER_FIELDS, USER_FIELDS, ())
+    errors += fieldset_errors
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    users = User.with_fields(
+        User.live().filter(User.username.in_(usernames)), fields
+    )
+    serialized = {user.username: user.serialize(fields) for user in users}
+    missing = [username for username in usernames
+               if username not in serialized]
+    return (jsonify(users=serialized, missing=missing), 200)
+
+
 @app.route('/users/<username>')
 @jwt_required
+@cached("user", "listing")
 def user_show(username):
     """ Show user details.
+        Optional query parameters:
+            fields: comma-separated keys to return (default: all)
+            include: listings (the user's listings, brief form)
         Returns => {
                     user: {
                             username,
@@ -221,30 +439,64 @@ def user_show(username):
                             email,
                             image_url,
                             location,
-                            is_admin
+                            is_admin,
+                            listings?,
                         }
                     }
         TODO: Auth required: admin or username equals logged in user
     """
 
-    user = User.query.get_or_404(username)
+    fields, includes, errors = _fieldset_args(
+        USER_FIELDS, USER_FIELDS, USER_INCLUDES
+    )
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    user = User.with_fields(
+        User.live().filter(User.username == username), fields
+    ).first_or_404()
     # TODO: grab messages for user inbox (to_user = user) and
     #       user outbox (from_user = user)
     # order messages by most recent from the database
 
-    return (jsonify(user=user.serialize()), 200)
+    serialized = user.serialize(fields)
+    if "listings" in includes:
+        listings = Listing.with_fields(
+            Listing.live().filter(Listing.created_by == username),
+            LISTING_BRIEF_FIELDS,
+        )
+        serialized["listings"] = [
+            listing.serialize(isDetailed=False) for listing in listings
+        ]
+    return (jsonify(user=serialized), 200)
 
 @app.route('/users/<username>/listings')
 @jwt_required
+@cached("listing", "user")
 def user_listings(username):
-    """ Show user's created listings """
-
-    user = User.query.get_or_404(username)
-    created_listings = user.created_listings
-    serialized = [
-        listing.serialize(isDetailed=False)
-        for listing in created_listings
-    ]
+    """ Show user's created listings
+        Optional query parameters:
+            fields: comma-separated keys to return (default: brief form)
+            include: creator and/or renter (embedded users)
+    """
+
+    fields, includes, errors = _fieldset_args(
+        LISTING_FIELDS, LISTING_BRIEF_FIELDS, LISTING_INCLUDES
+    )
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    User.get_live_or_404(username)
+    created_listings = Listing.with_fields(
+        Listing.live().filter(Listing.created_by == username),
+        fields,
+        includes,
+    ).all()
+    with timed("serialize"):
+        serialized = Listing.embed(created_listings, [
+            listing.serialize(isDetailed=False, fields=fields)
+            for listing in created_listings
+        ], includes)
     return (jsonify(listings=serialized), 200)
 
 @app.route('/users/<username>/edit', methods=["PATCH"])
@@ -257,9 +509,10 @@ def user_edit(username):
                         last_name,
                         email,
                         password,
-                        image_url,
                         location
                         }}
+        The profile image is changed by uploading a new one (signup, or
+        POST /uploads with target "user").
         Returns => {
                 user: {
                         username,
@@ -275,45 +528,89 @@ def user_edit(username):
         TODO: Auth required: admin or username equals logged in user
     """
 
-    user = User.query.get_or_404(username)
+    user = User.get_live_or_404(username)
     user_data = request.json.get("user")
-    form = UserEditForm(data=user_data)
+    values, errors = USER_EDIT.validate(user_data)
 
-    if form.validate():
-        if User.authenticate(username, form.password.data):
-            user.update(form)
+    if not errors:
+        if User.authenticate(username, values["password"]):
+            user.update(values)
             db.session.commit()
             return (jsonify(user=user.serialize()), 200)
         else:
             return (jsonify(errors=["Invalid credentials"]), 401)
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
-        return (jsonify(errors=errors), 400)
+        return errors_response(errors)
 
 
 @app.route('/users/<username>/delete', methods=["DELETE"])
 @jwt_required
 def user_delete(username):
-    """ Delete user.
-        Returns { deleted: success }
+    """ Delete user, along with their listings.
+        The user disappears immediately; their rows and images are purged
+        in the background by reaper.py.
+        Returns { deleted: accepted }
         TODO: Auth required: admin or username equals logged in user
     """
-    user = User.query.get_or_404(username)
-    db.session.delete(user)
+    user = User.get_live_or_404(username)
+    soft_delete_user(user)
     db.session.commit()
-    return (jsonify(delete="success"), 201)
+    return (jsonify(delete="accepted"), 202)
 
 
 ##############################################################################
 # Messages routes:
 
+def _message_page_args():
+    """ Parse the `before` cursor and `limit` query parameters.
+        Returns (before, limit, errors).
+    """
+
+    errors = []
+    before = request.args.get("before")
+    if before is not None:
+        try:
+            before = datetime.fromisoformat(before)
+        except ValueError:
+            errors.append("before must be an ISO 8601 timestamp")
+    try:
+        limit = int(request.args.get("limit", MESSAGES_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MESSAGES_PAGE_SIZE:
+        errors.append(f"limit must be between 1 and {MESSAGES_PAGE_SIZE}")
+    return before, limit, errors
+
+
+def _hot_since():
+    """ Messages sent before this may have been archived. """
+
+    return datetime.utcnow() - timedelta(days=app.config['MESSAGE_HOT_DAYS'])
+
+
+def _next_before(messages, limit, before, hot_since):
+    """ Cursor for the page after `messages`, or None if this is the last.
+        A short page that stopped at the edge of the hot window continues
+        from `hot_since`, in the archive.
+    """
+
+    if len(messages) == limit:
+        return messages[-1].sent_at.isoformat()
+    if not reaches_archive(messages, before, hot_since):
+        return hot_since.isoformat()
+    return None
+
+
 @app.route('/messages/<from_username>/<to_username>', methods=["GET"])
 @jwt_required
+@cached("message", "user")
 def messages_list(from_username, to_username):
-    """ Show messages between two users.
+    """ Show messages between two users, newest first.
+        Optional query parameters:
+            before: only messages sent before this (the next_before cursor)
+            limit: page size, 1 to MESSAGES_PAGE_SIZE
+        Pages may come up short before the last; keep paging until
+        next_before is null.
         Returns => {
                     messages: [{
                             body,
@@ -322,19 +619,33 @@ def messages_list(from_username, to_username):
                             sent_at,
                             read_at,
                         },
-                        ...]
+                        ...],
+                    next_before,
                     }
         TODO: Auth required: to_user or from_user equals logged in user
     """
-    User.query.get_or_404(from_username)
-    User.query.get_or_404(to_username)
+    User.get_live_or_404(from_username)
+    User.get_live_or_404(to_username)
 
-    messages = Message.find_all(from_username, to_username)
-    serialized = [message.serialize() for message in messages]
-    return (jsonify(messages=serialized), 200)
+    before, limit, errors = _message_page_args()
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    hot_since = _hot_since()
+    messages = Message.find_all(
+        from_username, to_username, before=before, limit=limit,
+        hot_since=hot_since,
+    )
+    with timed("serialize"):
+        serialized = [message.serialize() for message in messages]
+    return (jsonify(
+        messages=serialized,
+        next_before=_next_before(messages, limit, before, hot_since),
+    ), 200)
 
 @app.route('/messages/<from_username>/<to_username>/add', methods=["POST"])
 @jwt_required
+@idempotent
 def message_add(from_username, to_username):
     """ Create a message.
         Takes in { message: { body, from_user, to_user }}
@@ -349,21 +660,17 @@ def message_add(from_username, to_username):
                     }
         TODO: Auth required: to_user or from_user equals logged in user
     """
-    # from_username = User.query.get_or_404(from_username)
-    # to_username = User.query.get_or_404(to_username)
+    # from_username = User.get_live_or_404(from_username)
+    # to_username = User.get_live_or_404(to_username)
     message_data = request.json.get("message")
-    form = MessageCreateForm(data=message_data)
+    values, errors = MESSAGE_CREATE.validate(message_data)
 
-    if form.validate():
-        message = Message.create(form)
-        db.session.commit()
+    if not errors:
+        message = Message.create(values)
+        commit()
         return (jsonify(message=message.serialize()), 200)
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
-        return (jsonify(errors=errors), 400)
+        return errors_response(errors)
 
 
 ##############################################################################
@@ -371,9 +678,13 @@ def message_add(from_username, to_username):
 
 @app.route('/listings')
 @jwt_required
+@cached("listing", "user")
 def listings_list():
     """ Show listings based on query parameters of
         max price, longitude, latitude, number of beds, or number of bathrooms
+        Optional query parameters:
+            fields: comma-separated keys to return (default: as below)
+            include: creator and/or renter (embedded users)
         Returns => {
                 listings: [
                     {
@@ -390,20 +701,67 @@ def listings_list():
         Auth required: user logged in
     """
 
-    inputs = Listing.convert_inputs(request.args)
-    form = ListingSearchForm(data=inputs)
-    if form.validate():
-        listings = Listing.find_all(inputs)
-        serialized = [listing.serialize(
-                        isDetailed=False
-                        ) for listing in listings]
+    fields, includes, errors = _fieldset_args(
+        LISTING_FIELDS, LISTING_BRIEF_FIELDS, LISTING_INCLUDES
+    )
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    inputs, errors = LISTING_SEARCH.validate(request.args)
+    if not errors:
+        listings = Listing.find_all(inputs, fields, includes)
+        with timed("serialize"):
+            serialized = Listing.embed(listings, [listing.serialize(
+                            isDetailed=False, fields=fields
+                            ) for listing in listings], includes)
         return (jsonify(listings=serialized), 200)
     else:
-        return (jsonify(errors=["Bad request"]), 400)
+        return errors_response(errors)
+
+
+@app.route('/listings/batch')
+@jwt_required
+@cached("listing", "user")
+def listings_batch():
+    """ Show many listings at once.
+        Query parameters:
+            ids: comma-separated listing ids, at most MAX_BATCH_SIZE
+            fields: comma-separated keys to return (default: detailed form)
+            include: creator and/or renter (embedded users)
+        Returns => {
+                    listings: { id: { id, title, ... }, ... },
+                    missing: [id, ...]
+                    }
+        Auth required: user logged in
+    """
+
+    ids, errors = _batch_keys("ids", int)
+    fields, includes, fieldset_errors = _fieldset_args(
+        LISTING_FIELDS, LISTING_FIELDS, LISTING_INCLUDES
+    )
+    errors += fieldset_errors
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    listings = Listing.with_fields(
+        Listing.live().filter(Listing.id.in_(ids)), fields, includes
+    ).all()
+    with timed("serialize"):
+        serialized = Listing.embed(listings, [
+            listing.serialize(isDetailed=True, fields=fields)
+            for listing in listings
+        ], includes)
+    found = {
+        listing.id: listing_dict
+        for listing, listing_dict in zip(listings, serialized)
+    }
+    missing = [listing_id for listing_id in ids if listing_id not in found]
+    return (jsonify(listings=found, missing=missing), 200)
 
 
 @app.route('/listings/<int:listing_id>')
 @jwt_required
+@cached("listing", "user")
 def listing_show(listing_id):
     """ Show a listing.
         Returns => {
@@ -420,19 +778,38 @@ def listing_show(listing_id):
                                 bathrooms,
                                 created_by,
                                 rented_by,
+                                photos,
                             }
                     }
+        Optional query parameters:
+            fields: comma-separated keys to return (default: as above)
+            include: creator and/or renter (embedded users)
         Auth required: user logged in
     """
 
-    listing = Listing.query.get_or_404(listing_id)
-    return (jsonify(listing=listing.serialize(isDetailed=True)), 200)
+    fields, includes, errors = _fieldset_args(
+        LISTING_FIELDS, LISTING_FIELDS, LISTING_INCLUDES
+    )
+    if errors:
+        return (jsonify(errors=errors), 400)
+
+    listing = Listing.with_fields(
+        Listing.live().filter(Listing.id == listing_id), fields, includes
+    ).first_or_404()
+    serialized = listing.serialize(isDetailed=True, fields=fields)
+    Listing.embed([listing], [serialized], includes)
+    return (jsonify(listing=serialized), 200)
 
 
 @app.route('/listings/<int:listing_id>/messages', methods=["GET"])
 @jwt_required
 def listing_messages(listing_id):
-    """ Show messages belonging to a listing thread
+    """ Show messages belonging to a listing thread, newest first.
+        Optional query parameters:
+            before: only messages sent before this (the next_before cursor)
+            limit: page size, 1 to MESSAGES_PAGE_SIZE
+        Pages may come up short before the last; keep paging until
+        next_before is null.
         Returns => {
                     messages: [{
                             body,
@@ -442,21 +819,68 @@ def listing_messages(listing_id):
                             sent_at,
                             read_at,
                         },
-                        ...]
+                        ...],
+                    next_before,
                     }
         TODO: Auth required: to_user or from_user equals logged in user
     """
-    Listing.query.get_or_404(listing_id)
+    Listing.get_live_or_404(listing_id)
+
+    before, limit, errors = _message_page_args()
+    if errors:
+        return (jsonify(errors=errors), 400)
 
     auth_username = get_jwt_identity()
-    all_messages = Message.find_by_listing(listing_id, auth_username)
-    print("ALL MESSAGES: ", all_messages)
-    serialized = [message.serialize() for message in all_messages]
-    return (jsonify(messages=serialized), 200)
+    hot_since = _hot_since()
+    all_messages = Message.find_by_listing(
+        listing_id, auth_username, before=before, limit=limit,
+        hot_since=hot_since,
+    )
+    with timed("serialize"):
+        serialized = [message.serialize() for message in all_messages]
+    return (jsonify(
+        messages=serialized,
+        next_before=_next_before(all_messages, limit, before, hot_since),
+    ), 200)
+
+
+@app.route('/listings/<int:listing_id>/messages/broadcast', methods=["POST"])
+@jwt_required
+@idempotent
+def listing_messages_broadcast(listing_id):
+    """ Send one message from the listing's host to every user who has
+        messaged them about it. Recipients are notified in the background.
+        Takes in { message: { body } }
+        Returns => {
+                    sent,
+                    recipients: [username, ...]
+                    }
+        Auth required: created_by equals logged in user
+    """
+
+    listing = Listing.get_live_or_404(listing_id)
+    host = get_jwt_identity()
+    if listing.created_by != host:
+        return (jsonify(errors=["Unauthorized"]), 403)
+
+    values, errors = MESSAGE_BROADCAST.validate(request.json.get("message"))
+    if errors:
+        return errors_response(errors)
+
+    messages = Message.broadcast(listing_id, host, values["body"])
+    after_commit(lambda: invalidate("message"))
+    if messages:
+        after_commit(lambda: notify_messages(messages))
+    commit()
+    return (jsonify(
+        sent=len(messages),
+        recipients=[message["to_user"] for message in messages],
+    ), 201)
 
 
 @app.route('/listings', methods=["POST"])
 @jwt_required
+@idempotent
 def listing_create():
     """ Create a new listing.
         Takes in { listing: {
@@ -490,20 +914,150 @@ def listing_create():
     TODO: Auth required: admin or logged in user
     """
     listing_data = request.json.get("listing")
-    form = ListingCreateForm(data=listing_data)
+    values, errors = LISTING_CREATE.validate(listing_data)
 
-    if form.validate():
-        listing = Listing.create(form)
-        db.session.commit()
+    if not errors:
+        listing = Listing.create(values)
+        commit()
         # TODO: reevaluate error with a try and except later
         return (jsonify(listing=listing.serialize(isDetailed=True)), 201)
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
+        return errors_response(errors)
+
+
+@app.route('/listings/bulk', methods=["POST"])
+@jwt_required
+def listings_bulk_create():
+    """ Create many listings from a streamed CSV or NDJSON body.
+        Content-Type: text/csv (with a header row) or application/x-ndjson.
+        Each row takes the same fields as POST /listings.
+        Valid rows are inserted in a single transaction; invalid rows are
+        reported by row number (1-based, not counting a CSV header).
+        Returns => {
+                    inserted,
+                    ids: [id, ...],
+                    errors: [{ row, errors: [...] }, ...]
+                    }
+        TODO: Auth required: admin or logged in user
+    """
+
+    if (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+        return (jsonify(errors=["Request body too large"]), 413)
+
+    try:
+        ids, errors = import_listings(request.stream, request.mimetype)
+    except BulkImportError as e:
+        db.session.rollback()
+        return (jsonify(errors=[str(e)]), 400)
+    except IntegrityError:
+        db.session.rollback()
+        return (jsonify(errors=["Failed to insert listings"]), 400)
+
+    db.session.commit()
+    invalidate("listing")
+    status = 201 if ids or not errors else 400
+    return (jsonify(inserted=len(ids), ids=ids, errors=errors), status)
+
+
+@app.route('/listings/export')
+@jwt_required
+def listings_export():
+    """ Stream listings matching the same query parameters as GET /listings.
+        ?format=ndjson (default) or ?format=csv
+        Rows are streamed as they are read, never materialized all at once.
+        Auth required: user logged in
+    """
+
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in ("ndjson", "csv"):
+        return (jsonify(errors=["format must be ndjson or csv"]), 400)
+
+    inputs, errors = LISTING_SEARCH.validate(request.args)
+    if errors:
+        return errors_response(errors)
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(
+        stream_with_context(export_listings(inputs, fmt)),
+        mimetype=mimetype,
+    )
+
+
+@app.route('/listings/<int:listing_id>/photos', methods=["POST"])
+@jwt_required
+def listing_photos_add(listing_id):
+    """ Add photos to a listing's gallery.
+        Takes multipart form data with one or more files under `photos`.
+        Files are stored by content hash (images S3 already has aren't
+        uploaded again), new ones are uploaded to S3 in parallel, and all are
+        appended to the gallery in the order they were sent; the first photo
+        becomes the cover image if the listing doesn't have one yet.
+        Returns => {
+                    photos: [{ id, position, url, width, height }, ...],
+                    errors: [...]
+                    }
+        Auth required: admin or created_by equals logged in user
+    """
+
+    listing = Listing.get_live_or_404(listing_id)
+    if (listing.created_by != get_jwt_identity()
+            and not get_jwt_claims()['is_admin']):
+        return (jsonify(errors=["Unauthorized"]), 403)
+
+    files = [file for file in request.files.getlist('photos') if file]
+    if not files:
+        return (jsonify(errors=["No photos uploaded"]), 400)
+    if len(files) > MAX_PHOTOS_PER_UPLOAD:
+        errors = [f"Upload at most {MAX_PHOTOS_PER_UPLOAD} photos at a time"]
+        return (jsonify(errors=errors), 400)
+
+    errors = []
+    accepted = []
+    dimensions = []
+    for file in files:
+        if not allowed_file(file.filename):
+            errors.append(f"{file.filename}: file type not allowed")
+            continue
+        accepted.append(file)
+        dimensions.append(image_dimensions(file.stream))
+
+    keys = store_images(accepted, BUCKET)
+
+    photos = []
+    position = ListingPhoto.next_position(listing_id)
+    for file, key, (width, height) in zip(accepted, keys, dimensions):
+        if key is None:
+            errors.append(f"{file.filename}: failure to upload image")
+            continue
+        photo = ListingPhoto(
+            listing_id=listing_id,
+            position=position,
+            object_name=key,
+            url=create_presigned_url(BUCKET, key),
+            width=width,
+            height=height,
+        )
+        db.session.add(photo)
+        photos.append(photo)
+        position += 1
+
+    if not photos:
+        db.session.rollback()
         return (jsonify(errors=errors), 400)
 
+    if listing.photo == DEFAULT_LOCATION_IMAGE:
+        listing.photo = photos[0].url
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        errors = ["Gallery changed while uploading, please retry"]
+        return (jsonify(errors=errors), 409)
+
+    serialized = [photo.serialize() for photo in photos]
+    return (jsonify(photos=serialized, errors=errors), 201)
+
 
 @app.route('/listings/<int:listing_id>/edit', methods=["PATCH"])
 @jwt_required
@@ -541,34 +1095,199 @@ def listing_edit(listing_id):
         TODO: Auth required: admin or created_by equals logged in user
     """
 
-    listing = Listing.query.get_or_404(listing_id)
+    listing = Listing.get_live_or_404(listing_id)
     listing_data = request.json.get("listing")
-    form = ListingEditForm(data=listing_data)
+    values, errors = LISTING_EDIT.validate(listing_data)
 
-    if form.validate():
-        listing.update(form)
+    if not errors:
+        listing.update(values)
         db.session.commit()
         return (jsonify(listing=listing.serialize(isDetailed=True)), 200)
 
     else:
-        errors = []
-        for field in form:
-            for error in field.errors:
-                errors.append(error)
-        return (jsonify(errors=errors), 400)
+        return errors_response(errors)
 
 
 @app.route('/listings/<int:listing_id>/delete', methods=["DELETE"])
 @jwt_required
 def listing_delete(listing_id):
     """ Delete listing.
-        Returns { deleted: success }
+        The listing disappears immediately; its rows and photos are purged
+        in the background by reaper.py.
+        Returns { deleted: accepted }
         TODO: Auth required: admin or created_by equals logged in user
     """
-    listing = Listing.query.get_or_404(listing_id)
-    db.session.delete(listing)
+    listing = Listing.get_live_or_404(listing_id)
+    soft_delete_listing(listing)
     db.session.commit()
-    return (jsonify(delete="success"), 201)
+    return (jsonify(delete="accepted"), 202)
+
+
+##############################################################################
+# Direct-to-S3 uploads:
+
+def _direct_upload_prefix(username, target, listing_id):
+    """ S3 key prefix a user's direct uploads for a target must live under. """
+
+    if target == "listing":
+        return f"uploads/{username}/listing/{listing_id}/"
+    return f"uploads/{username}/user/"
+
+
+def _direct_upload_target(upload_data):
+    """ Check the upload target and return (listing, error response).
+
+        The user may only upload their own profile image, or photos for
+        listings they created (admins may upload for any listing).
+    """
+
+    target = upload_data.get("target")
+    if target == "user":
+        return None, None
+    if target != "listing":
+        errors = ["target must be 'user' or 'listing'"]
+        return None, (jsonify(errors=errors), 400)
+
+    listing = Listing.get_live_or_404(upload_data.get("listing_id"))
+    if (listing.created_by != get_jwt_identity()
+            and not get_jwt_claims()['is_admin']):
+        return None, (jsonify(errors=["Unauthorized"]), 403)
+    return listing, None
+
+
+@app.route('/uploads', methods=["POST"])
+@jwt_required
+def upload_presign():
+    """ Issue a presigned POST for uploading an image straight to S3.
+        Takes in { upload: {
+                        target: "user" or "listing",
+                        listing_id (listing only),
+                        filename,
+                        content_type,
+                        }}
+        Returns => {
+                    upload: {
+                            url,
+                            fields,
+                            key,
+                            max_size,
+                            expires_in,
+                        }
+                    }
+        The client POSTs `fields` plus its file (last) as multipart form data
+        to `url`, then calls POST /uploads/complete with `key`.
+        Auth required: logged in user (and listing creator or admin)
+    """
+
+    upload_data = request.json.get("upload") or {}
+    listing, error = _direct_upload_target(upload_data)
+    if error:
+        return error
+
+    filename = upload_data.get("filename") or ""
+    content_type = upload_data.get("content_type")
+    if not allowed_file(filename) or content_type not in ALLOWED_CONTENT_TYPES:
+        return (jsonify(errors=["File type not allowed"]), 400)
+
+    ext = filename.rsplit('.', 1)[1].lower()
+    key = (
+        _direct_upload_prefix(
+            get_jwt_identity(),
+            upload_data["target"],
+            listing.id if listing else None,
+        )
+        + f"{uuid.uuid4().hex}.{ext}"
+    )
+    presigned = create_presigned_post(
+        BUCKET, key, content_type, DIRECT_UPLOAD_MAX_BYTES,
+        DIRECT_UPLOAD_EXPIRATION,
+    )
+    if presigned is None:
+        return (jsonify(errors=["Failure to create upload"]), 502)
+
+    return (jsonify(upload={
+        "url": presigned["url"],
+        "fields": presigned["fields"],
+        "key": key,
+        "max_size": DIRECT_UPLOAD_MAX_BYTES,
+        "expires_in": DIRECT_UPLOAD_EXPIRATION,
+    }), 201)
+
+
+@app.route('/uploads/complete', methods=["POST"])
+@jwt_required
+def upload_complete():
+    """ Link a finished direct upload to the user or listing.
+        Takes in { upload: { target, listing_id (listing only), key }}
+        Verifies the object exists in S3 within the allowed size and type.
+        Returns => { user: {...} } for target "user", or
+                   { photo: { id, position, url, width, height }} for
+                   target "listing"
+        Auth required: logged in user (and listing creator or admin)
+    """
+
+    upload_data = request.json.get("upload") or {}
+    listing, error = _direct_upload_target(upload_data)
+    if error:
+        return error
+
+    key = upload_data.get("key") or ""
+    prefix = _direct_upload_prefix(
+        get_jwt_identity(),
+        upload_data["target"],
+        listing.id if listing else None,
+    )
+    if not key.startswith(prefix) or "/" in key[len(prefix):]:
+        return (jsonify(errors=["Invalid upload key"]), 400)
+
+    if listing is not None:
+        linked = ListingPhoto.query.filter_by(object_name=key).first()
+        if linked:
+            return (jsonify(photo=linked.serialize()), 200)
+
+    head_bytes = DIRECT_UPLOAD_HEAD_BYTES if listing else 0
+    uploaded = head_object(BUCKET, key, head_bytes)
+    if uploaded is None:
+        return (jsonify(errors=["Upload not found"]), 404)
+    if (uploaded["size"] > DIRECT_UPLOAD_MAX_BYTES
+            or uploaded["content_type"] not in ALLOWED_CONTENT_TYPES):
+        return (jsonify(errors=["Upload rejected"]), 400)
+
+    url = create_presigned_url(BUCKET, key)
+
+    if listing is None:
+        user = User.get_live_or_404(get_jwt_identity())
+        # Taken before the old one is released, so re-linking the same key
+        # keeps its reference.
+        previous = user.image_key
+        user.image_key = acquire_upload(key, uploaded["size"],
+                                        uploaded["content_type"])
+        release_object(previous)
+        user.image_url = url
+        db.session.commit()
+        return (jsonify(user=user.serialize()), 200)
+
+    width, height = image_dimensions(uploaded["head"])
+    photo = ListingPhoto(
+        listing_id=listing.id,
+        position=ListingPhoto.next_position(listing.id),
+        object_name=key,
+        url=url,
+        width=width,
+        height=height,
+    )
+    db.session.add(photo)
+    if listing.photo == DEFAULT_LOCATION_IMAGE:
+        listing.photo = url
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        errors = ["Gallery changed while uploading, please retry"]
+        return (jsonify(errors=errors), 409)
+
+    return (jsonify(photo=photo.serialize()), 201)
 
 
 ##############################################################################
@@ -0,0 +1,93 @@
+"""Move old messages out of the hot `messages` table.
+
+Messages older than MESSAGE_HOT_DAYS are copied, oldest first and in
+bounded batches, into `message_archive` (ArchivedMessage) with their bodies
+zlib-compressed, then deleted from `messages`; each batch is its own short
+transaction. That keeps `messages` and its indexes sized to recent
+conversations, which is what almost every read asks for.
+
+Reads don't need to know: Message.find_all and Message.find_by_listing
+only query the archive when the hot table can't fill the requested page,
+i.e. once a client pages (with the `before` cursor) past the hot window.
+
+    python archive.py            # archive everything past the cutoff
+    python archive.py --once     # one batch, then exit
+"""
+
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+from models import db, Message, ArchivedMessage
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def archive_messages(cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """ Move up to `batch_size` of the oldest messages sent before `cutoff`
+        into the archive, and commit. Returns how many were moved.
+    """
+
+    messages = db.session.query(
+        *Message.__table__.columns
+    ).filter(
+        Message.sent_at < cutoff
+    ).order_by(
+        Message.sent_at
+    ).limit(batch_size).with_for_update().all()
+    if not messages:
+        db.session.commit()
+        return 0
+
+    db.session.execute(
+        ArchivedMessage.__table__.insert(),
+        [ArchivedMessage.values_from_message(message)
+         for message in messages],
+    )
+    Message.query.filter(
+        Message.id.in_([message.id for message in messages])
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return len(messages)
+
+
+def archive_all(cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """ Archive batches until nothing before `cutoff` is left. """
+
+    total = 0
+    while True:
+        moved = archive_messages(cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+        logger.info("archived %s messages", total)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move old messages to the archive table."
+    )
+    parser.add_argument('--once', action='store_true',
+                        help="archive one batch and exit")
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--days', type=int,
+                        help="archive messages older than this many days "
+                             "(default: MESSAGE_HOT_DAYS)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        days = args.days or app.config['MESSAGE_HOT_DAYS']
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        if args.once:
+            moved = archive_messages(cutoff, args.batch_size)
+        else:
+            moved = archive_all(cutoff, args.batch_size)
+    print(f"Archived {moved} messages sent before {cutoff.isoformat()}")
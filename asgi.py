@@ -0,0 +1,122 @@
+"""Serve the app under an ASGI server instead of a WSGI one.
+
+    pip3 install -r requirements-asgi.txt
+    ASGI_THREADS=32 uvicorn asgi:application --workers 2
+
+Under a sync WSGI server (e.g. gunicorn's default workers) each worker
+handles one request at a time, and a request blocked on Postgres, S3 or
+bcrypt holds its worker for the whole wait. Here the server's event loop
+owns the connections (slow clients and idle keep-alives cost no thread),
+and the routes in app.py run unchanged on a pool of ASGI_THREADS threads
+per worker. Database, S3 and bcrypt calls release the GIL while they
+wait, so one worker serves up to ASGI_THREADS requests at once, and the
+database connection pool is sized to match.
+
+Flask 1.1 views and SQLAlchemy 1.3 sessions are synchronous, so this is
+the async mode they support: the loop is async, the handlers are threads.
+asgiref's stock WsgiToAsgi runs every request on one shared thread, so
+this module gives it a pool of its own.
+
+Requests waiting for a thread count towards MAX_CONCURRENT_REQUESTS, so a
+worker whose pool is backed up sheds new requests with 503 at once rather
+than queueing them (see ratelimit.py).
+
+Compare the two deployments with benchmarks/serving.py.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+from app import app
+from metrics import registry
+from ratelimit import DEFAULT_RETRY_AFTER
+
+
+def _configure_pool(app, threads):
+    """ One database connection per handler thread (Postgres only: SQLite
+        doesn't pool connections).
+    """
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith("sqlite"):
+        return
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    options.setdefault('pool_size', threads)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    """ WsgiToAsgi that runs requests concurrently on `executor`, and
+        refuses requests beyond `max_pending` running or waiting for it.
+    """
+
+    def __init__(self, wsgi_application, executor, max_pending=None):
+        super().__init__(wsgi_application)
+        self.max_pending = max_pending
+        # Only touched from the event loop.
+        self.pending = 0
+        run_wsgi_app = sync_to_async(
+            WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+            thread_sensitive=False,
+            executor=executor,
+        )
+        self._instance_class = type(
+            "ThreadPoolWsgiToAsgiInstance",
+            (WsgiToAsgiInstance,),
+            {"run_wsgi_app": run_wsgi_app},
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            # Nothing to set up or tear down.
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        if self.max_pending and self.pending >= self.max_pending:
+            registry.inc("sharebnb_admission_total",
+                         (("route", "asgi"), ("decision", "pending")))
+            await _busy(send)
+            return
+        self.pending += 1
+        try:
+            await self._instance_class(
+                self.wsgi_application, self.duplicate_header_limit
+            )(scope, receive, send)
+        finally:
+            self.pending -= 1
+
+
+async def _busy(send):
+    body = b'{"errors": ["Server busy, retry shortly"]}'
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(DEFAULT_RETRY_AFTER).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_application(threads=None):
+    """ The ASGI application, handling requests on `threads` threads
+        (default: ASGI_THREADS).
+    """
+
+    threads = threads or app.config['ASGI_THREADS']
+    _configure_pool(app, threads)
+    executor = ThreadPoolExecutor(
+        max_workers=threads,
+        thread_name_prefix="asgi",
+    )
+    max_pending = None
+    if app.config['RATE_LIMITS_ENABLED']:
+        max_pending = app.config['MAX_CONCURRENT_REQUESTS']
+    return ThreadPoolWsgiToAsgi(app, executor, max_pending)
+
+
+application = create_application()
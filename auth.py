@@ -0,0 +1,34 @@
+"""Authorization helpers built on the JWT claims added at login."""
+
+from functools import wraps
+
+from flask import jsonify
+from flask_jwt_extended import (
+    get_jwt_claims, verify_jwt_in_request, verify_jwt_in_request_optional
+)
+
+
+def admin_required(fn):
+    """ Like @jwt_required, but the token must also carry is_admin. """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        verify_jwt_in_request()
+        if not get_jwt_claims().get('is_admin'):
+            return (jsonify(errors=["Admin access required"]), 403)
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+def is_admin_request():
+    """ True if the current request carries a valid admin token.
+
+        Never raises: a missing or bad token just means "not an admin".
+    """
+
+    try:
+        verify_jwt_in_request_optional()
+        return bool((get_jwt_claims() or {}).get('is_admin'))
+    except Exception:
+        return False
@@ -0,0 +1,85 @@
+"""Compare two benchmark result files and flag regressions.
+
+    python benchmarks/compare.py results/new.json results/baseline.json
+
+A scenario regresses when its p95 latency grows, or its throughput drops,
+by more than the threshold (15% by default). Exits 1 if anything regressed.
+"""
+
+import argparse
+import json
+import sys
+
+DEFAULT_THRESHOLD = 0.15
+
+
+def compare(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Compare result dicts scenario by scenario.
+
+        Returns a list of (scenario, metric, baseline, current, change, bad)
+        rows; `change` is the relative change, `bad` marks a regression.
+    """
+
+    rows = []
+    for scenario, result in current["results"].items():
+        base = baseline["results"].get(scenario)
+        if base is None:
+            continue
+
+        for metric, higher_is_worse in [("p95_ms", True),
+                                        ("throughput_rps", False)]:
+            old = base[metric]
+            new = result[metric]
+            change = (new - old) / old if old else 0.0
+            bad = change > threshold if higher_is_worse else (
+                change < -threshold
+            )
+            rows.append((scenario, metric, old, new, change, bad))
+    return rows
+
+
+def mismatched_meta(current, baseline):
+    """ Run settings that differ between the two runs. """
+
+    return [
+        key for key in ("scale", "database", "concurrency")
+        if current["meta"].get(key) != baseline["meta"].get(key)
+    ]
+
+
+def print_comparison(rows):
+    """ Print the comparison as a table.
+        Returns True if anything regressed.
+    """
+
+    print(f"{'scenario':<28}{'metric':<16}{'baseline':>12}"
+          f"{'current':>12}{'change':>10}")
+    regressed = False
+    for scenario, metric, old, new, change, bad in rows:
+        flag = "  REGRESSION" if bad else ""
+        print(f"{scenario:<28}{metric:<16}{old:>12.2f}{new:>12.2f}"
+              f"{change:>+10.1%}{flag}")
+        regressed = regressed or bad
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('current')
+    parser.add_argument('baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    with open(args.current) as current_file:
+        current = json.load(current_file)
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    for key in mismatched_meta(current, baseline):
+        print(f"warning: {key} differs from the baseline run")
+    rows = compare(current, baseline, args.threshold)
+    return 1 if print_comparison(rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,694 @@
+"""Benchmark the API's hot endpoints against a locally seeded database.
+
+Seeds a database with generator/synthetic.py data at the requested scale
+(COPY on Postgres, batched inserts on SQLite), puts moto in front of S3,
+then drives the Flask app in-process and reports throughput and
+p50/p95/p99 latency per scenario:
+
+    python benchmarks/run.py --scale 10k
+    python benchmarks/run.py --scale 100k \\
+        --database-url postgresql:///sharebnb_bench \\
+        --baseline benchmarks/results/baseline-100k.json
+
+Results are written as JSON (see --output). With --baseline, the run is
+compared against an earlier result file and the script exits 1 if any
+scenario regressed (see compare.py).
+
+On Postgres the seeded `messages` table is partitioned by month (see
+partitions.py), and the report also records how many partitions the
+message finders read for recently active threads.
+
+The report also compares response compression: for a sample of real
+listing and message responses, the bytes sent and the CPU time spent
+compressing and decompressing at each encoding and level (see
+compression.py), and how long each request schema takes to validate a
+typical body (see schemas.py). --response-cache-ttl turns on the response
+cache (see cache.py) for the scenarios.
+
+The database is reseeded only when its row counts don't match the scale,
+so repeated runs against the same database skip straight to measuring.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import islice
+from random import Random
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "generator"))
+
+from compare import (  # noqa: E402
+    compare, mismatched_meta, print_comparison
+)
+
+SCALES = {
+    "10k": 10000,
+    "100k": 100000,
+    "1m": 1000000,
+}
+
+# bcrypt makes every login take a few hundred ms, so it gets fewer requests.
+LOGIN_REQUESTS = 20
+SEED_BATCH_SIZE = 10000
+
+# Most recently active threads whose finder queries are EXPLAINed to check
+# partition pruning (Postgres only).
+PRUNING_THREADS = 20
+
+# Levels compared per encoding (those whose package isn't installed are
+# skipped). Each sample is compressed at each level up to
+# COMPRESSION_ROUNDS times, stopping early once COMPRESSION_BUDGET seconds
+# are spent (the slowest levels take seconds on large responses).
+COMPRESSION_LEVELS = {
+    "gzip": (1, 6, 9),
+    "br": (1, 4, 5, 9, 11),
+    "zstd": (1, 3, 9, 19),
+}
+COMPRESSION_ROUNDS = 20
+COMPRESSION_BUDGET = 1.0
+
+# Times each request schema validates a typical body.
+VALIDATION_ROUNDS = 10000
+
+
+def scale_counts(rows):
+    """ Number of users, listings and messages for a scale. """
+
+    return {
+        "users": max(rows // 10, 10),
+        "listings": rows,
+        "messages": rows,
+    }
+
+
+def percentile(sorted_values, pct):
+    """ Nearest-rank percentile of an already sorted list. """
+
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(db, counts, seed_value):
+    """ Recreate the tables and fill them with synthetic data. """
+
+    import synthetic
+
+    db.drop_all()
+    db.create_all()
+
+    pools = synthetic.Pools(seed_value)
+    end_date = datetime.fromisoformat(synthetic.DEFAULT_END_DATE)
+    tables = [
+        ("users", synthetic.USERS_CSV_HEADERS,
+         synthetic.iter_users(pools, counts["users"]), counts["users"]),
+        ("listings", synthetic.LISTINGS_CSV_HEADERS,
+         synthetic.iter_listings(pools, counts["listings"], counts["users"]),
+         counts["listings"]),
+        ("messages", synthetic.MESSAGES_CSV_HEADERS,
+         synthetic.iter_messages(pools, counts["messages"],
+                                 counts["listings"], counts["users"],
+                                 end_date),
+         counts["messages"]),
+    ]
+
+    if db.engine.dialect.name == "postgresql":
+        conn = db.engine.raw_connection()
+        try:
+            for table, headers, rows, total in tables:
+                synthetic.copy_rows(
+                    conn, table, headers, rows, total, SEED_BATCH_SIZE
+                )
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE")
+            conn.commit()
+        finally:
+            conn.close()
+
+        import partitions
+
+        with db.engine.begin() as connection:
+            partitions.migrate(connection)
+        _backfill_geo_cells()
+        return
+
+    for table, headers, rows, total in tables:
+        progress = synthetic.Progress(table, total)
+        table_obj = db.metadata.tables[table]
+        rows = iter(rows)
+        while True:
+            batch = [dict(zip(headers, row))
+                     for row in islice(rows, SEED_BATCH_SIZE)]
+            if not batch:
+                break
+            if table == "messages":
+                for row in batch:
+                    row["sent_at"] = datetime.fromisoformat(row["sent_at"])
+            db.engine.execute(table_obj.insert(), batch)
+            progress.update(len(batch))
+        progress.finish()
+    _backfill_geo_cells()
+
+
+def _backfill_geo_cells():
+    import clusters
+
+    clusters.backfill_all(SEED_BATCH_SIZE)
+
+
+def is_seeded(db, counts):
+    """ True if the tables exist and hold the expected row counts.
+
+        Earlier runs' message_add requests leave extra messages behind, so
+        messages only need to be at least the seeded count.
+    """
+
+    try:
+        for table, expected in counts.items():
+            actual = db.engine.execute(
+                f"SELECT count(*) FROM {table}"
+            ).scalar()
+            if actual < expected or (actual > expected
+                                     and table != "messages"):
+                return False
+    except Exception:
+        return False
+    return True
+
+
+def build_scenarios(app, db, counts, rng):
+    """ Map scenario name -> (request count override, request factory).
+
+        A request factory returns (method, url, kwargs) for the test client.
+    """
+
+    from flask_jwt_extended import create_access_token
+    from models import User, Listing, Message
+
+    with app.app_context():
+        users = [
+            username for (username,) in
+            db.session.query(User.username).limit(1000)
+        ]
+        threads = db.session.query(
+            Message.from_user, Message.to_user, Message.listing_id
+        ).limit(1000).all()
+        locations = db.session.query(
+            Listing.latitude, Listing.longitude
+        ).limit(1000).all()
+        token = create_access_token(identity=User.query.get(users[0]))
+
+    headers = {"Authorization": f"Bearer {token}"}
+    num_listings = counts["listings"]
+
+    def login():
+        return ("POST", "/login", {"json": {"user": {
+            "username": rng.choice(users),
+            "password": "password",
+        }}})
+
+    def listings_unfiltered():
+        return ("GET", "/listings", {"headers": headers})
+
+    def listings_unfiltered_compressed():
+        return ("GET", "/listings", {"headers": {
+            **headers, "Accept-Encoding": "br, zstd, gzip",
+        }})
+
+    def listings_max_price():
+        max_price = rng.randrange(200, 400)
+        return ("GET", f"/listings?max_price={max_price}",
+                {"headers": headers})
+
+    def listings_beds_bathrooms():
+        return ("GET",
+                f"/listings?beds={rng.randint(1, 6)}"
+                f"&bathrooms={rng.randint(1, 6)}",
+                {"headers": headers})
+
+    def listing_show():
+        listing_id = rng.randint(1, num_listings)
+        return ("GET", f"/listings/{listing_id}", {"headers": headers})
+
+    def listing_similar():
+        listing_id = rng.randint(1, num_listings)
+        return ("GET", f"/listings/{listing_id}/similar",
+                {"headers": headers})
+
+    def listing_clusters_city():
+        latitude, longitude = rng.choice(locations)
+        bbox = (f"{latitude - 0.3},{longitude - 0.5},"
+                f"{latitude + 0.3},{longitude + 0.5}")
+        return ("GET", f"/listings/clusters?bbox={bbox}&zoom=10",
+                {"headers": headers})
+
+    def listing_clusters_world():
+        return ("GET", "/listings/clusters?bbox=-85,-180,85,180&zoom=1",
+                {"headers": headers})
+
+    def messages_list():
+        from_user, to_user, _ = rng.choice(threads)
+        return ("GET", f"/messages/{from_user}/{to_user}",
+                {"headers": headers})
+
+    def message_add():
+        from_user, to_user, listing_id = rng.choice(threads)
+        return ("POST", f"/messages/{from_user}/{to_user}/add", {
+            "headers": headers,
+            "json": {"message": {
+                "body": "Is this still available?",
+                "from_user": from_user,
+                "to_user": to_user,
+                "listing_id": listing_id,
+            }},
+        })
+
+    return {
+        "login": (LOGIN_REQUESTS, login),
+        "listings_unfiltered": (None, listings_unfiltered),
+        "listings_unfiltered_compressed": (
+            None, listings_unfiltered_compressed
+        ),
+        "listings_max_price": (None, listings_max_price),
+        "listings_beds_bathrooms": (None, listings_beds_bathrooms),
+        "listing_show": (None, listing_show),
+        "listing_similar": (None, listing_similar),
+        "listing_clusters_city": (None, listing_clusters_city),
+        "listing_clusters_world": (None, listing_clusters_world),
+        "messages_list": (None, messages_list),
+        "message_add": (None, message_add),
+    }
+
+
+def _partitions_read(plan):
+    """ Names of the partitions an EXPLAIN ANALYZE plan actually read. """
+
+    read = set()
+    stack = [plan]
+    while stack:
+        node = stack.pop()
+        relation = node.get("Relation Name", "")
+        if relation.startswith("messages_") and node.get("Actual Loops"):
+            read.add(relation)
+        stack.extend(node.get("Plans", []))
+    return read
+
+
+def check_partition_pruning(app, db):
+    """ How many `messages` partitions Message.find_all/find_by_listing read
+        for the most recently active threads, for a first page ("page") and
+        for just the latest message ("latest"). Returns None unless the
+        table is partitioned.
+
+        The finders' own SQL is captured and re-run under EXPLAIN ANALYZE,
+        so this checks the queries the routes really send.
+    """
+
+    import partitions
+    from sqlalchemy import event
+    from models import Message, MESSAGES_PAGE_SIZE
+
+    with app.app_context():
+        connection = db.session.connection()
+        if not partitions.is_partitioned(connection):
+            return None
+        total = len(partitions.list_partitions(connection))
+        threads = db.session.query(
+            Message.from_user, Message.to_user, Message.listing_id
+        ).order_by(Message.sent_at.desc()).limit(PRUNING_THREADS).all()
+
+        captured = []
+
+        def capture(conn, cursor, statement, parameters, context, many):
+            if "FROM messages " in statement:
+                captured.append((statement, parameters))
+
+        finders = {
+            "find_all": lambda thread, limit: Message.find_all(
+                thread.from_user, thread.to_user, limit=limit),
+            "find_by_listing": lambda thread, limit: Message.find_by_listing(
+                thread.listing_id, thread.from_user, limit=limit),
+        }
+        report = {"partitions": total}
+        for name, finder in finders.items():
+            for page, limit in (("page", MESSAGES_PAGE_SIZE), ("latest", 1)):
+                counts = []
+                for thread in threads:
+                    captured.clear()
+                    event.listen(db.engine, "before_cursor_execute", capture)
+                    try:
+                        finder(thread, limit)
+                    finally:
+                        event.remove(
+                            db.engine, "before_cursor_execute", capture
+                        )
+                    statement, parameters = captured[0]
+                    plan = db.session.connection().execute(
+                        "EXPLAIN (ANALYZE, FORMAT JSON) " + statement,
+                        parameters,
+                    ).scalar()
+                    counts.append(len(_partitions_read(plan[0]["Plan"])))
+                report[f"{name}_{page}"] = {
+                    "mean_partitions_read": sum(counts) / len(counts),
+                    "max_partitions_read": max(counts),
+                }
+        db.session.rollback()
+    return report
+
+
+def _decompressor(encoding):
+    import gzip
+    import compression
+
+    if encoding == "br":
+        return compression.brotli.decompress
+    if encoding == "zstd":
+        decompressor = compression.zstandard.ZstdDecompressor()
+        return decompressor.decompress
+    return gzip.decompress
+
+
+def check_compression(app, db):
+    """ Bytes on the wire and CPU time per encoding and level, for the
+        uncompressed bodies of a few typical responses.
+    """
+
+    import compression
+    from flask_jwt_extended import create_access_token
+    from models import User, Message
+
+    with app.app_context():
+        user = User.query.first()
+        thread = db.session.query(Message.from_user, Message.to_user).first()
+        token = create_access_token(identity=user)
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Accept-Encoding": "identity",
+    }
+
+    client = app.test_client()
+    urls = {
+        "listings": "/listings",
+        "user_listings": f"/users/{user.username}/listings",
+    }
+    if thread is not None:
+        urls["messages"] = f"/messages/{thread[0]}/{thread[1]}"
+    samples = {
+        name: client.get(url, headers=headers).get_data()
+        for name, url in urls.items()
+    }
+
+    report = {}
+    for name, body in samples.items():
+        results = {"bytes": len(body)}
+        for encoding, levels in COMPRESSION_LEVELS.items():
+            if encoding not in compression.ENCODERS:
+                continue
+            decompress = _decompressor(encoding)
+            for level in levels:
+                rounds = 0
+                started = time.perf_counter()
+                while (rounds < COMPRESSION_ROUNDS and
+                       time.perf_counter() - started < COMPRESSION_BUDGET):
+                    compressed = compression.compress(body, encoding, level)
+                    rounds += 1
+                compress_time = time.perf_counter() - started
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    decompress(compressed)
+                decompress_time = time.perf_counter() - started
+                results[f"{encoding}-{level}"] = {
+                    "bytes": len(compressed),
+                    "ratio": len(body) / len(compressed),
+                    "compress_ms": 1000 * compress_time / rounds,
+                    "decompress_ms": 1000 * decompress_time / rounds,
+                }
+        report[name] = results
+    return report
+
+
+def check_validation():
+    """ Microseconds per validation of a typical body by each schema.
+        Schemas are compiled at import, so this is the whole per-request
+        cost.
+    """
+
+    import schemas
+
+    bodies = {
+        "USER_LOGIN": {"username": "guest", "password": "password"},
+        "MESSAGE_CREATE": {
+            "body": "Is this still available?",
+            "from_user": "guest",
+            "to_user": "host",
+            "listing_id": 1,
+        },
+        "LISTING_CREATE": {
+            "title": "Sunny studio",
+            "description": "Close to the park",
+            "price": 120.5,
+            "longitude": -122.42,
+            "latitude": 37.77,
+            "beds": 1,
+            "rooms": 2,
+            "bathrooms": 1,
+            "created_by": "host",
+        },
+        # Query strings arrive as text and are coerced.
+        "LISTING_SEARCH": {
+            "max_price": "300",
+            "beds": "2.0",
+            "bathrooms": "1",
+        },
+    }
+
+    report = {}
+    for name, body in bodies.items():
+        schema = getattr(schemas, name)
+        started = time.perf_counter()
+        for _ in range(VALIDATION_ROUNDS):
+            schema.validate(body)
+        elapsed = time.perf_counter() - started
+        report[name] = {"validate_us": 1e6 * elapsed / VALIDATION_ROUNDS}
+    return report
+
+
+def run_scenario(app, make_request, count, concurrency, warmup):
+    """ Issue `count` requests from `concurrency` threads and time them. """
+
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker(requests_to_send):
+        client = app.test_client()
+        local = []
+        local_errors = 0
+        for _ in range(requests_to_send):
+            method, url, kwargs = make_request()
+            started = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            local.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                local_errors += 1
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    worker(warmup)
+    latencies.clear()
+    errors[0] = 0
+
+    per_thread = [count // concurrency] * concurrency
+    for idx in range(count % concurrency):
+        per_thread[idx] += 1
+
+    started = time.perf_counter()
+    workers = [
+        threading.Thread(target=worker, args=(n,)) for n in per_thread if n
+    ]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+    }
+
+
+def start_fake_s3(bucket):
+    """ Start moto's S3 mock and create the app's bucket in it. """
+
+    try:
+        from moto import mock_aws as mock_s3
+    except ImportError:
+        from moto import mock_s3
+    import boto3
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    mock = mock_s3()
+    mock.start()
+    boto3.client("s3").create_bucket(Bucket=bucket)
+    return mock
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default="10k")
+    parser.add_argument(
+        '--database-url',
+        default="sqlite:////tmp/sharebnb-bench.db",
+        help="database to seed and benchmark against (it is reseeded!)",
+    )
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per scenario")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="untimed requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', nargs="*",
+                        help="only run these scenarios")
+    parser.add_argument('--response-cache-ttl', type=float, default=0,
+                        help="serve cached responses for this many seconds")
+    parser.add_argument('--output', help="where to write the results JSON")
+    parser.add_argument('--baseline', help="results JSON to compare against")
+    parser.add_argument('--threshold', type=float, default=0.15)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["RESPONSE_CACHE_TTL"] = str(args.response_cache_ttl)
+    # Measure the routes, not the rate limits in front of them or a
+    # warm-up running beside them.
+    os.environ["RATE_LIMITS_ENABLED"] = "0"
+    os.environ["WARMUP_ENABLED"] = "0"
+
+    from app import app, db, BUCKET
+
+    counts = scale_counts(SCALES[args.scale])
+    fake_s3 = start_fake_s3(BUCKET)
+    try:
+        with app.app_context():
+            if not is_seeded(db, counts):
+                seed(db, counts, args.seed)
+
+        rng = Random(args.seed)
+        scenarios = build_scenarios(app, db, counts, rng)
+        results = {}
+        for name, (count, make_request) in scenarios.items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            count = min(count or args.requests, args.requests)
+            print(f"running {name} ({count} requests)...", file=sys.stderr)
+            results[name] = run_scenario(
+                app, make_request, count, args.concurrency,
+                min(args.warmup, count),
+            )
+        pruning = check_partition_pruning(app, db)
+        compressed = check_compression(app, db)
+        validation = check_validation()
+    finally:
+        fake_s3.stop()
+
+    report = {
+        "meta": {
+            "scale": args.scale,
+            "counts": counts,
+            "database": args.database_url.split(":", 1)[0],
+            "concurrency": args.concurrency,
+            "response_cache_ttl": args.response_cache_ttl,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": datetime.utcnow().isoformat(),
+        },
+        "results": results,
+        "compression": compressed,
+        "validation": validation,
+    }
+    if pruning is not None:
+        report["partition_pruning"] = pruning
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results",
+        f"{args.scale}-{datetime.utcnow():%Y%m%dT%H%M%S}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print(f"\n{'scenario':<28}{'rps':>10}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, result in results.items():
+        print(f"{name:<28}{result['throughput_rps']:>10.1f}"
+              f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{result['errors']:>8}")
+    if pruning is not None:
+        print(f"\nmessage partitions read (mean/max, of "
+              f"{pruning['partitions']})")
+        for name, counts in pruning.items():
+            if name != "partitions":
+                print(f"{name:<28}{counts['mean_partitions_read']:.1f}"
+                      f"/{counts['max_partitions_read']}")
+    for name, sample in compressed.items():
+        print(f"\n{name} response, {sample['bytes']} bytes")
+        print(f"{'encoding':<28}{'bytes':>10}{'ratio':>10}"
+              f"{'comp ms':>10}{'decomp ms':>10}")
+        for encoding, result in sample.items():
+            if encoding == "bytes":
+                continue
+            print(f"{encoding:<28}{result['bytes']:>10}"
+                  f"{result['ratio']:>10.1f}{result['compress_ms']:>10.3f}"
+                  f"{result['decompress_ms']:>10.3f}")
+    print(f"\n{'schema':<28}{'validate us':>12}")
+    for name, result in validation.items():
+        print(f"{name:<28}{result['validate_us']:>12.2f}")
+    print(f"\nresults written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print()
+        for key in mismatched_meta(report, baseline):
+            print(f"warning: {key} differs from the baseline run")
+        if print_comparison(compare(report, baseline, args.threshold)):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""Compare WSGI and ASGI serving side by side: requests per worker at rising
+client concurrency.
+
+Starts the app on a real socket with one worker at a time,
+
+    wsgi    gunicorn, one sync worker (how the app is deployed today)
+    asgi    uvicorn serving asgi.py, one worker with ASGI_THREADS threads
+
+and drives it with N concurrent keep-alive clients for each N in
+--concurrency, reporting throughput and p50/p95 latency:
+
+    pip3 install -r requirements-asgi.txt gunicorn
+    python benchmarks/serving.py --scale 10k --scenario login
+    python benchmarks/serving.py --database-url postgresql:///sharebnb_bench \\
+        --scenario listing_show --concurrency 1 16 64
+
+A sync worker's throughput stays flat as clients are added (they queue);
+the ASGI worker's grows for as long as requests spend their time waiting
+on something that releases the GIL (bcrypt in `login`, Postgres in the
+read scenarios) and there are cores or I/O to overlap. With SQLite, which
+runs in-process, or on a single core, there is nothing to overlap and the
+ASGI worker is slightly slower. Each server is driven once GET /ready
+reports it warmed up (see warmup.py). The database is seeded as in run.py;
+S3 isn't involved.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from random import Random
+
+import requests
+
+from run import (
+    ROOT, SCALES, is_seeded, percentile, scale_counts, seed,
+)
+
+SERVERS = {
+    "wsgi": ["gunicorn", "--workers", "1", "--bind", "127.0.0.1:{port}",
+             "app:app"],
+    "asgi": ["uvicorn", "--workers", "1", "--host", "127.0.0.1",
+             "--port", "{port}", "--no-access-log", "asgi:application"],
+}
+STARTUP_TIMEOUT = 60
+
+
+def build_requests(app, db, counts, scenario, rng):
+    """ A factory returning (method, path, kwargs) for `scenario`. """
+
+    from flask_jwt_extended import create_access_token
+    from models import User
+
+    with app.app_context():
+        users = [
+            username for (username,) in
+            db.session.query(User.username).limit(1000)
+        ]
+        token = create_access_token(identity=User.query.get(users[0]))
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def login():
+        return ("POST", "/login", {"json": {"user": {
+            "username": rng.choice(users),
+            "password": "password",
+        }}})
+
+    def listing_show():
+        listing_id = rng.randint(1, counts["listings"])
+        return ("GET", f"/listings/{listing_id}", {"headers": headers})
+
+    def listings_max_price():
+        max_price = rng.randrange(200, 400)
+        return ("GET", f"/listings?max_price={max_price}&fields=id,title",
+                {"headers": headers})
+
+    return {
+        "login": login,
+        "listing_show": listing_show,
+        "listings_max_price": listings_max_price,
+    }[scenario]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(mode, port, env):
+    command = [part.format(port=port) for part in SERVERS[mode]]
+    process = subprocess.Popen(
+        [sys.executable, "-m"] + command, cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"{command[0]} exited with {process.returncode}"
+            )
+        try:
+            response = requests.get(f"http://127.0.0.1:{port}/ready",
+                                    timeout=1)
+            if response.status_code == 200:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{command[0]} didn't start")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def drive(base_url, make_request, count, concurrency):
+    """ Send `count` requests from `concurrency` clients and time them. """
+
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    remaining = [count]
+
+    def client():
+        session = requests.Session()
+        local = []
+        local_errors = 0
+        while True:
+            with lock:
+                if not remaining[0]:
+                    break
+                remaining[0] -= 1
+                method, path, kwargs = make_request()
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, **kwargs)
+                failed = response.status_code >= 400
+            except requests.RequestException:
+                failed = True
+            local.append(time.perf_counter() - started)
+            local_errors += failed
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default="10k")
+    parser.add_argument(
+        '--database-url',
+        default=os.environ.get(
+            "BENCH_DATABASE_URL", "sqlite:////tmp/sharebnb-bench.db"
+        ),
+    )
+    parser.add_argument('--scenario', default="login",
+                        choices=["login", "listing_show",
+                                 "listings_max_price"])
+    parser.add_argument('--concurrency', type=int, nargs="+",
+                        default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per concurrency level")
+    parser.add_argument('--threads', type=int, default=32,
+                        help="ASGI_THREADS for the asgi worker")
+    parser.add_argument('--modes', nargs="+", choices=sorted(SERVERS),
+                        default=["wsgi", "asgi"])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="where to write the results JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["RATE_LIMITS_ENABLED"] = "0"
+
+    from app import app, db
+
+    counts = scale_counts(SCALES[args.scale])
+    with app.app_context():
+        if not is_seeded(db, counts):
+            seed(db, counts, args.seed)
+    make_request = build_requests(
+        app, db, counts, args.scenario, Random(args.seed)
+    )
+
+    env = dict(os.environ, ASGI_THREADS=str(args.threads))
+    results = {}
+    for mode in args.modes:
+        port = free_port()
+        print(f"starting {mode} on port {port}...", file=sys.stderr)
+        process = start_server(mode, port, env)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            drive(base_url, make_request, min(args.requests, 10), 1)
+            results[mode] = {}
+            for concurrency in args.concurrency:
+                print(f"  {concurrency} clients...", file=sys.stderr)
+                results[mode][concurrency] = drive(
+                    base_url, make_request, args.requests, concurrency
+                )
+        finally:
+            stop_server(process)
+
+    print(f"\n{args.scenario}, one worker"
+          f" (asgi: {args.threads} threads)")
+    print(f"{'mode':<8}{'clients':>8}{'rps':>10}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'errors':>8}")
+    for mode, levels in results.items():
+        for concurrency, result in levels.items():
+            print(f"{mode:<8}{concurrency:>8}"
+                  f"{result['throughput_rps']:>10.1f}"
+                  f"{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+                  f"{result['errors']:>8}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "scenario": args.scenario,
+                "scale": args.scale,
+                "database": args.database_url.split(":", 1)[0],
+                "asgi_threads": args.threads,
+                "results": results,
+            }, output_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
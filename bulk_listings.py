@@ -0,0 +1,239 @@
+"""Bulk import and streaming export of listings.
+
+Import reads a CSV or NDJSON request body line by line, validates rows in
+batches with the same LISTING_CREATE schema single creates use, and inserts
+each batch with one multi-row INSERT. Core inserts skip the ORM events that
+keep the area statistics, the change log and the outbox current, so each
+batch is counted into the statistics and logged directly.
+Everything happens in one transaction that the caller commits.
+
+Export streams listings out of a server-side cursor, so the full result set
+is never held in memory.
+"""
+
+import csv
+import io
+import json
+
+from models import (
+    db, ChangeLog, OutboxEvent, User, Listing, DEFAULT_LOCATION_IMAGE
+)
+from schemas import LISTING_CREATE
+from stats import record_listings
+
+BULK_BATCH_SIZE = 500
+MAX_BULK_ROWS = 10000
+EXPORT_CHUNK_SIZE = 1000
+
+CSV_MIMETYPES = {"text/csv", "application/csv"}
+NDJSON_MIMETYPES = {"application/x-ndjson", "application/ndjson"}
+
+EXPORT_COLUMNS = [
+    "id",
+    "title",
+    "description",
+    "photo",
+    "price",
+    "longitude",
+    "latitude",
+    "beds",
+    "rooms",
+    "bathrooms",
+    "created_by",
+    "rented_by",
+]
+
+
+class BulkImportError(Exception):
+    """ Raised when the body as a whole can't be imported. """
+
+
+def iter_rows(stream, mimetype):
+    """ Yield (row_number, row) pairs from a CSV or NDJSON byte stream.
+
+        `row` is a dict of the row's fields, or None when the line couldn't
+        be parsed. Row numbers start at 1 and don't count the CSV header.
+    """
+
+    lines = (line.decode("utf-8") for line in stream)
+
+    if mimetype in CSV_MIMETYPES:
+        for row_number, row in enumerate(csv.DictReader(lines), start=1):
+            yield row_number, row
+
+    elif mimetype in NDJSON_MIMETYPES:
+        row_number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            row_number += 1
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield row_number, row if isinstance(row, dict) else None
+
+    else:
+        raise BulkImportError(
+            "Content-Type must be text/csv or application/x-ndjson"
+        )
+
+
+def validate_batch(batch):
+    """ Validate a batch of (row_number, row) pairs.
+
+        Returns (values, errors): column values for each valid row, and
+        { row, errors } for each invalid one. Unknown `created_by` users are
+        caught with one query for the whole batch rather than by a foreign
+        key failure halfway through the insert.
+    """
+
+    values = []
+    errors = []
+    for row_number, row in batch:
+        if row is None:
+            errors.append({"row": row_number, "errors": ["Malformed row"]})
+            continue
+
+        row_values, row_errors = LISTING_CREATE.validate(row)
+        if row_errors:
+            errors.append({"row": row_number, "errors": row_errors})
+            continue
+
+        row_values = Listing.values_from_input(row_values)
+        row_values["description"] = row_values["description"] or ""
+        row_values["photo"] = row_values["photo"] or DEFAULT_LOCATION_IMAGE
+        values.append((row_number, row_values))
+
+    usernames = {row_values["created_by"] for _, row_values in values}
+    known = {
+        username for (username,) in
+        db.session.query(User.username).filter(User.username.in_(usernames))
+    } if usernames else set()
+
+    valid = []
+    for row_number, row_values in values:
+        if row_values["created_by"] in known:
+            valid.append(row_values)
+        else:
+            errors.append({
+                "row": row_number,
+                "errors": [f"Unknown user: {row_values['created_by']}"],
+            })
+
+    return valid, errors
+
+
+def insert_listings(rows):
+    """ Insert listing rows and return their new ids, in order.
+
+        Uses a single multi-row INSERT ... RETURNING where the database
+        supports it, falling back to one INSERT per row elsewhere (SQLite).
+    """
+
+    if not rows:
+        return []
+
+    table = Listing.__table__
+    connection = db.session.connection()
+
+    if connection.dialect.implicit_returning:
+        result = connection.execute(
+            table.insert().values(rows).returning(table.c.id)
+        )
+        return [listing_id for (listing_id,) in result]
+
+    return [
+        connection.execute(table.insert(), row).inserted_primary_key[0]
+        for row in rows
+    ]
+
+
+def import_listings(stream, mimetype):
+    """ Validate and insert every row in `stream`.
+
+        Returns (ids, errors). Nothing is committed here; the caller commits
+        (or rolls back) the single transaction all batches were inserted in.
+    """
+
+    ids = []
+    errors = []
+    batch = []
+
+    def flush(batch):
+        valid, batch_errors = validate_batch(batch)
+        errors.extend(batch_errors)
+        batch_ids = insert_listings(valid)
+        ids.extend(batch_ids)
+        record_listings(valid)
+        ChangeLog.record(db.session.connection(), "listing", [
+            {"object_id": listing_id} for listing_id in batch_ids
+        ])
+        OutboxEvent.record(db.session.connection(), "listing.created", [
+            {"aggregate_id": listing_id, "payload": {**row, "id": listing_id}}
+            for row, listing_id in zip(valid, batch_ids)
+        ])
+
+    for row_number, row in iter_rows(stream, mimetype):
+        if row_number > MAX_BULK_ROWS:
+            raise BulkImportError(
+                f"Too many rows; send at most {MAX_BULK_ROWS} per request"
+            )
+        batch.append((row_number, row))
+        if len(batch) >= BULK_BATCH_SIZE:
+            flush(batch)
+            batch = []
+
+    if batch:
+        flush(batch)
+
+    errors.sort(key=lambda error: error["row"])
+    return ids, errors
+
+
+def _export_record(row):
+    """ Turn a listing row into a JSON/CSV-friendly dict. """
+
+    record = dict(zip(EXPORT_COLUMNS, row))
+    record["price"] = float(record["price"])
+    return record
+
+
+def export_listings(search_params, fmt):
+    """ Yield chunks of listings matching `search_params` as CSV or NDJSON.
+
+        Rows come off a server-side cursor in EXPORT_CHUNK_SIZE pieces and
+        each chunk is encoded and yielded before the next is fetched.
+    """
+
+    columns = [getattr(Listing, column) for column in EXPORT_COLUMNS]
+    rows = (
+        Listing.search_query(search_params)
+        .with_entities(*columns)
+        .order_by(Listing.id)
+        .yield_per(EXPORT_CHUNK_SIZE)
+    )
+
+    buf = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+
+    count = 0
+    for row in rows:
+        record = _export_record(row)
+        if writer:
+            writer.writerow(record)
+        else:
+            buf.write(json.dumps(record))
+            buf.write("\n")
+
+        count += 1
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,196 @@
+"""In-process cache of whole GET responses, compressed variants included.
+
+A view decorated with `@cached(*kinds)` has its 200 responses kept for
+RESPONSE_CACHE_TTL seconds, keyed by path and query string; the view (and
+its queries and serialization) only runs on a miss. Each entry also keeps
+the body compressed in every encoding clients have asked for, so a hot
+response is compressed once, not on every hit.
+
+Entries are dropped, in this worker, as soon as a commit writes any of the
+models named by `kinds` (or `invalidate(kind)` is called for writes that
+bypass the ORM). Other workers' entries age out after the TTL, so that is
+the longest a response can be stale. RESPONSE_CACHE_TTL = 0 (the default)
+disables the cache.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from compression import add_vary, compress, is_compressible, negotiate
+from metrics import registry, timed
+from models import db, Listing, ListingPhoto, Message, User
+
+registry.register(
+    "sharebnb_response_cache_total", "counter",
+    "Cacheable requests, by route and result (hit or miss).",
+)
+
+
+class CacheEntry:
+    """ A response body plus its compressed variants, by encoding. """
+
+    def __init__(self, body, content_type, expires):
+        self.body = body
+        self.content_type = content_type
+        self.expires = expires
+        self.variants = {}
+
+    def encoded(self, encoding, level):
+        """ The body compressed with `encoding`, compressing it only the
+            first time. (Two requests racing here both compress; the bytes
+            are the same.)
+        """
+
+        variant = self.variants.get(encoding)
+        if variant is None:
+            with timed("compress"):
+                variant = compress(self.body, encoding, level)
+            self.variants[encoding] = variant
+        return variant
+
+
+class ResponseCache:
+    """ Thread-safe LRU of CacheEntry, with per-kind generations. """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # kind -> counter bumped on every write to that kind; part of the
+        # key, so a write makes every older entry unreachable.
+        self._generations = {}
+
+    def key(self, kinds, *parts):
+        with self._lock:
+            generations = tuple(self._generations.get(kind, 0)
+                                for kind in kinds)
+        return (generations,) + parts
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kind):
+        with self._lock:
+            self._generations[kind] = self._generations.get(kind, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _response_cache():
+    return current_app.extensions["response_cache"]
+
+
+def invalidate(kind):
+    """ Forget this worker's cached responses that depend on `kind`. """
+
+    _response_cache().invalidate(kind)
+
+
+def _respond(entry):
+    app = current_app
+    response = app.response_class(entry.body,
+                                  content_type=entry.content_type)
+    if not is_compressible(response):
+        return response
+
+    add_vary(response)
+    if len(entry.body) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    encoding = negotiate()
+    if encoding is not None:
+        response.set_data(
+            entry.encoded(encoding, app.config["COMPRESS_LEVELS"][encoding])
+        )
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def cached(*kinds):
+    """ Cache the view's 200 responses until one of `kinds` (model kinds,
+        e.g. "listing") is written, or RESPONSE_CACHE_TTL passes.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            ttl = current_app.config["RESPONSE_CACHE_TTL"]
+            if not ttl:
+                return view(*args, **kwargs)
+
+            route = (("route", request.url_rule.rule),)
+            cache = _response_cache()
+            key = cache.key(kinds, request.path,
+                            request.query_string.decode("latin-1"))
+            entry = cache.get(key)
+            if entry is not None:
+                registry.inc("sharebnb_response_cache_total",
+                             route + (("result", "hit"),))
+                return _respond(entry)
+
+            registry.inc("sharebnb_response_cache_total",
+                         route + (("result", "miss"),))
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            entry = CacheEntry(response.get_data(), response.content_type,
+                               time.monotonic() + ttl)
+            cache.put(key, entry)
+            return _respond(entry)
+        return wrapper
+    return decorator
+
+
+def _listen(model, kind):
+    """ Invalidate `kind` after any commit that wrote a `model`. """
+
+    def written(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault("cache_kinds", set()).add(kind)
+
+    for name in ("after_insert", "after_update", "after_delete"):
+        event.listen(model, name, written)
+
+
+def init_cache(app):
+    """ Set up the response cache and its invalidation on commit. """
+
+    cache = ResponseCache(app.config["RESPONSE_CACHE_SIZE"])
+    app.extensions["response_cache"] = cache
+
+    _listen(Listing, "listing")
+    _listen(ListingPhoto, "listing")
+    _listen(Message, "message")
+    _listen(User, "user")
+
+    @event.listens_for(db.session, "after_commit")
+    def after_commit(session):
+        for kind in session.info.pop("cache_kinds", ()):
+            cache.invalidate(kind)
+
+    @event.listens_for(db.session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("cache_kinds", None)
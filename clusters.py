@@ -0,0 +1,186 @@
+"""Map clusters: listings aggregated per grid cell for zoomed-out maps.
+
+Every listing stores the quadkey of its coordinates at GEO_CELL_LEVEL in
+`geo_cell` (see geo.py), so the first n characters name its cell on level
+n. A map at zoom z is clustered on level z + CLUSTER_LEVEL_OFFSET (cells of
+about 64px) with one grouped query:
+
+    SELECT substr(geo_cell, 1, level), count(*), avg(latitude), ...
+    WHERE geo_cell in a few prefix ranges covering the box
+    GROUP BY 1
+
+The prefix ranges are index range scans on geo_cell, and the response has
+at most one cluster per cell on screen, however many listings there are.
+
+Listings created through the API get their geo_cell when written; after
+loading rows any other way (seed.py, COPY), fill it in with
+
+    python clusters.py
+"""
+
+from flask import jsonify, request
+from flask_jwt_extended import jwt_required
+
+from geo import covering_quadkeys, quadkey_range, tile_range, MAX_LATITUDE
+from models import db, Listing, GEO_CELL_LEVEL
+
+CLUSTER_LEVEL_OFFSET = 2
+MAX_ZOOM = GEO_CELL_LEVEL - CLUSTER_LEVEL_OFFSET
+# Largest grid (in cells) one request may cluster over.
+MAX_CLUSTER_CELLS = 4096
+# Most geo_cell prefix ranges the query filters on.
+MAX_PREFIX_RANGES = 16
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _cell_count(bbox, level):
+    min_x, min_y, max_x, max_y = tile_range(*bbox, level)
+    return (max_x - min_x + 1) * (max_y - min_y + 1)
+
+
+def _prefix_filter(bbox, level):
+    """ Filter on geo_cell to the cells covering `bbox`, using the finest
+        level at or above `level` that needs at most MAX_PREFIX_RANGES
+        ranges.
+    """
+
+    while level > 1 and _cell_count(bbox, level) > MAX_PREFIX_RANGES:
+        level -= 1
+    ranges = [quadkey_range(key) for key in covering_quadkeys(*bbox, level)]
+    return db.or_(*(
+        db.and_(Listing.geo_cell >= low, Listing.geo_cell < high)
+        for low, high in ranges
+    ))
+
+
+def clusters(bbox, zoom):
+    """ Clusters of live listings inside `bbox` (south, west, north, east)
+        for a map at `zoom`.
+    """
+
+    south, west, north, east = bbox
+    level = zoom + CLUSTER_LEVEL_OFFSET
+    cell = db.func.substr(Listing.geo_cell, 1, level)
+
+    rows = db.session.query(
+        cell,
+        db.func.count(Listing.id),
+        db.func.avg(Listing.latitude),
+        db.func.avg(Listing.longitude),
+        db.func.min(Listing.price),
+    ).filter(
+        Listing.deleted_at.is_(None),
+        _prefix_filter(bbox, level),
+        Listing.latitude.between(south, north),
+        Listing.longitude.between(west, east),
+    ).group_by(cell)
+
+    return [
+        {
+            "cell": key,
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+            "count": count,
+            "min_price": float(min_price),
+        }
+        for key, count, latitude, longitude, min_price in rows
+    ]
+
+
+def parse_bbox(value):
+    """ (south, west, north, east) from "south,west,north,east", or None if
+        it isn't a valid box.
+    """
+
+    try:
+        south, west, north, east = (float(part) for part in value.split(","))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= south < north <= 90 and -180 <= west < east <= 180):
+        return None
+    return (max(south, -MAX_LATITUDE), west, min(north, MAX_LATITUDE), east)
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """ Set geo_cell on up to `batch_size` listings missing it. Returns
+        how many were set; nothing is committed.
+    """
+
+    rows = db.session.query(
+        Listing.id, Listing.latitude, Listing.longitude
+    ).filter(Listing.geo_cell.is_(None)).limit(batch_size).all()
+    if rows:
+        db.session.bulk_update_mappings(Listing, [
+            {
+                "id": listing_id,
+                "geo_cell": Listing.geo_cell_for(latitude, longitude),
+            }
+            for listing_id, latitude, longitude in rows
+        ])
+    return len(rows)
+
+
+def backfill_all(batch_size=BACKFILL_BATCH_SIZE):
+    """ Set geo_cell on every listing missing it, committing each batch. """
+
+    total = 0
+    while True:
+        count = backfill(batch_size)
+        db.session.commit()
+        total += count
+        if count < batch_size:
+            return total
+
+
+def init_clusters(app):
+    """ Add the map clusters route. """
+
+    @app.route("/listings/clusters")
+    @jwt_required
+    def listing_clusters():
+        """ Listings grouped into map clusters.
+            Query parameters:
+                bbox: south,west,north,east in degrees
+                zoom: map zoom level, 0 to MAX_ZOOM
+            Returns => {
+                    level,
+                    clusters: [{
+                        cell,
+                        latitude,
+                        longitude,
+                        count,
+                        min_price,
+                        }, ...]
+                    }
+            Auth required: user logged in
+        """
+
+        errors = []
+        bbox = parse_bbox(request.args.get("bbox"))
+        if bbox is None:
+            errors.append("bbox must be south,west,north,east with "
+                          "south < north and west < east")
+        try:
+            zoom = int(request.args.get("zoom", ""))
+        except ValueError:
+            zoom = -1
+        if not 0 <= zoom <= MAX_ZOOM:
+            errors.append(f"zoom must be between 0 and {MAX_ZOOM}")
+        if errors:
+            return (jsonify(errors=errors), 400)
+
+        level = zoom + CLUSTER_LEVEL_OFFSET
+        if _cell_count(bbox, level) > MAX_CLUSTER_CELLS:
+            errors = ["bbox is too large for this zoom"]
+            return (jsonify(errors=errors), 400)
+
+        return (jsonify(level=level, clusters=clusters(bbox, zoom)), 200)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        total = backfill_all()
+    print(f"Set geo_cell on {total} listings")
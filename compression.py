@@ -0,0 +1,117 @@
+"""Negotiated response compression.
+
+JSON and text responses of at least COMPRESS_MIN_SIZE bytes are compressed
+with the best encoding the client accepts (Accept-Encoding), in order of
+preference:
+
+    br      brotli, if the `brotli` package is installed
+    zstd    Zstandard, if the `zstandard` package is installed
+    gzip    always available
+
+Both optional packages are pinned in requirements-compression.txt:
+
+    pip3 install -r requirements-compression.txt
+
+Each encoding's level is configurable (COMPRESS_LEVELS); higher levels
+trade CPU per response for fewer bytes on the wire, see
+`python benchmarks/run.py` for the numbers on real responses.
+
+Responses that are streamed, already encoded, or come from the response
+cache (which keeps its compressed variants with the entry, see cache.py)
+are left alone.
+"""
+
+import gzip
+
+from flask import request
+
+from metrics import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {"br": 4, "zstd": 3, "gzip": 6}
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain", "text/html")
+
+
+def _gzip(data, level):
+    # mtime=0 keeps the output the same for the same input.
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=level)
+
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# Most preferred first.
+ENCODERS = {}
+if brotli is not None:
+    ENCODERS["br"] = _brotli
+if zstandard is not None:
+    ENCODERS["zstd"] = _zstd
+ENCODERS["gzip"] = _gzip
+
+
+def compress(data, encoding, level=None):
+    """ `data` compressed with `encoding` at `level` (default: its
+        DEFAULT_LEVELS level).
+    """
+
+    if level is None:
+        level = DEFAULT_LEVELS[encoding]
+    return ENCODERS[encoding](data, level)
+
+
+def negotiate():
+    """ The encoding to use for this request's response, or None. """
+
+    return request.accept_encodings.best_match(list(ENCODERS))
+
+
+def is_compressible(response):
+    return response.mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def add_vary(response):
+    response.vary.add("Accept-Encoding")
+
+
+def _compress_response(app, response):
+    if (response.direct_passthrough
+            or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or not is_compressible(response)):
+        return response
+
+    add_vary(response)
+    data = response.get_data()
+    if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    level = app.config["COMPRESS_LEVELS"][encoding]
+    with timed("compress"):
+        body = compress(data, encoding, level)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """ Compress responses to clients that accept it. """
+
+    app.after_request(lambda response: _compress_response(app, response))
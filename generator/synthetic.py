@@ -0,0 +1,395 @@
+"""Generate large, deterministic datasets of ShareBnb data for load testing.
+
+Unlike create_csvs.py this never touches the network: every row is derived
+from a seeded RNG and a few small word pools built once from Faker, so the
+same seed always produces the same dataset. Rows are generated lazily and
+written in fixed-size batches, so memory stays flat whether you ask for a
+thousand rows or ten million.
+
+Rows can be streamed to CSV files (same format as create_csvs.py, so
+seed.py can load them):
+
+    python generator/synthetic.py --users 1000000 --listings 1000000 \\
+        --messages 5000000 --out /tmp/sharebnb-1m
+
+or straight into Postgres with COPY (tables must already exist, e.g. from
+a previous `python seed.py`):
+
+    python generator/synthetic.py --users 100000 --listings 100000 \\
+        --messages 500000 --copy --truncate
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from random import Random
+
+from faker import Faker
+
+USERS_CSV_HEADERS = [
+    'username',
+    'bio',
+    'first_name',
+    'last_name',
+    'email',
+    'password',
+    'image_url',
+    'location'
+    ]
+LISTINGS_CSV_HEADERS = [
+    'title',
+    'description',
+    'photo',
+    'price',
+    'longitude',
+    'latitude',
+    'beds',
+    'rooms',
+    'bathrooms',
+    'created_by'
+    ]
+MESSAGES_CSV_HEADERS = [
+    'body',
+    'sent_at',
+    'to_user',
+    'from_user',
+    'listing_id'
+    ]
+
+# password hash is for "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+PROFILE_IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+# A handful of the splashbase images create_csvs.py used to fetch, so the
+# generator can run without network access.
+LOCATION_IMAGE_URLS = [
+    "https://splashbase.s3.amazonaws.com/unsplash/regular/"
+    f"tumblr_{name}_1280.jpg"
+    for name in [
+        "mnh0n9pHJW1st5lhmo1",
+        "mnh0uemhCk1st5lhmo1",
+        "mnh121HEWa1st5lhmo1",
+        "mnh17lfd9R1st5lhmo1",
+        "mnh1d7s3UD1st5lhmo1",
+        "mnh1jdFvHR1st5lhmo1",
+        "mnh1uhYnog1st5lhmo1",
+        "mnh25vNOvI1st5lhmo1",
+        "mnh2m1hnS81st5lhmo1",
+        "mo1h6tGOZf1st5lhmo1",
+        "mo2wz2LTCs1st5lhmo1",
+        "mo2x3aAnRH1st5lhmo1",
+    ]
+]
+
+# a random number of beds, rooms, and bathrooms to use for listings
+TOTAL_IN_HOME = [1, 2, 3, 4, 5, 6]
+
+POOL_SIZE = 500
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_END_DATE = "2021-02-01"
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _mix(value, salt):
+    """ Deterministically hash an integer (splitmix64).
+
+        Used to derive per-row choices (usernames, listing owners) from a
+        row index alone, so nothing has to be remembered between tables.
+    """
+
+    z = (value + salt * 0x9E3779B97F4A7C15) & _MASK_64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return z ^ (z >> 31)
+
+
+class Pools:
+    """ Small word pools every generated row draws from.
+
+        Building these is the only place Faker runs; per-row generation is
+        plain list indexing, which is what keeps millions of rows cheap.
+    """
+
+    def __init__(self, seed):
+        Faker.seed(seed)
+        fake = Faker()
+        self.seed = seed
+        self.first_names = [fake.first_name() for _ in range(POOL_SIZE)]
+        self.last_names = [fake.last_name() for _ in range(POOL_SIZE)]
+        self.cities = [fake.city() for _ in range(POOL_SIZE)]
+        self.words = sorted({fake.word() for _ in range(POOL_SIZE * 4)})
+        self.locations = [
+            (float(lat), float(lng))
+            for lat, lng, *_ in
+            (fake.location_on_land() for _ in range(POOL_SIZE))
+        ]
+
+    def username(self, idx):
+        """ Username of the user at row `idx` (0-based). """
+
+        first = self.first_names[_mix(idx, self.seed) % POOL_SIZE]
+        last = self.last_names[_mix(idx, self.seed + 1) % POOL_SIZE]
+        return f"{first}{last}{idx}".lower()
+
+    def sentence(self, rng, min_words=4, max_words=10):
+        """ Random sentence built from the word pool. """
+
+        words = [
+            rng.choice(self.words)
+            for _ in range(rng.randint(min_words, max_words))
+        ]
+        return " ".join(words).capitalize() + "."
+
+
+def listing_owner(pools, listing_idx, num_users):
+    """ Index of the user that created the listing at row `listing_idx`. """
+
+    return _mix(listing_idx, pools.seed + 2) % num_users
+
+
+def iter_users(pools, num_users):
+    """ Yield user rows in USERS_CSV_HEADERS order. """
+
+    rng = Random(pools.seed)
+    for idx in range(num_users):
+        username = pools.username(idx)
+        yield (
+            username,
+            pools.sentence(rng),
+            rng.choice(pools.first_names),
+            rng.choice(pools.last_names),
+            f"{username}@example.com",
+            PASSWORD_HASH,
+            rng.choice(PROFILE_IMAGE_URLS),
+            rng.choice(pools.cities),
+        )
+
+
+def iter_listings(pools, num_listings, num_users):
+    """ Yield listing rows in LISTINGS_CSV_HEADERS order.
+
+        Listings are expected to be inserted into an empty table whose id
+        sequence starts at 1 (generate restarts it), so the listing at row
+        `idx` gets id `idx + 1`.
+    """
+
+    rng = Random(pools.seed + 1)
+    for idx in range(num_listings):
+        lat, lng = rng.choice(pools.locations)
+        yield (
+            pools.sentence(rng),
+            " ".join(pools.sentence(rng) for _ in range(rng.randint(1, 3))),
+            rng.choice(LOCATION_IMAGE_URLS),
+            round(rng.uniform(150, 2000), 2),
+            round(lng + rng.uniform(-0.05, 0.05), 5),
+            round(lat + rng.uniform(-0.05, 0.05), 5),
+            rng.choice(TOTAL_IN_HOME),
+            rng.choice(TOTAL_IN_HOME),
+            rng.choice(TOTAL_IN_HOME),
+            pools.username(listing_owner(pools, idx, num_users)),
+        )
+
+
+def iter_messages(pools, num_messages, num_listings, num_users, end_date,
+                  year_gap=2):
+    """ Yield message rows in MESSAGES_CSV_HEADERS order.
+
+        Each message is sent to the owner of a random listing by some other
+        user, at a random time within `year_gap` years before `end_date`.
+    """
+
+    rng = Random(pools.seed + 2)
+    span = timedelta(days=365 * year_gap).total_seconds()
+    for _ in range(num_messages):
+        listing_idx = rng.randrange(num_listings)
+        owner_idx = listing_owner(pools, listing_idx, num_users)
+        sender_idx = rng.randrange(num_users)
+        if sender_idx == owner_idx:
+            sender_idx = (sender_idx + 1) % num_users
+        sent_at = end_date - timedelta(seconds=rng.uniform(0, span))
+        yield (
+            pools.sentence(rng),
+            sent_at.isoformat(sep=" "),
+            pools.username(owner_idx),
+            pools.username(sender_idx),
+            listing_idx + 1,
+        )
+
+
+def batched(rows, batch_size):
+    """ Yield lists of at most `batch_size` rows. """
+
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class Progress:
+    """ Prints rows written / rows per second to stderr. """
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+
+    def update(self, count):
+        self.done += count
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        pct = 100.0 * self.done / self.total if self.total else 100.0
+        print(
+            f"\r{self.label}: {self.done}/{self.total} ({pct:5.1f}%) "
+            f"{self.done / elapsed:,.0f} rows/s",
+            end="",
+            file=sys.stderr,
+            flush=True,
+        )
+
+    def finish(self):
+        print(file=sys.stderr)
+
+
+def write_csv(path, headers, rows, total, batch_size):
+    """ Stream rows into a CSV file at `path`, one batch at a time. """
+
+    progress = Progress(os.path.basename(path), total)
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(headers)
+        for batch in batched(rows, batch_size):
+            writer.writerows(batch)
+            progress.update(len(batch))
+    progress.finish()
+
+
+def copy_rows(conn, table, headers, rows, total, batch_size):
+    """ Stream rows into `table` with COPY, committing once per batch. """
+
+    progress = Progress(table, total)
+    sql = (
+        f"COPY {table} ({', '.join(headers)}) "
+        "FROM STDIN WITH (FORMAT csv)"
+    )
+    with conn.cursor() as cursor:
+        for batch in batched(rows, batch_size):
+            buf = io.StringIO()
+            csv.writer(buf).writerows(batch)
+            buf.seek(0)
+            cursor.copy_expert(sql, buf)
+            conn.commit()
+            progress.update(len(batch))
+    progress.finish()
+
+
+def generate(args):
+    """ Generate users, listings and messages and write them out. """
+
+    pools = Pools(args.seed)
+    end_date = datetime.fromisoformat(args.end_date)
+    tables = [
+        ('users', USERS_CSV_HEADERS,
+         iter_users(pools, args.users), args.users),
+        ('listings', LISTINGS_CSV_HEADERS,
+         iter_listings(pools, args.listings, args.users), args.listings),
+        ('messages', MESSAGES_CSV_HEADERS,
+         iter_messages(pools, args.messages, args.listings, args.users,
+                       end_date),
+         args.messages),
+    ]
+
+    if not args.copy:
+        os.makedirs(args.out, exist_ok=True)
+        for table, headers, rows, total in tables:
+            path = os.path.join(args.out, f"{table}.csv")
+            write_csv(path, headers, rows, total, args.batch_size)
+        return
+
+    import psycopg2
+
+    conn = psycopg2.connect(args.database_url)
+    try:
+        with conn.cursor() as cursor:
+            if args.truncate:
+                cursor.execute(
+                    "TRUNCATE users, listings, messages "
+                    "RESTART IDENTITY CASCADE"
+                )
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM users) "
+                "OR EXISTS (SELECT 1 FROM listings)"
+            )
+            if cursor.fetchone()[0]:
+                sys.exit(
+                    "users/listings are not empty; "
+                    "rerun with --truncate to replace them"
+                )
+            # Messages refer to the listing at row idx as id idx + 1, but an
+            # empty table's id sequence may have moved on, so restart it.
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('listings', 'id'), "
+                "1, false)"
+            )
+        conn.commit()
+
+        for table, headers, rows, total in tables:
+            copy_rows(conn, table, headers, rows, total, args.batch_size)
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--listings', type=int, default=100)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        '--end-date',
+        default=DEFAULT_END_DATE,
+        help="messages are sent within two years before this date",
+    )
+    parser.add_argument(
+        '--out',
+        default='generator',
+        help="directory to write users.csv, listings.csv and messages.csv",
+    )
+    parser.add_argument(
+        '--copy',
+        action='store_true',
+        help="COPY rows into Postgres instead of writing CSVs",
+    )
+    parser.add_argument(
+        '--truncate',
+        action='store_true',
+        help="with --copy, empty the tables before loading",
+    )
+    parser.add_argument(
+        '--database-url',
+        default=os.environ.get('DATABASE_URL', 'postgres:///sharebnb'),
+    )
+
+    args = parser.parse_args(argv)
+    if args.users < 2 and args.messages:
+        parser.error("need at least two users to generate messages")
+    if args.listings < 1 and args.messages:
+        parser.error("need at least one listing to generate messages")
+    return args
+
+
+if __name__ == '__main__':
+    generate(parse_args())
@@ -0,0 +1,120 @@
+"""Geo cells for grouping listings by area.
+
+Cells are quadkeys of the Web Mercator tile grid: each character picks one
+of four quadrants, so a level-n quadkey is an n-character string and its
+prefixes are the enclosing cells at every coarser level. That makes one
+string usable as a multi-resolution cell id.
+"""
+
+import math
+
+MAX_LEVEL = 23
+MAX_LATITUDE = 85.05112878
+
+
+def _clip(value, lower, upper):
+    return min(max(value, lower), upper)
+
+
+def tile_for(latitude, longitude, level):
+    """ (x, y) of the level-`level` tile containing the point. """
+
+    latitude = _clip(latitude, -MAX_LATITUDE, MAX_LATITUDE)
+    longitude = _clip(longitude, -180.0, 180.0)
+
+    x = (longitude + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+
+    size = 1 << level
+    return (int(_clip(x * size, 0, size - 1)),
+            int(_clip(y * size, 0, size - 1)))
+
+
+def tile_quadkey(tile_x, tile_y, level):
+    """ Quadkey of the tile at (tile_x, tile_y) on level `level`. """
+
+    digits = []
+    for i in range(level, 0, -1):
+        mask = 1 << (i - 1)
+        digit = 0
+        if tile_x & mask:
+            digit += 1
+        if tile_y & mask:
+            digit += 2
+        digits.append(str(digit))
+    return "".join(digits)
+
+
+def quadkey(latitude, longitude, level):
+    """ Quadkey of the level-`level` tile containing the point. """
+
+    return tile_quadkey(*tile_for(latitude, longitude, level), level)
+
+
+def tile_range(south, west, north, east, level):
+    """ (min_x, min_y, max_x, max_y) of the level-`level` tiles that cover
+        a bounding box (west < east; boxes across the antimeridian aren't
+        supported).
+    """
+
+    min_x, min_y = tile_for(north, west, level)
+    max_x, max_y = tile_for(south, east, level)
+    return min_x, min_y, max_x, max_y
+
+
+def covering_quadkeys(south, west, north, east, level):
+    """ Quadkeys of the level-`level` tiles that cover a bounding box. """
+
+    min_x, min_y, max_x, max_y = tile_range(south, west, north, east, level)
+    return [
+        tile_quadkey(x, y, level)
+        for y in range(min_y, max_y + 1)
+        for x in range(min_x, max_x + 1)
+    ]
+
+
+def quadkey_range(key):
+    """ (low, high) such that a quadkey starts with `key` exactly when
+        low <= quadkey < high, for index range scans over a quadkey column.
+    """
+
+    return key, key[:-1] + chr(ord(key[-1]) + 1)
+
+
+def tile_xy(key):
+    """ (x, y, level) tile coordinates of a quadkey. """
+
+    x = y = 0
+    level = len(key)
+    for i, digit in enumerate(key):
+        mask = 1 << (level - i - 1)
+        if digit in "13":
+            x |= mask
+        if digit in "23":
+            y |= mask
+    return x, y, level
+
+
+def _tile_latitude(y, size):
+    n = math.pi - 2 * math.pi * y / size
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+def quadkey_bounds(key):
+    """ (south, west, north, east) of a quadkey's tile, in degrees. """
+
+    x, y, level = tile_xy(key)
+    size = 1 << level
+    west = x / size * 360.0 - 180.0
+    east = (x + 1) / size * 360.0 - 180.0
+    north = _tile_latitude(y, size)
+    south = _tile_latitude(y + 1, size)
+    return south, west, north, east
+
+
+def quadkey_center(key):
+    """ (latitude, longitude) of the middle of a quadkey's tile. """
+
+    south, west, north, east = quadkey_bounds(key)
+    return (south + north) / 2, (west + east) / 2
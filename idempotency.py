@@ -0,0 +1,214 @@
+"""Idempotency-Key support for endpoints that create things.
+
+A client that may retry a POST sends a unique `Idempotency-Key` header.
+The first request with a key claims it (a row with no response yet) before
+the view runs; once the view succeeds, its response is stored compressed
+against the key in the same transaction as the view's writes. Views under
+@idempotent therefore end with commit() from this module, which only
+flushes, and the decorator commits both together: a crash or failed commit
+leaves neither, and a retry after CLAIM_TIMEOUT runs the view afresh.
+Anything that must wait for the data to be committed (notifications, cache
+invalidation) is registered with after_commit.
+
+A retry with the same key, from the same user, to the same endpoint, with
+the same body then gets the stored response back after a single
+primary-key lookup, without the view or any model being touched.
+Replayed responses carry `Idempotent-Replayed: true`.
+
+    - a retry while the first request is still running gets 409
+    - the same key with a different body gets 422
+    - failed requests (non-2xx) release the key, so they can be retried
+
+Keys live for IDEMPOTENCY_TTL seconds; expired ones are ignored and purged
+in batches by reaper.py.
+"""
+
+import hashlib
+import zlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import current_app, g, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request_optional
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from image_store import content_hash
+from models import db, IdempotencyKey
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+# A claimed key whose request hasn't finished after this long is assumed
+# abandoned (e.g. the worker died) and may be claimed again.
+CLAIM_TIMEOUT = timedelta(seconds=60)
+
+
+def _identity():
+    try:
+        verify_jwt_in_request_optional()
+        return get_jwt_identity() or ""
+    except Exception:
+        return ""
+
+
+def _key_hash(key):
+    scope = "\n".join((_identity(), request.method, request.path, key))
+    return hashlib.sha256(scope.encode("utf-8")).digest()
+
+
+def _request_hash():
+    """ Digest of the request body.
+
+        Multipart bodies are hashed by their fields and the content hashes
+        of their files (already computed as the upload streamed in), so an
+        upload is never read twice.
+    """
+
+    sha256 = hashlib.sha256()
+    if request.mimetype in ("multipart/form-data",
+                            "application/x-www-form-urlencoded"):
+        for name, value in sorted(request.form.items(multi=True)):
+            sha256.update(f"{name}={value}\n".encode("utf-8"))
+        for name, file in sorted(request.files.items(multi=True),
+                                 key=lambda item: item[0]):
+            digest, _ = content_hash(file)
+            sha256.update(f"{name}:{file.filename}:{digest}\n".encode("utf-8"))
+    else:
+        sha256.update(request.get_data())
+    return sha256.digest()
+
+
+def _replay(stored):
+    response = current_app.response_class(
+        zlib.decompress(stored.body),
+        status=stored.status_code,
+        content_type=stored.content_type,
+    )
+    response.headers[REPLAYED_HEADER] = "true"
+    return response
+
+
+def _claim(key_hash, request_hash):
+    """ Claim the key for this request.
+
+        Returns None if the view should run, or the response to send
+        instead (a replay or an error).
+    """
+
+    now = datetime.utcnow()
+    ttl = timedelta(seconds=current_app.config["IDEMPOTENCY_TTL"])
+
+    stored = IdempotencyKey.query.get(key_hash)
+    if stored is not None:
+        abandoned = (stored.status_code is None
+                     and stored.created_at < now - CLAIM_TIMEOUT)
+        if stored.expires_at <= now or abandoned:
+            db.session.delete(stored)
+            db.session.commit()
+        elif stored.request_hash != request_hash:
+            errors = [f"{IDEMPOTENCY_HEADER} was already used for a "
+                      "different request"]
+            return (jsonify(errors=errors), 422)
+        elif stored.status_code is None:
+            errors = ["A request with this "
+                      f"{IDEMPOTENCY_HEADER} is still in progress"]
+            return (jsonify(errors=errors), 409)
+        else:
+            return _replay(stored)
+
+    db.session.add(IdempotencyKey(
+        key_hash=key_hash,
+        request_hash=request_hash,
+        created_at=now,
+        expires_at=now + ttl,
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request claimed the key first; answer as if it had
+        # been there when we looked.
+        db.session.rollback()
+        return _claim(key_hash, request_hash)
+    return None
+
+
+def commit():
+    """ Commit the view's writes; under @idempotent, flush them for the
+        decorator to commit along with the stored response.
+    """
+
+    if g.get("_idempotency_key_hash") is None:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+
+def after_commit(callback):
+    """ Call `callback()` once the current transaction commits; never if it
+        rolls back.
+    """
+
+    db.session.info.setdefault("after_commit", []).append(callback)
+
+
+@event.listens_for(db.session, "after_commit")
+def _run_after_commit(session):
+    for callback in session.info.pop("after_commit", ()):
+        callback()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_after_commit(session):
+    session.info.pop("after_commit", None)
+
+
+def _release(key_hash):
+    db.session.rollback()
+    IdempotencyKey.query.filter_by(key_hash=key_hash).delete()
+    db.session.commit()
+
+
+def idempotent(fn):
+    """ Honour an Idempotency-Key header on the wrapped view.
+
+        Apply it below @jwt_required, so the key is scoped to the caller.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return fn(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            errors = [f"{IDEMPOTENCY_HEADER} must be 1 to "
+                      f"{MAX_KEY_LENGTH} characters"]
+            return (jsonify(errors=errors), 400)
+
+        key_hash = _key_hash(key)
+        early = _claim(key_hash, _request_hash())
+        if early is not None:
+            return early
+
+        g._idempotency_key_hash = key_hash
+        try:
+            response = make_response(fn(*args, **kwargs))
+            if not 200 <= response.status_code < 300 or response.is_streamed:
+                _release(key_hash)
+                return response
+
+            stored = IdempotencyKey.query.get(key_hash)
+            if stored is not None:
+                stored.status_code = response.status_code
+                stored.content_type = response.content_type
+                stored.body = zlib.compress(response.get_data())
+            db.session.commit()
+        except Exception:
+            _release(key_hash)
+            raise
+        finally:
+            g.pop("_idempotency_key_hash", None)
+        return response
+
+    return wrapper
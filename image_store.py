@@ -0,0 +1,256 @@
+"""Content-addressed image storage with deduplication.
+
+Uploaded images are stored in S3 under images/<sha256 of the bytes>, so two
+users uploading `photo.jpg` no longer overwrite each other, and the same
+image uploaded twice is stored once.
+
+The hash is computed while Werkzeug spools the multipart upload to its
+temporary file (see HashingRequest), so by the time a view sees the file
+its digest is already known and nothing re-reads the bytes. A duplicate
+upload then only bumps the object's reference count in `stored_objects`;
+the S3 PUT is skipped entirely.
+
+Reference counting makes deletes safe. release_object only decrements the
+count, inside the caller's transaction, so a rollback leaves the object and
+everything pointing at it intact. Objects whose count reached zero are
+deleted from S3 later by purge_unreferenced (run by reaper.py), which locks
+each row and re-checks the count first, so a concurrent upload of the same
+bytes either revives the row before the purge or re-uploads after it.
+Direct-upload profile images are counted the same way, under their upload
+key (acquire_upload). Other objects that aren't reference counted (direct
+uploads to listing galleries) are deleted from S3 only once the
+transaction that dropped them commits.
+"""
+
+import hashlib
+
+from flask import Request
+from sqlalchemy import event
+from werkzeug.formparser import default_stream_factory
+
+from models import db, StoredObject
+from upload_functions import delete_object, upload_file_objs
+
+KEY_PREFIX = "images/"
+
+
+class HashingStream:
+    """ File-like wrapper that hashes everything written through it. """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._sha256.update(data)
+        self.size += len(data)
+        return self._stream.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+
+class HashingRequest(Request):
+    """ Request whose uploaded files are hashed as they are received. """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        return HashingStream(default_stream_factory(
+            total_content_length=total_content_length,
+            filename=filename,
+            content_type=content_type,
+            content_length=content_length,
+        ))
+
+
+def content_hash(file):
+    """ (sha256 hex digest, size) of an uploaded werkzeug FileStorage.
+
+        Uses the digest computed while the upload streamed in; only files
+        that didn't come through HashingRequest are read to hash them.
+    """
+
+    stream = file.stream
+    if isinstance(stream, HashingStream):
+        return stream.hexdigest(), stream.size
+
+    sha256 = hashlib.sha256()
+    size = 0
+    start = stream.tell()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        sha256.update(chunk)
+        size += len(chunk)
+    stream.seek(start)
+    return sha256.hexdigest(), size
+
+
+def acquire_object(sha256, size, content_type):
+    """ Take a reference to the object for these bytes.
+
+        Returns (key, is_new). When is_new, the caller must upload the
+        bytes before committing; otherwise they are already in S3.
+    """
+
+    return _acquire(KEY_PREFIX + sha256, sha256, size, content_type)
+
+
+def acquire_upload(key, size, content_type):
+    """ Take a reference to a direct upload already in S3 at `key`, so it
+        is released like any stored object. Returns `key`.
+    """
+
+    return _acquire(key, None, size, content_type)[0]
+
+
+def _acquire(key, sha256, size, content_type):
+    table = StoredObject.__table__
+    connection = db.session.connection()
+
+    if connection.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        statement = insert(table).values(
+            key=key,
+            sha256=sha256,
+            size=size,
+            content_type=content_type,
+            ref_count=1,
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={"ref_count": table.c.ref_count + 1},
+        ).returning(table.c.ref_count)
+        ref_count = connection.execute(statement).scalar()
+        return key, ref_count == 1
+
+    stored = StoredObject.query.filter_by(key=key).with_for_update().first()
+    if stored is None:
+        db.session.add(StoredObject(
+            key=key,
+            sha256=sha256,
+            size=size,
+            content_type=content_type,
+            ref_count=1,
+        ))
+        db.session.flush()
+        return key, True
+
+    # A row left at zero by release_object may already be gone from S3.
+    is_new = stored.ref_count <= 0
+    stored.ref_count += 1
+    db.session.flush()
+    return key, is_new
+
+
+def release_object(key):
+    """ Drop a reference to `key`. Once unreferenced, the object is left
+        for purge_unreferenced to delete after this transaction commits.
+    """
+
+    if not key:
+        return
+
+    stored = StoredObject.query.filter_by(key=key).with_for_update().first()
+    if stored is None:
+        return
+
+    stored.ref_count -= 1
+    db.session.flush()
+
+
+def release_key(key, bucket):
+    """ Let go of an S3 object a photo points at.
+
+        Content-addressed objects are reference counted; anything else
+        (direct uploads) belongs to that one photo and is deleted outright,
+        once the transaction commits.
+    """
+
+    if key.startswith(KEY_PREFIX):
+        release_object(key)
+    else:
+        delete_after_commit(key, bucket)
+
+
+def delete_after_commit(key, bucket):
+    """ Delete `key` from S3 if and when the current transaction commits. """
+
+    db.session.info.setdefault("s3_deletes", []).append((bucket, key))
+
+
+@event.listens_for(db.session, "after_commit")
+def _delete_committed(session):
+    for bucket, key in session.info.pop("s3_deletes", ()):
+        delete_object(bucket, key)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_deletes(session):
+    session.info.pop("s3_deletes", None)
+
+
+def purge_unreferenced(bucket, batch_size):
+    """ Delete up to `batch_size` objects nothing references any more from
+        S3 and stored_objects. Returns how many were deleted.
+
+        Each row stays locked while its object is deleted, so an upload of
+        the same bytes waits and then uploads afresh; if the S3 delete fails
+        the row is kept and tried again next time.
+    """
+
+    objects = StoredObject.query.filter(
+        StoredObject.ref_count <= 0
+    ).limit(batch_size).with_for_update(skip_locked=True).all()
+
+    deleted = 0
+    for stored in objects:
+        if delete_object(bucket, stored.key):
+            db.session.delete(stored)
+            deleted += 1
+    db.session.commit()
+    return deleted
+
+
+def store_images(files, bucket):
+    """ Store uploaded images, uploading only bytes S3 doesn't have yet.
+
+        New objects are uploaded in parallel. Returns a key per file, or
+        None where the upload failed. Nothing is committed here.
+    """
+
+    keys = []
+    uploads = []
+    for file in files:
+        sha256, size = content_hash(file)
+        key, is_new = acquire_object(sha256, size, file.mimetype)
+        keys.append(key)
+        if is_new:
+            uploads.append((file.stream, key, file.mimetype))
+
+    results = upload_file_objs(uploads, bucket)
+    failed = {
+        key for (_, key, _), uploaded in zip(uploads, results)
+        if not uploaded
+    }
+
+    # Nothing may point at an object whose upload failed: drop the
+    # references this call took (purge_unreferenced clears the rows).
+    for key in failed:
+        stored = StoredObject.query.get(key)
+        stored.ref_count -= keys.count(key)
+    db.session.flush()
+
+    return [None if key in failed else key for key in keys]
+
+
+def store_image(file, bucket):
+    """ Store one uploaded image; returns its key, or None on failure. """
+
+    return store_images([file], bucket)[0]
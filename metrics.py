@@ -0,0 +1,299 @@
+"""Request-level performance instrumentation.
+
+Each request records, per route:
+    - total latency
+    - number of SQL queries and time spent in the database
+    - time spent serializing (model -> dict and JSON encoding)
+    - time spent talking to S3
+    - time spent compressing responses
+
+SQL is measured with SQLAlchemy engine events, everything else with Flask
+before/after_request hooks and the `timed` context manager. Histograms live
+in-process (one registry per worker) and are exposed in the Prometheus text
+format at GET /metrics.
+
+If SLOW_REQUEST_MS is configured, requests slower than that are logged
+together with the SQL they ran, slowest statements first.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, json, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# How many statements a request keeps around for the slow-request log.
+MAX_RECORDED_STATEMENTS = 50
+
+
+class Histogram:
+    """ Cumulative-bucket histogram, as Prometheus expects. """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """ Thread-safe store of counters and histograms keyed by labels. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (type, help, buckets)
+        self._meta = {}
+        # name -> { labels tuple: Histogram or number }
+        self._series = {}
+
+    def register(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+        self._series.setdefault(name, {})
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            series = self._series[name]
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            series = self._series[name]
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = Histogram(self._meta[name][2])
+            histogram.observe(value)
+
+    def render(self):
+        """ Render every metric in the Prometheus text exposition format. """
+
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, _) in sorted(self._meta.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(self._series[name].items()):
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(value.buckets, value.counts):
+                        bucket_labels = labels + (("le", _number(bound)),)
+                        lines.append(
+                            f"{name}_bucket{_labels(bucket_labels)} {count}"
+                        )
+                    inf_labels = labels + (("le", "+Inf"),)
+                    lines.append(
+                        f"{name}_bucket{_labels(inf_labels)} {value.count}"
+                    )
+                    lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+                    lines.append(
+                        f"{name}_count{_labels(labels)} {value.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    return repr(float(value))
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = (f'{key}="{_escape(value)}"' for key, value in labels)
+    return "{" + ",".join(pairs) + "}"
+
+
+registry = Registry()
+registry.register(
+    "sharebnb_requests_total", "counter",
+    "Requests handled, by route, method and status.",
+)
+registry.register(
+    "sharebnb_request_duration_seconds", "histogram",
+    "Request latency by route.", LATENCY_BUCKETS,
+)
+registry.register(
+    "sharebnb_request_sql_queries", "histogram",
+    "SQL queries issued per request, by route.", QUERY_COUNT_BUCKETS,
+)
+registry.register(
+    "sharebnb_request_db_seconds", "histogram",
+    "Time spent executing SQL per request, by route.", LATENCY_BUCKETS,
+)
+registry.register(
+    "sharebnb_request_serialize_seconds", "histogram",
+    "Time spent serializing responses per request, by route.",
+    LATENCY_BUCKETS,
+)
+registry.register(
+    "sharebnb_request_s3_seconds", "histogram",
+    "Time spent in S3 calls per request, by route.", LATENCY_BUCKETS,
+)
+registry.register(
+    "sharebnb_request_compress_seconds", "histogram",
+    "Time spent compressing responses per request, by route.",
+    LATENCY_BUCKETS,
+)
+
+
+class RequestStats:
+    """ Timings collected over the course of one request (lives on `g`). """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.db_time = 0.0
+        self.timers = {"serialize": 0.0, "s3": 0.0, "compress": 0.0}
+        self.statements = []
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get("_request_stats")
+    return None
+
+
+@contextmanager
+def timed(kind):
+    """ Add the time spent in the block to this request's `kind` timer.
+
+        Outside of a request (e.g. in seed scripts) this does nothing.
+    """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = _current_stats()
+        if stats is not None:
+            stats.timers[kind] = (
+                stats.timers.get(kind, 0.0)
+                + time.perf_counter() - started
+            )
+
+
+class TimedJSONEncoder(json.JSONEncoder):
+    """ Flask's JSON encoder, with encoding counted as serialization time. """
+
+    def encode(self, o):
+        with timed("serialize"):
+            return super().encode(o)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = _current_stats()
+    if stats is None:
+        return
+
+    stats.query_count += 1
+    stats.db_time += elapsed
+    if len(stats.statements) < MAX_RECORDED_STATEMENTS:
+        stats.statements.append((elapsed, statement))
+
+
+def _route_label():
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def _start_request():
+    g._request_stats = RequestStats()
+
+
+def _finish_request(app, response):
+    stats = g.pop("_request_stats", None)
+    if stats is None:
+        return response
+
+    duration = time.perf_counter() - stats.started
+    route = (("route", _route_label()),)
+
+    registry.inc(
+        "sharebnb_requests_total",
+        route + (("method", request.method), ("status", response.status_code)),
+    )
+    registry.observe("sharebnb_request_duration_seconds", route, duration)
+    registry.observe("sharebnb_request_sql_queries", route, stats.query_count)
+    registry.observe("sharebnb_request_db_seconds", route, stats.db_time)
+    registry.observe(
+        "sharebnb_request_serialize_seconds", route, stats.timers["serialize"]
+    )
+    registry.observe("sharebnb_request_s3_seconds", route, stats.timers["s3"])
+    registry.observe(
+        "sharebnb_request_compress_seconds", route, stats.timers["compress"]
+    )
+
+    slow_ms = app.config.get("SLOW_REQUEST_MS")
+    if slow_ms is not None and duration * 1000 >= slow_ms:
+        statements = "\n".join(
+            f"  [{elapsed * 1000:.1f}ms] {statement}"
+            for elapsed, statement in sorted(stats.statements, reverse=True)
+        )
+        logger.warning(
+            "Slow request %s %s: %.1fms total, %d queries / %.1fms db, "
+            "%.1fms serialize, %.1fms s3\n%s",
+            request.method,
+            request.full_path.rstrip("?"),
+            duration * 1000,
+            stats.query_count,
+            stats.db_time * 1000,
+            stats.timers["serialize"] * 1000,
+            stats.timers["s3"] * 1000,
+            statements,
+        )
+
+    return response
+
+
+def metrics_view():
+    """ Prometheus scrape endpoint. """
+
+    return Response(
+        registry.render(),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
+def init_metrics(app):
+    """ Install the instrumentation hooks and GET /metrics on `app`. """
+
+    app.json_encoder = TimedJSONEncoder
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(app, response))
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -1,14 +1,49 @@
 """SQLAlchemy models for sharebnb."""
 
+import json
+import zlib
 from datetime import datetime
+from decimal import Decimal
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.orm import aliased, load_only, selectinload
+
+from geo import quadkey
 
 # TODO: reference to actual S3 bucket
 DEFAULT_USER_IMAGE = "/static/images/default-pic.png"
 DEFAULT_LOCATION_IMAGE = "/static/images/default-pic.png"
 
+# Most messages returned by one Message.find_* call.
+MESSAGES_PAGE_SIZE = 100
+
+# Rows per multi-row INSERT when broadcasting (keeps bind parameters well
+# under Postgres' limit of 65535 per statement).
+BROADCAST_CHUNK_SIZE = 1000
+
+# Level of Listing.geo_cell (tiles roughly 600m across); its prefixes are
+# the coarser cells map clusters are grouped by.
+GEO_CELL_LEVEL = 16
+
+# Keys a client can pick with `fields=`, and embed with `include=`.
+USER_FIELDS = (
+    "username", "bio", "first_name", "last_name", "email", "image_url",
+    "location", "is_admin",
+)
+# What an embedded user (e.g. a listing's creator) carries.
+USER_BRIEF_FIELDS = (
+    "username", "first_name", "last_name", "image_url", "location",
+)
+USER_INCLUDES = ("listings",)
+LISTING_FIELDS = (
+    "id", "title", "description", "photo", "price", "longitude", "latitude",
+    "beds", "rooms", "bathrooms", "created_by", "rented_by", "photos",
+)
+LISTING_BRIEF_FIELDS = LISTING_FIELDS[:7]
+LISTING_INCLUDES = ("creator", "renter")
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -17,6 +52,15 @@ class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
+    __table_args__ = (
+        # Lets the reaper find deleted users without scanning live ones.
+        db.Index(
+            'ix_users_deleted_at',
+            'deleted_at',
+            postgresql_where=db.text('deleted_at IS NOT NULL'),
+            sqlite_where=db.text('deleted_at IS NOT NULL'),
+        ),
+    )
 
     username = db.Column(
         db.String(length=50),
@@ -56,6 +100,11 @@ class User(db.Model):
         default=DEFAULT_USER_IMAGE,
     )
 
+    image_key = db.Column(
+        db.Text,
+        db.ForeignKey('stored_objects.key'),
+    )
+
     location = db.Column(
         db.Text,
         nullable=False
@@ -67,6 +116,11 @@ class User(db.Model):
         default=False
     )
 
+    # Set when the user is deleted; the row is purged later by reaper.py.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     created_listings = db.relationship(
         'Listing',
         foreign_keys='Listing.created_by',
@@ -96,24 +150,24 @@ class User(db.Model):
                     {self.email}>"""
 
     @classmethod
-    def signup(cls, form):
-        """Sign up user.
+    def signup(cls, values):
+        """Sign up user from validated USER_SIGNUP values.
 
         Hashes password and adds user to system.
         """
 
         hashed_pwd = bcrypt.generate_password_hash(
-                            form.password.data
+                            values["password"]
                             ).decode('UTF-8')
 
         user = User(
-            username=form.username.data,
-            first_name=form.first_name.data,
-            last_name=form.last_name.data,
-            email=form.email.data,
+            username=values["username"],
+            first_name=values["first_name"],
+            last_name=values["last_name"],
+            email=values["email"],
             password=hashed_pwd,
             image_url=DEFAULT_USER_IMAGE,
-            location=form.location.data or "",
+            location=values.get("location", ""),
         )
 
         db.session.add(user)
@@ -130,7 +184,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.live().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -139,35 +193,65 @@ class User(db.Model):
 
         return False
 
-    def serialize(self):
-        """ Serialize User object to dictionary """
+    @classmethod
+    def live(cls):
+        """ Query for users that haven't been deleted. """
 
-        return {
-            "username": self.username,
-            "bio": self.bio,
-            "first_name": self.first_name,
-            "last_name": self.last_name,
-            "email": self.email,
-            "image_url": self.image_url,
-            "location": self.location,
-            "is_admin": self.is_admin
-        }
+        return cls.query.filter(cls.deleted_at.is_(None))
 
-    def update(self, form):
-        """ Update fields of self if key in form """
+    @classmethod
+    def get_live_or_404(cls, username):
+        """ The user with `username`, or 404 if missing or deleted. """
+
+        return cls.live().filter(cls.username == username).first_or_404()
+
+    @classmethod
+    def with_fields(cls, query, fields):
+        """ Only load the columns needed to serialize `fields`. """
+
+        return query.options(load_only("username", *fields))
+
+    def serialize(self, fields=USER_FIELDS):
+        """ Serialize User object to dictionary, with only `fields` """
 
-        self.bio = form.bio.data
-        self.first_name = form.first_name.data
-        self.last_name = form.last_name.data
-        self.email = form.email.data
-        self.image_url = form.image_url.data
-        self.location = form.location.data
+        return {field: getattr(self, field) for field in fields}
+
+    def update(self, values):
+        """ Update fields of self from validated USER_EDIT values.
+            The profile image only changes through an upload.
+        """
+
+        self.bio = values.get("bio")
+        self.first_name = values.get("first_name")
+        self.last_name = values.get("last_name")
+        self.email = values["email"]
+        self.location = values.get("location")
 
 
 class Message(db.Model):
-    """An individual message."""
+    """An individual message.
+
+    On Postgres the table is partitioned by month of sent_at and its
+    primary key is (id, sent_at); see partitions.py.
+    """
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Both finders read newest first within these, which lets a
+        # partitioned table stop at the newest partitions.
+        db.Index(
+            'ix_messages_thread',
+            'from_user',
+            'to_user',
+            'sent_at',
+        ),
+        db.Index(
+            'ix_messages_listing',
+            'listing_id',
+            'from_user',
+            'sent_at',
+        ),
+    )
 
     id = db.Column(
         db.Integer,
@@ -183,6 +267,7 @@ class Message(db.Model):
         db.String,
         db.ForeignKey('users.username', ondelete='CASCADE'),
         nullable=False,
+        index=True,
     )
 
     from_user = db.Column(
@@ -200,7 +285,7 @@ class Message(db.Model):
     sent_at = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     read_at = db.Column(
@@ -218,54 +303,133 @@ class Message(db.Model):
                     {self.sent_at}>"""
 
     @classmethod
-    def find_all(cls, from_user, to_user, listing_id):
-        """ Given from_user and to_user, query for all messages.
+    def live(cls):
+        """ Query for messages whose sender, recipient and listing haven't
+            been deleted. Each join is a primary key lookup.
+        """
+
+        return _live_messages(cls)
+
+    @classmethod
+    def find_all(cls, from_user, to_user, listing_id=None, before=None,
+                 limit=MESSAGES_PAGE_SIZE, hot_since=None):
+        """ Given from_user and to_user (and optionally listing_id),
+            query for all messages.
             Order by timestamp descending
-            Limit by 100
+            Limit by `limit`, starting before `before` (a sent_at cursor)
+            The archive is only read once the page reaches `hot_since`
         """
 
-        messages = cls.query.filter(
-                                    Message.from_user == from_user,
-                                    Message.to_user == to_user,
-                            ).order_by(
-                                Message.sent_at.desc()
-                            ).limit(
-                                100
-                            ).all()
-        return messages
+        def criteria(model):
+            filters = [
+                model.from_user == from_user,
+                model.to_user == to_user,
+            ]
+            if listing_id is not None:
+                filters.append(model.listing_id == listing_id)
+            return filters
+
+        return _find_messages(criteria, before, limit, hot_since)
 
     @classmethod
-    def find_by_listing(cls, listing_id, from_username):
+    def find_by_listing(cls, listing_id, from_username, before=None,
+                        limit=MESSAGES_PAGE_SIZE, hot_since=None):
         """ Given listing_id and from_username, query for all messages.
             Order by timestamp descending
-            Limit by 100
+            Limit by `limit`, starting before `before` (a sent_at cursor)
+            The archive is only read once the page reaches `hot_since`
         """
 
-        messages = cls.query.filter(
-                                    Message.listing_id == listing_id,
-                                    Message.from_user == from_username,
-                            ).order_by(
-                                Message.sent_at.desc()
-                            ).limit(
-                                100
-                            ).all()
-        return messages
+        def criteria(model):
+            return [
+                model.listing_id == listing_id,
+                model.from_user == from_username,
+            ]
+
+        return _find_messages(criteria, before, limit, hot_since)
 
     @classmethod
-    def create(cls, form):
-        """Create message and add message to database."""
+    def create(cls, values):
+        """Create message from validated values and add it to database."""
 
         message = Message(
-            body=form.body.data,
-            from_user=form.from_user.data,
-            to_user=form.to_user.data,
-            listing_id=form.listing_id.data,
-            sent_at=datetime.now(),
+            body=values["body"],
+            from_user=values["from_user"],
+            to_user=values["to_user"],
+            listing_id=values["listing_id"],
+            sent_at=datetime.utcnow(),
         )
 
         db.session.add(message)
         return message
 
+    @classmethod
+    def inquirers(cls, listing_id, host):
+        """ Query for the distinct users who have messaged `host` about a
+            listing, archived messages included.
+        """
+
+        def senders(model):
+            return _live_messages(model).filter(
+                model.listing_id == listing_id,
+                model.to_user == host,
+                model.from_user != host,
+            ).with_entities(model.from_user)
+
+        return senders(cls).union(senders(ArchivedMessage))
+
+    @classmethod
+    def broadcast(cls, listing_id, host, body):
+        """ Send `body` from `host` to everyone who has messaged them about
+            the listing, with one multi-row INSERT ... RETURNING per
+            BROADCAST_CHUNK_SIZE recipients (one INSERT per row where
+            RETURNING isn't supported, i.e. SQLite). Returns the inserted
+            rows as dicts, with their ids. Nothing is committed here.
+        """
+
+        sent_at = datetime.utcnow()
+        rows = [
+            {
+                "body": body,
+                "from_user": host,
+                "to_user": username,
+                "listing_id": listing_id,
+                "sent_at": sent_at,
+            }
+            for (username,) in cls.inquirers(listing_id, host)
+        ]
+
+        table = cls.__table__
+        connection = db.session.connection()
+        for start in range(0, len(rows), BROADCAST_CHUNK_SIZE):
+            chunk = rows[start:start + BROADCAST_CHUNK_SIZE]
+            if connection.dialect.implicit_returning:
+                result = connection.execute(
+                    table.insert().values(chunk).returning(table.c.id)
+                )
+                ids = [message_id for (message_id,) in result]
+            else:
+                ids = [
+                    connection.execute(table.insert(), row)
+                    .inserted_primary_key[0]
+                    for row in chunk
+                ]
+            for row, message_id in zip(chunk, ids):
+                row["id"] = message_id
+
+        ChangeLog.record(connection, "message", [
+            {
+                "object_id": row["id"],
+                "from_user": row["from_user"],
+                "to_user": row["to_user"],
+            }
+            for row in rows
+        ])
+        OutboxEvent.record(connection, "message.created", [
+            {"aggregate_id": row["id"], "payload": row} for row in rows
+        ])
+        return rows
+
     def serialize(self):
         """ Serialize message object to dictionary. """
 
@@ -279,10 +443,206 @@ class Message(db.Model):
         }
 
 
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` by the archive job (archive.py).
+
+    Same columns as Message, with the body stored zlib-compressed. Reads go
+    through Message.find_*, which only look here once the hot table runs
+    out of messages for the page being read.
+    """
+
+    __tablename__ = 'message_archive'
+    __table_args__ = (
+        db.Index(
+            'ix_message_archive_thread',
+            'from_user',
+            'to_user',
+            'sent_at',
+        ),
+        db.Index(
+            'ix_message_archive_listing',
+            'listing_id',
+            'from_user',
+            'sent_at',
+        ),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    body_compressed = db.Column(
+        db.LargeBinary,
+        nullable=False,
+    )
+
+    to_user = db.Column(
+        db.String,
+        db.ForeignKey('users.username', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+    from_user = db.Column(
+        db.String,
+        db.ForeignKey('users.username', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    listing_id = db.Column(
+        db.Integer,
+        db.ForeignKey('listings.id', ondelete="CASCADE"),
+        nullable=False,
+    )
+
+    sent_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    archived_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"""<ArchivedMessage #{self.id}:
+                    {self.to_user},
+                    {self.from_user},
+                    {self.sent_at}>"""
+
+    @classmethod
+    def live(cls):
+        """ Query for archived messages whose sender, recipient and listing
+            haven't been deleted.
+        """
+
+        return _live_messages(cls)
+
+    @classmethod
+    def values_from_message(cls, message):
+        """ Column values archiving a `messages` row (any object with its
+            columns as attributes).
+        """
+
+        return {
+            "id": message.id,
+            "body_compressed": zlib.compress(message.body.encode("utf-8")),
+            "to_user": message.to_user,
+            "from_user": message.from_user,
+            "listing_id": message.listing_id,
+            "sent_at": message.sent_at,
+            "read_at": message.read_at,
+        }
+
+    @property
+    def body(self):
+        return zlib.decompress(self.body_compressed).decode("utf-8")
+
+    def serialize(self):
+        """ Serialize archived message to the same dictionary as Message. """
+
+        return {
+            "body": self.body,
+            "from_user": self.from_user,
+            "to_user": self.to_user,
+            "listing_id": self.listing_id,
+            "sent_at": self.sent_at,
+            "read_at": self.read_at,
+        }
+
+
+def _live_messages(model):
+    """ Live-message query for Message or ArchivedMessage. """
+
+    sender = aliased(User)
+    recipient = aliased(User)
+    return model.query.join(
+        sender, sender.username == model.from_user
+    ).join(
+        recipient, recipient.username == model.to_user
+    ).join(
+        Listing, Listing.id == model.listing_id
+    ).filter(
+        sender.deleted_at.is_(None),
+        recipient.deleted_at.is_(None),
+        Listing.deleted_at.is_(None),
+    )
+
+
+def reaches_archive(messages, before, hot_since):
+    """ Whether a page of hot `messages`, read from `before`, has reached
+        the archive, which only holds messages sent before `hot_since`
+        (None: the archive may hold anything).
+    """
+
+    if hot_since is None:
+        return True
+    position = messages[-1].sent_at if messages else before
+    return position is not None and position <= hot_since
+
+
+def _find_messages(criteria, before, limit, hot_since):
+    """ Newest-first page of live messages matching `criteria(model)`.
+
+        The hot table is read first; the archive is only queried when that
+        comes up short of a full page and the page has reached `hot_since`,
+        i.e. when the cursor has moved past the hot window. A short page
+        that hasn't stops there, and the caller continues from `hot_since`.
+        The two are merged by sent_at, since messages the archive job
+        hasn't reached yet may be older than archived ones.
+    """
+
+    def page(model):
+        query = model.live().filter(*criteria(model))
+        if before is not None:
+            query = query.filter(model.sent_at < before)
+        return query.order_by(model.sent_at.desc()).limit(limit).all()
+
+    messages = page(Message)
+    if len(messages) < limit and reaches_archive(messages, before, hot_since):
+        messages = sorted(
+            messages + page(ArchivedMessage),
+            key=lambda message: message.sent_at,
+            reverse=True,
+        )[:limit]
+    return messages
+
+
 class Listing(db.Model):
     """An individual listing."""
 
     __tablename__ = 'listings'
+    __table_args__ = (
+        # Searches only ever look at live listings, so their indexes skip
+        # deleted rows; the reaper gets its own index of just those.
+        db.Index(
+            'ix_listings_live_price',
+            'price',
+            postgresql_where=db.text('deleted_at IS NULL'),
+            sqlite_where=db.text('deleted_at IS NULL'),
+        ),
+        db.Index(
+            'ix_listings_live_beds_bathrooms',
+            'beds',
+            'bathrooms',
+            postgresql_where=db.text('deleted_at IS NULL'),
+            sqlite_where=db.text('deleted_at IS NULL'),
+        ),
+        db.Index(
+            'ix_listings_deleted_at',
+            'deleted_at',
+            postgresql_where=db.text('deleted_at IS NOT NULL'),
+            sqlite_where=db.text('deleted_at IS NOT NULL'),
+        ),
+    )
 
     id = db.Column(
         db.Integer,
@@ -340,18 +700,49 @@ class Listing(db.Model):
     created_by = db.Column(
         db.String,
         db.ForeignKey('users.username', ondelete='CASCADE'),
-        nullable=False
+        nullable=False,
+        index=True,
     )
 
     rented_by = db.Column(
         db.String,
         db.ForeignKey('users.username', ondelete='CASCADE'),
+        index=True,
+    )
+
+    # Quadkey of the listing's coordinates at GEO_CELL_LEVEL; see
+    # clusters.py. Rows loaded with COPY are filled in by its backfill.
+    geo_cell = db.Column(
+        db.String(GEO_CELL_LEVEL),
+        index=True,
+    )
+
+    # Set by the database's clock on every write (including COPY and bulk
+    # inserts), so workers can poll for listings changed since a point.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=db.func.now(),
+        onupdate=db.func.now(),
+        server_default=db.func.now(),
+        index=True,
+    )
+
+    # Set when the listing is deleted; the row is purged later by reaper.py.
+    deleted_at = db.Column(
+        db.DateTime,
     )
 
     sent_messages = db.relationship('Message',
                                     foreign_keys="Message.listing_id",
                                     backref="listing_thread")
 
+    photos = db.relationship('ListingPhoto',
+                             order_by="ListingPhoto.position",
+                             backref="listing",
+                             cascade="all, delete-orphan",
+                             passive_deletes=True)
+
     def __repr__(self):
         return f"""<Listing #{self.id}:
                     {self.price},
@@ -360,10 +751,21 @@ class Listing(db.Model):
                     {self.longitude}>"""
 
     @classmethod
-    def find_all(cls, search_params):
-        """ Given search inputs, query and return all listings.  """
+    def find_all(cls, search_params, fields=None, includes=()):
+        """ Given search inputs, query and return all listings.
+            With `fields`, only what they (and `includes`) need is loaded.
+        """
+
+        search_query = cls.search_query(search_params)
+        if fields is not None:
+            search_query = cls.with_fields(search_query, fields, includes)
+        return search_query.all()
+
+    @classmethod
+    def search_query(cls, search_params):
+        """ Given search inputs, build (but don't run) the listings query. """
 
-        search_query = cls.query
+        search_query = cls.live()
 
         for key in search_params:
             if key == 'max_price' and search_params.get(key):
@@ -387,103 +789,623 @@ class Listing(db.Model):
                     Listing.bathrooms == search_params[key]
                     )
 
-        listings = search_query.all()
-        return listings
+        return search_query
 
     @classmethod
-    def create(cls, form):
-        """Create listing and adds listing to database."""
-
-        listing = Listing(
-            title=form.title.data,
-            description=form.description.data or None,
-            photo=form.photo.data or None,
-            price=form.price.data,
-            longitude=form.longitude.data,
-            latitude=form.latitude.data,
-            beds=form.beds.data,
-            rooms=form.rooms.data,
-            bathrooms=form.bathrooms.data,
-            created_by=form.created_by.data,
-        )
+    def with_fields(cls, query, fields, includes=()):
+        """ Only load the columns needed to serialize `fields` and embed
+            `includes`; the gallery is loaded (in one query for all
+            listings) only when "photos" is asked for.
+        """
 
-        db.session.add(listing)
-        return listing
+        columns = {"id"}
+        columns.update(field for field in fields if field != "photos")
+        if "creator" in includes:
+            columns.add("created_by")
+        if "renter" in includes:
+            columns.add("rented_by")
+
+        query = query.options(load_only(*columns))
+        if "photos" in fields:
+            query = query.options(selectinload(cls.photos))
+        return query
 
     @classmethod
-    def convert_inputs(self, inputs):
-        """ Converts search parameter inputs into correct type. """
+    def embed(cls, listings, serialized, includes,
+              user_fields=USER_BRIEF_FIELDS):
+        """ Add the `includes` ("creator", "renter") of each listing to its
+            serialized dict, loading every user needed with one query.
+        """
 
-        search_params = {}
-        max_price = inputs.get("max_price", None)
-        longitude = inputs.get("longitude", None)
-        latitude = inputs.get("latitude", None)
-        beds = inputs.get("beds", None)
-        bathrooms = inputs.get("bathrooms", None)
+        if not includes:
+            return serialized
+
+        usernames = set()
+        if "creator" in includes:
+            usernames.update(listing.created_by for listing in listings)
+        if "renter" in includes:
+            usernames.update(listing.rented_by for listing in listings)
+        usernames.discard(None)
+
+        users = {}
+        if usernames:
+            users_query = User.with_fields(
+                User.live().filter(User.username.in_(usernames)),
+                user_fields,
+            )
+            users = {
+                user.username: user.serialize(user_fields)
+                for user in users_query
+            }
 
-        if max_price:
-            search_params["max_price"] = int(max_price)
+        for listing, listing_dict in zip(listings, serialized):
+            if "creator" in includes:
+                listing_dict["creator"] = users.get(listing.created_by)
+            if "renter" in includes:
+                listing_dict["renter"] = users.get(listing.rented_by)
+        return serialized
 
-        if longitude:
-            search_params["longitude"] = float(longitude)
+    @classmethod
+    def live(cls):
+        """ Query for listings that haven't been deleted. """
 
-        if latitude:
-            search_params["latitude"] = float(latitude)
+        return cls.query.filter(cls.deleted_at.is_(None))
 
-        if beds:
-            search_params["beds"] = int(beds.split(".")[0])
+    @classmethod
+    def get_live_or_404(cls, listing_id):
+        """ The listing with `listing_id`, or 404 if missing or deleted. """
 
-        if bathrooms:
-            search_params["bathrooms"] = int(bathrooms.split(".")[0])
+        return cls.live().filter(cls.id == listing_id).first_or_404()
 
-        return search_params
+    @classmethod
+    def create(cls, values):
+        """Create listing from validated values and add it to database."""
 
-    def serialize(self, isDetailed):
+        listing = Listing(**cls.values_from_input(values))
+
+        db.session.add(listing)
+        return listing
+
+    @classmethod
+    def values_from_input(cls, values):
+        """ Column values for a new listing from validated LISTING_CREATE
+            values.
+        """
+
+        return {
+            "title": values["title"],
+            "description": values.get("description"),
+            "photo": values.get("photo"),
+            "price": values["price"],
+            "longitude": values["longitude"],
+            "latitude": values["latitude"],
+            "beds": values["beds"],
+            "rooms": values["rooms"],
+            "bathrooms": values["bathrooms"],
+            "created_by": values["created_by"],
+            "geo_cell": cls.geo_cell_for(
+                values["latitude"], values["longitude"]
+            ),
+        }
+
+    @staticmethod
+    def geo_cell_for(latitude, longitude):
+        """ geo_cell value for a listing at these coordinates. """
+
+        return quadkey(latitude, longitude, GEO_CELL_LEVEL)
+
+    def serialize(self, isDetailed, fields=None):
         """ Serialize Listing object to dictionary
         price is a Numeric in db, but Decimal is not serializable,
         so converting to a float beforehand
+        The brief form only carries the cover image (`photo`); the
+        detailed form also includes the whole gallery. `fields`, if given,
+        picks the keys instead.
         """
 
-        if not isDetailed:
-            return {
-                "id": self.id,
-                "title": self.title,
-                "description": self.description,
-                "photo": self.photo,
-                "price": float(self.price),
-                "longitude": self.longitude,
-                "latitude": self.latitude,
-            }
+        if fields is None:
+            fields = LISTING_FIELDS if isDetailed else LISTING_BRIEF_FIELDS
+
+        serialized = {}
+        for field in fields:
+            if field == "price":
+                serialized["price"] = float(self.price)
+            elif field == "photos":
+                serialized["photos"] = [
+                    photo.serialize() for photo in self.photos
+                ]
+            else:
+                serialized[field] = getattr(self, field)
+        return serialized
+
+    def update(self, values):
+        """ Update fields of self from validated LISTING_EDIT values """
+
+        self.title = values.get("title")
+        self.description = values.get("description")
+        self.photo = values.get("photo")
+        self.price = values.get("price")
+        self.longitude = values.get("longitude")
+        self.latitude = values.get("latitude")
+        if self.latitude is not None and self.longitude is not None:
+            self.geo_cell = self.geo_cell_for(self.latitude, self.longitude)
+        self.beds = values.get("beds")
+        self.rooms = values.get("rooms")
+        self.bathrooms = values.get("bathrooms")
+        self.created_by = values.get("created_by")
+        self.rented_by = values.get("rented_by")
+
+
+class ListingPhoto(db.Model):
+    """A photo in a listing's gallery."""
+
+    __tablename__ = 'listing_photos'
+    __table_args__ = (
+        db.UniqueConstraint('listing_id', 'position'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    listing_id = db.Column(
+        db.Integer,
+        db.ForeignKey('listings.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    position = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    object_name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    url = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    width = db.Column(
+        db.Integer,
+    )
+
+    height = db.Column(
+        db.Integer,
+    )
+
+    def __repr__(self):
+        return f"""<ListingPhoto #{self.id}:
+                    {self.listing_id},
+                    {self.position},
+                    {self.object_name}>"""
+
+    @classmethod
+    def next_position(cls, listing_id):
+        """ Position after the last photo currently in the gallery. """
+
+        last = db.session.query(
+            db.func.max(cls.position)
+        ).filter(cls.listing_id == listing_id).scalar()
+        return 0 if last is None else last + 1
+
+    def serialize(self):
+        """ Serialize ListingPhoto object to dictionary. """
 
         return {
             "id": self.id,
-            "title": self.title,
-            "description": self.description,
-            "photo": self.photo,
-            "price": float(self.price),
-            "longitude": self.longitude,
-            "latitude": self.latitude,
-            "beds": self.beds,
-            "rooms": self.rooms,
-            "bathrooms": self.bathrooms,
-            "created_by": self.created_by,
-            "rented_by": self.rented_by
+            "position": self.position,
+            "url": self.url,
+            "width": self.width,
+            "height": self.height,
         }
 
-    def update(self, form):
-        """ Update fields of self if key in form """
-
-        self.title = form.title.data
-        self.description = form.description.data
-        self.photo = form.photo.data
-        self.price = form.price.data
-        self.longitude = form.longitude.data
-        self.latitude = form.latitude.data
-        self.beds = form.beds.data
-        self.rooms = form.rooms.data
-        self.bathrooms = form.bathrooms.data
-        self.created_by = form.created_by.data
-        self.rented_by = form.rented_by.data
+
+class StoredObject(db.Model):
+    """An image stored in S3 under its content hash, or a direct upload
+    (under its upload key, with no hash).
+
+    `ref_count` is how many users/photos point at the object; once it is
+    zero the reaper removes the object from S3, then the row.
+    """
+
+    __tablename__ = 'stored_objects'
+    __table_args__ = (
+        # Lets the reaper find unreferenced objects without a scan.
+        db.Index(
+            'ix_stored_objects_unreferenced',
+            'key',
+            postgresql_where=db.text('ref_count <= 0'),
+            sqlite_where=db.text('ref_count <= 0'),
+        ),
+    )
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    sha256 = db.Column(
+        db.String(length=64),
+    )
+
+    size = db.Column(
+        db.BigInteger,
+        nullable=False,
+    )
+
+    content_type = db.Column(
+        db.Text,
+    )
+
+    ref_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"""<StoredObject #{self.key}:
+                    {self.size},
+                    {self.ref_count}>"""
+
+
+class ListingCellStats(db.Model):
+    """Running listing aggregates for one geo cell (see stats.py).
+
+    Kept up to date as listings are created, edited and deleted, so area
+    statistics never need a scan of `listings`.
+    """
+
+    __tablename__ = 'listing_cell_stats'
+
+    cell = db.Column(
+        db.String(length=32),
+        primary_key=True,
+    )
+
+    listing_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    rented_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    price_sum = db.Column(
+        db.Numeric(16, 2),
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return f"""<ListingCellStats #{self.cell}:
+                    {self.listing_count},
+                    {self.rented_count},
+                    {self.price_sum}>"""
+
+
+class ListingCellPriceBucket(db.Model):
+    """How many listings in a geo cell fall in one price bucket.
+
+    Together a cell's buckets form a log-scale histogram of its prices,
+    which is what median and other quantiles are estimated from.
+    """
+
+    __tablename__ = 'listing_cell_price_buckets'
+
+    cell = db.Column(
+        db.String(length=32),
+        primary_key=True,
+    )
+
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    def __repr__(self):
+        return f"""<ListingCellPriceBucket #{self.cell}:
+                    {self.bucket},
+                    {self.count}>"""
+
+
+class IdempotencyKey(db.Model):
+    """A client-supplied Idempotency-Key and the response it produced.
+
+    `key_hash` covers the key together with who sent it and to which
+    endpoint; `request_hash` is a digest of the request body, so a key
+    reused for a different request can be told apart from a retry. Rows
+    without a status are requests still in progress.
+    """
+
+    __tablename__ = 'idempotency_keys'
+
+    key_hash = db.Column(
+        db.LargeBinary(length=32),
+        primary_key=True,
+    )
+
+    request_hash = db.Column(
+        db.LargeBinary(length=32),
+        nullable=False,
+    )
+
+    status_code = db.Column(
+        db.SmallInteger,
+    )
+
+    content_type = db.Column(
+        db.Text,
+    )
+
+    # zlib-compressed response body.
+    body = db.Column(
+        db.LargeBinary,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    expires_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"""<IdempotencyKey #{self.key_hash.hex()}:
+                    {self.status_code},
+                    {self.expires_at}>"""
+
+
+def has_changes(target):
+    """ Whether a flush is writing new values to any of `target`'s
+        columns (as opposed to only touching its relationships).
+    """
+
+    state = inspect(target)
+    return any(
+        state.attrs[attr.key].history.has_changes()
+        for attr in state.mapper.column_attrs
+    )
+
+
+def txid_finished(txid):
+    """ Criterion for rows whose writing transaction (the `txid` column)
+        has finished, along with every transaction that could still write
+        a lower txid. Always true off Postgres, where one transaction
+        writes at a time.
+    """
+
+    if db.engine.dialect.name != "postgresql":
+        return db.true()
+    return txid < db.func.txid_snapshot_xmin(db.func.txid_current_snapshot())
+
+
+class ChangeLog(db.Model):
+    """One create, update or delete of a listing or message.
+
+    Entries are written in the same transaction as the change (see
+    sync.py), and their (txid, id) positions serve as the sync tokens
+    clients pass to `GET /sync`. Message entries carry the two users who
+    can see them.
+    """
+
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        db.Index('ix_change_log_position', 'txid', 'id'),
+        db.Index('ix_change_log_kind', 'kind', 'txid', 'id'),
+        db.Index('ix_change_log_from_user', 'from_user', 'txid', 'id'),
+        db.Index('ix_change_log_to_user', 'to_user', 'txid', 'id'),
+    )
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+    )
+
+    # The writing transaction's id on Postgres (txid_current()); 0 on
+    # SQLite, where one writer at a time already commits ids in order.
+    txid = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    # "listing" or "message"
+    kind = db.Column(
+        db.String(16),
+        nullable=False,
+    )
+
+    object_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    deleted = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    from_user = db.Column(
+        db.String,
+    )
+
+    to_user = db.Column(
+        db.String,
+    )
+
+    # When the entry was written (on the writing host's clock); only used
+    # to expire old entries.
+    changed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"""<ChangeLog #{self.id}:
+                    {self.kind},
+                    {self.object_id},
+                    {self.deleted}>"""
+
+    @classmethod
+    def record(cls, connection, kind, changes):
+        """ Log changes to objects of `kind`. `changes` are dicts with
+            object_id and optionally deleted, from_user and to_user.
+        """
+
+        rows = [
+            {
+                "kind": kind,
+                "object_id": change["object_id"],
+                "deleted": change.get("deleted", False),
+                "from_user": change.get("from_user"),
+                "to_user": change.get("to_user"),
+            }
+            for change in changes
+        ]
+        if not rows:
+            return
+        insert = cls.__table__.insert()
+        if connection.dialect.name == "postgresql":
+            insert = insert.values(txid=db.func.txid_current())
+        connection.execute(insert, rows)
+
+
+def _json_value(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+class OutboxEvent(db.Model):
+    """A change event waiting to be published to downstream consumers.
+
+    Written in the same transaction as the change it describes (see
+    outbox.py); `published_at` is set once the relay has handed it to the
+    sink. `payload` is the changed object as JSON. Events are relayed in
+    (txid, id) order, like change log entries.
+    """
+
+    __tablename__ = 'outbox_events'
+    __table_args__ = (
+        db.Index(
+            'ix_outbox_events_unpublished', 'txid', 'id',
+            postgresql_where=db.text('published_at IS NULL'),
+            sqlite_where=db.text('published_at IS NULL'),
+        ),
+    )
+
+    id = db.Column(
+        db.BigInteger().with_variant(db.Integer, 'sqlite'),
+        primary_key=True,
+    )
+
+    # The writing transaction's id on Postgres (txid_current()); 0 on
+    # SQLite, where one writer at a time already commits ids in order.
+    txid = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    # e.g. "listing.created", "message.created", "user.deleted"
+    event_type = db.Column(
+        db.String(32),
+        nullable=False,
+    )
+
+    # Listing or message id, or username.
+    aggregate_id = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    published_at = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
+    def __repr__(self):
+        return f"""<OutboxEvent #{self.id}:
+                    {self.event_type},
+                    {self.aggregate_id},
+                    {self.published_at}>"""
+
+    @classmethod
+    def record(cls, connection, event_type, changes):
+        """ Write one `event_type` event per change, a dict with
+            aggregate_id and payload (the object's fields).
+        """
+
+        rows = [
+            {
+                "event_type": event_type,
+                "aggregate_id": str(change["aggregate_id"]),
+                "payload": json.dumps(change["payload"],
+                                      default=_json_value),
+            }
+            for change in changes
+        ]
+        if not rows:
+            return
+        insert = cls.__table__.insert()
+        if connection.dialect.name == "postgresql":
+            insert = insert.values(txid=db.func.txid_current())
+        connection.execute(insert, rows)
+
+    def serialize(self):
+        """ The event as published. """
+
+        return {
+            "id": self.id,
+            "type": self.event_type,
+            "aggregate_id": self.aggregate_id,
+            "created_at": self.created_at.isoformat(),
+            "payload": json.loads(self.payload),
+        }
 
 
 def connect_db(app):
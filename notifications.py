@@ -0,0 +1,65 @@
+"""New-message notifications, sent off the request thread.
+
+Routes call notify_messages after committing; delivery happens on a small
+shared thread pool, so a broadcast to hundreds of inquirers returns as
+soon as its rows are written. Each registered sender (see
+register_sender) is called once per notification; by default they are
+only logged, until a mail or push sender is plugged in.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_WORKERS = 4
+# Characters of the message body included in a notification.
+PREVIEW_LENGTH = 140
+
+_notify_pool = ThreadPoolExecutor(
+    max_workers=NOTIFY_WORKERS,
+    thread_name_prefix="notify",
+)
+
+
+def _log_sender(notification):
+    logger.info("notify %s: message from %s about listing %s",
+                notification["to_user"], notification["from_user"],
+                notification["listing_id"])
+
+
+_senders = [_log_sender]
+
+
+def register_sender(sender):
+    """ Also deliver every notification through `sender(notification)`. """
+
+    _senders.append(sender)
+    return sender
+
+
+def _deliver(notifications):
+    for notification in notifications:
+        for sender in _senders:
+            try:
+                sender(notification)
+            except Exception:
+                logger.exception("notifying %s failed",
+                                 notification["to_user"])
+
+
+def notify_messages(messages):
+    """ Queue a notification to the recipient of each message. `messages`
+        are dicts with the Message columns. Returns a future.
+    """
+
+    notifications = [
+        {
+            "to_user": message["to_user"],
+            "from_user": message["from_user"],
+            "listing_id": message["listing_id"],
+            "preview": message["body"][:PREVIEW_LENGTH],
+        }
+        for message in messages
+    ]
+    return _notify_pool.submit(_deliver, notifications)
@@ -0,0 +1,239 @@
+"""Change events for downstream consumers, through a transactional outbox.
+
+Creating, updating or deleting a listing, message or user writes an
+OutboxEvent row in the same transaction as the change: mapper events cover
+ORM writes (Listing.create / update, listing_delete, Message.create,
+User.signup, ...), and the Core paths (bulk import, broadcasts, user
+soft-delete) record their rows themselves, as they do for the change log.
+An event exists if and only if its change committed, and requests pay for
+one extra INSERT, not for a call to a broker.
+
+The relay then publishes unpublished events in batches to a sink, and
+marks them published:
+
+    python outbox.py                          # OUTBOX_SINK, forever
+    python outbox.py --once --sink file:/tmp/events.jsonl
+
+Delivery is at least once: if the relay stops between publishing a batch
+and marking it, the batch is published again, so consumers dedupe on the
+event id.
+
+Events are published in (txid, id) order, as sync.py reads the change log:
+ids are handed out when an event is written, not when its transaction
+commits, so on Postgres each event records its transaction's id and the
+relay only takes events of transactions older than the oldest one still
+running. An event committed later can then never sort before one already
+published, and a long transaction holds the relay back until it finishes.
+Run one relay to keep events in that order; more can run side by side (on
+Postgres each skips batches another holds), at the cost of ordering
+between batches.
+
+Event types are "<kind>.created", "<kind>.updated" and "<kind>.deleted" for
+the kinds listing, message and user. The payload is the object's columns
+(users without their password hash); deletes carry only the id. Published
+events are kept for OUTBOX_RETENTION, then purged by reaper.py.
+"""
+
+import argparse
+import json
+import logging
+import queue
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, inspect
+
+from models import (
+    db, has_changes, txid_finished, Listing, Message, OutboxEvent, User,
+    USER_FIELDS
+)
+
+logger = logging.getLogger(__name__)
+
+RELAY_BATCH_SIZE = 500
+RELAY_INTERVAL = 1
+OUTBOX_RETENTION = timedelta(days=7)
+
+
+def _columns(target):
+    mapper = inspect(target).mapper
+    return {attr.key: getattr(target, attr.key)
+            for attr in mapper.column_attrs}
+
+
+def _user_payload(user):
+    return {field: getattr(user, field) for field in USER_FIELDS}
+
+
+def _was_deleted(target):
+    """ Whether this flush soft-deleted `target`. """
+
+    attrs = inspect(target).attrs
+    if "deleted_at" not in attrs.keys():
+        return False
+    history = attrs.deleted_at.history
+    return (
+        any(value is not None for value in history.added)
+        and all(value is None for value in history.deleted)
+    )
+
+
+def _listen(model, kind, key, payload):
+    """ Record an event for every ORM insert, update and delete of
+        `model`, identified by its attribute `key`.
+    """
+
+    def record(connection, action, target, deleted=False):
+        OutboxEvent.record(connection, f"{kind}.{action}", [{
+            "aggregate_id": getattr(target, key),
+            "payload": {key: getattr(target, key)} if deleted
+            else payload(target),
+        }])
+
+    def after_insert(mapper, connection, target):
+        record(connection, "created", target)
+
+    def after_update(mapper, connection, target):
+        if _was_deleted(target):
+            record(connection, "deleted", target, deleted=True)
+        elif has_changes(target):
+            record(connection, "updated", target)
+
+    def after_delete(mapper, connection, target):
+        record(connection, "deleted", target, deleted=True)
+
+    event.listen(model, "after_insert", after_insert)
+    event.listen(model, "after_update", after_update)
+    event.listen(model, "after_delete", after_delete)
+
+
+class LogSink:
+    """ Logs each event. The default until a broker is plugged in. """
+
+    def publish(self, events):
+        for published in events:
+            logger.info("event %s %s %s", published["id"],
+                        published["type"], published["aggregate_id"])
+
+
+class FileSink:
+    """ Appends each event as a line of JSON to `path`. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, events):
+        with open(self.path, "a") as events_file:
+            for published in events:
+                events_file.write(json.dumps(published) + "\n")
+
+
+class QueueSink:
+    """ Puts each event on a queue.Queue, for in-process consumers. """
+
+    def __init__(self, events_queue=None):
+        self.queue = events_queue or queue.Queue()
+
+    def publish(self, events):
+        for published in events:
+            self.queue.put(published)
+
+
+def sink_from_url(url):
+    """ A sink from "log", "queue" or "file:<path>". """
+
+    if url == "log":
+        return LogSink()
+    if url == "queue":
+        return QueueSink()
+    if url.startswith("file:"):
+        return FileSink(url[len("file:"):])
+    raise ValueError(f"Unknown outbox sink {url!r}")
+
+
+def relay_once(sink, batch_size=RELAY_BATCH_SIZE):
+    """ Publish up to `batch_size` unpublished events to `sink` and mark
+        them published. Returns how many were published.
+
+        If `sink.publish` raises, nothing is marked and the same events are
+        tried again next time.
+    """
+
+    events = OutboxEvent.query.filter(
+        OutboxEvent.published_at.is_(None),
+        txid_finished(OutboxEvent.txid),
+    ).order_by(
+        OutboxEvent.txid, OutboxEvent.id
+    ).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not events:
+        db.session.commit()
+        return 0
+
+    try:
+        sink.publish([outbox_event.serialize() for outbox_event in events])
+    except Exception:
+        db.session.rollback()
+        raise
+
+    OutboxEvent.query.filter(
+        OutboxEvent.id.in_([outbox_event.id for outbox_event in events])
+    ).update(
+        {OutboxEvent.published_at: datetime.utcnow()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return len(events)
+
+
+def run(sink, batch_size=RELAY_BATCH_SIZE, interval=RELAY_INTERVAL):
+    """ Relay forever, sleeping `interval` seconds whenever idle. """
+
+    while True:
+        try:
+            published = relay_once(sink, batch_size)
+        except Exception:
+            db.session.rollback()
+            logger.exception("outbox relay batch failed")
+            published = 0
+
+        if published == batch_size:
+            continue
+        if published:
+            logger.info("published %s events", published)
+        time.sleep(interval)
+
+
+def init_outbox(app):
+    """ Record outbox events for listing, message and user changes. """
+
+    _listen(Listing, "listing", "id", _columns)
+    _listen(Message, "message", "id", _columns)
+    _listen(User, "user", "username", _user_payload)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Publish outbox events to a sink."
+    )
+    parser.add_argument('--once', action='store_true',
+                        help="publish one batch and exit")
+    parser.add_argument('--sink',
+                        help='"log", "queue" or "file:<path>"'
+                             ' (default: OUTBOX_SINK)')
+    parser.add_argument('--batch-size', type=int, default=RELAY_BATCH_SIZE)
+    parser.add_argument('--interval', type=float, default=RELAY_INTERVAL,
+                        help="seconds to sleep when there is nothing to do")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        sink = sink_from_url(args.sink or app.config['OUTBOX_SINK'])
+        if args.once:
+            print(relay_once(sink, args.batch_size))
+        else:
+            run(sink, args.batch_size, args.interval)
@@ -0,0 +1,190 @@
+"""Monthly range partitions for the `messages` table (Postgres 12+).
+
+On Postgres `messages` is partitioned by RANGE (sent_at), one partition per
+calendar month (messages_2021_01 covers January 2021). Message.find_* read
+newest first with a LIMIT, so a recent thread is answered from the newest
+partitions and the planner never touches older ones; a `before` cursor
+prunes every partition after it.
+
+A partitioned table's primary key has to include the partition key, so
+there it is (id, sent_at). Ids still come from the one messages_id_seq, so
+`id` alone keeps identifying a message and the model maps it that way.
+
+db.create_all() creates a plain table (SQLite has no partitioning, and the
+partitions need creating anyway); `migrate` converts it in place:
+
+    python partitions.py migrate    # partition an existing messages table
+    python partitions.py ensure     # create the coming months' partitions
+
+Inserts fail for a month without a partition, so reaper.py calls
+ensure_partitions every PARTITION_CHECK_INTERVAL seconds to keep
+PARTITION_MONTHS_AHEAD months ready.
+"""
+
+import argparse
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db, Message
+
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = 60 * 60
+
+# The unpartitioned table is renamed to this while its rows are copied.
+UNPARTITIONED_TABLE = "messages_unpartitioned"
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_month(month):
+    if month.month == 12:
+        return datetime(month.year + 1, 1, 1)
+    return datetime(month.year, month.month + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def is_partitioned(connection):
+    """ True if `messages` is a partitioned table. """
+
+    if connection.dialect.name != "postgresql":
+        return False
+    return connection.execute(text(
+        "SELECT relkind = 'p' FROM pg_class "
+        "WHERE oid = to_regclass('messages')"
+    )).scalar() is True
+
+
+def list_partitions(connection):
+    """ Names of the partitions of `messages`, oldest first. """
+
+    return [name for (name,) in connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass('messages') "
+        "ORDER BY child.relname"
+    ))]
+
+
+def create_partition(connection, month):
+    """ Create the partition for the month starting at `month`, unless it
+        exists already.
+    """
+
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+        "PARTITION OF messages "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+        f"TO ('{next_month(month):%Y-%m-%d}')"
+    ))
+
+
+def ensure_partitions(connection, since=None,
+                      months_ahead=PARTITION_MONTHS_AHEAD):
+    """ Make sure every month from `since` (default: this month) through
+        `months_ahead` months from now has a partition. Returns how many
+        were created. Does nothing unless `messages` is partitioned.
+    """
+
+    if not is_partitioned(connection):
+        return 0
+
+    existing = set(list_partitions(connection))
+    month = month_start(since or datetime.utcnow())
+    last = month_start(datetime.utcnow())
+    for _ in range(months_ahead):
+        last = next_month(last)
+
+    created = 0
+    while month <= last:
+        if partition_name(month) not in existing:
+            create_partition(connection, month)
+            created += 1
+        month = next_month(month)
+    return created
+
+
+def migrate(connection):
+    """ Turn an unpartitioned `messages` table into a partitioned one,
+        copying its rows over. Run it inside a transaction, with writers
+        stopped: the old table is locked for the whole copy. Returns False
+        if there was nothing to do.
+    """
+
+    if connection.dialect.name != "postgresql" or is_partitioned(connection):
+        return False
+
+    connection.execute(text("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE"))
+    connection.execute(text(
+        f"ALTER TABLE messages RENAME TO {UNPARTITIONED_TABLE}"
+    ))
+    connection.execute(text(
+        "CREATE TABLE messages "
+        f"(LIKE {UNPARTITIONED_TABLE} INCLUDING DEFAULTS) "
+        "PARTITION BY RANGE (sent_at)"
+    ))
+    # The id sequence belongs to the old table and would go with it.
+    connection.execute(text(
+        "ALTER SEQUENCE messages_id_seq OWNED BY messages.id"
+    ))
+
+    oldest = connection.execute(text(
+        f"SELECT min(sent_at) FROM {UNPARTITIONED_TABLE}"
+    )).scalar()
+    ensure_partitions(connection, since=oldest)
+
+    connection.execute(text(
+        f"INSERT INTO messages SELECT * FROM {UNPARTITIONED_TABLE}"
+    ))
+    connection.execute(text(f"DROP TABLE {UNPARTITIONED_TABLE}"))
+
+    # Constraints and indexes go on once the rows are in (and the old
+    # table's, with the same names, are gone). Those created on the parent
+    # are created on every partition too.
+    connection.execute(text(
+        "ALTER TABLE messages ADD PRIMARY KEY (id, sent_at)"
+    ))
+    for foreign_key in Message.__table__.foreign_keys:
+        column = foreign_key.parent.name
+        target = foreign_key.column
+        connection.execute(text(
+            f"ALTER TABLE messages ADD FOREIGN KEY ({column}) "
+            f"REFERENCES {target.table.name} ({target.name}) "
+            f"ON DELETE {foreign_key.ondelete or 'NO ACTION'}"
+        ))
+    for index in Message.__table__.indexes:
+        index.create(connection)
+    connection.execute(text("ANALYZE messages"))
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Manage the monthly partitions of the messages table."
+    )
+    parser.add_argument('command', choices=["migrate", "ensure"])
+    parser.add_argument('--months-ahead', type=int,
+                        default=PARTITION_MONTHS_AHEAD)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    args = parse_args()
+    with app.app_context():
+        connection = db.session.connection()
+        if args.command == "migrate":
+            if migrate(connection):
+                print("messages is now partitioned by month")
+            else:
+                print("nothing to migrate")
+        created = ensure_partitions(connection,
+                                    months_ahead=args.months_ahead)
+        db.session.commit()
+    print(f"Created {created} partitions")
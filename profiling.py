@@ -0,0 +1,306 @@
+"""Opt-in per-request profiling.
+
+A request is profiled when either
+    - it sends `X-Profile: 1` with an admin JWT, or
+    - it is picked by random sampling (PROFILE_SAMPLE_RATE, 0 disables).
+
+The whole request (view, ORM hydration, serialize, JSON encoding) runs under
+cProfile, or pyinstrument when PROFILER=pyinstrument and it is installed.
+The result is saved as folded stacks ("a;b;c <microseconds>" per line),
+which flamegraph.pl, speedscope and inferno all read, keyed by the request
+id that is returned in the X-Request-ID response header. That id is always
+generated here, so one request can't overwrite another's profile; an
+X-Request-ID the client sent is kept in the profile's metadata as
+client_request_id, for correlating with its own logs.
+
+Profiles are written to PROFILE_DIR so every worker on the host can serve
+them; only the newest PROFILE_KEEP are kept. Admins fetch them from
+GET /admin/profiles and GET /admin/profiles/<request_id>.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+
+from flask import Response, abort, g, jsonify, request
+
+from auth import admin_required, is_admin_request
+
+PROFILE_HEADER = "X-Profile"
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Paths deeper than this are truncated when flattening cProfile output.
+MAX_STACK_DEPTH = 64
+# Stacks cheaper than this (in seconds) are left out of the folded output.
+MIN_STACK_TIME = 1e-6
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def _frame_label(func):
+    """ Folded-stack label for a pstats (file, line, name) key. """
+
+    filename, line, name = func
+    if filename == "~":
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ":")
+
+
+def folded_from_cprofile(profile):
+    """ Flatten a cProfile run into folded stacks.
+
+        cProfile only records caller -> callee edges, not whole stacks, so
+        each callee's time is split between its callers in proportion to
+        the time it spent under each of them.
+    """
+
+    stats = pstats.Stats(profile).stats
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, {})[func] = edge
+
+    lines = {}
+
+    def walk(func, path, inclusive):
+        _, _, total_tt, total_ct, _ = stats[func]
+        ratio = inclusive / total_ct if total_ct else 0.0
+        key = ";".join(_frame_label(frame) for frame in path)
+        self_time = total_tt * ratio
+        if self_time >= MIN_STACK_TIME:
+            lines[key] = lines.get(key, 0.0) + self_time
+        if len(path) >= MAX_STACK_DEPTH:
+            return
+        for child, (_, _, _, edge_ct) in callees.get(func, {}).items():
+            child_time = edge_ct * ratio
+            if child in path or child_time < MIN_STACK_TIME:
+                continue
+            walk(child, path + [child], child_time)
+
+    for func, (_, _, _, total_ct, callers) in stats.items():
+        if not callers:
+            walk(func, [func], total_ct)
+
+    return _render_folded(lines)
+
+
+def folded_from_pyinstrument(session):
+    """ Flatten a pyinstrument session's call tree into folded stacks. """
+
+    lines = {}
+
+    def walk(frame, path):
+        label = f"{frame.function} ({frame.file_path_short}:{frame.line_no})"
+        path = path + [label.replace(";", ":")]
+        if frame.self_time >= MIN_STACK_TIME:
+            key = ";".join(path)
+            lines[key] = lines.get(key, 0.0) + frame.self_time
+        for child in frame.children:
+            walk(child, path)
+
+    root = session.root_frame()
+    if root is not None:
+        walk(root, [])
+    return _render_folded(lines)
+
+
+def _render_folded(lines):
+    return "".join(
+        f"{stack} {max(int(seconds * 1e6), 1)}\n"
+        for stack, seconds in sorted(lines.items())
+    )
+
+
+class CProfileProfiler:
+    name = "cprofile"
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        return folded_from_cprofile(self._profile)
+
+
+class PyinstrumentProfiler:
+    name = "pyinstrument"
+
+    def __init__(self):
+        from pyinstrument import Profiler
+        self._profiler = Profiler(interval=0.0005)
+
+    def start(self):
+        self._profiler.start()
+
+    def stop(self):
+        self._profiler.stop()
+        return folded_from_pyinstrument(self._profiler.last_session)
+
+
+def _make_profiler(app):
+    if app.config.get("PROFILER") == "pyinstrument":
+        try:
+            return PyinstrumentProfiler()
+        except ImportError:
+            pass
+    return CProfileProfiler()
+
+
+class ProfileStore:
+    """ Profiles on disk: <id>.folded plus <id>.json metadata. """
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+
+    def _path(self, request_id, ext):
+        return os.path.join(self.directory, f"{request_id}.{ext}")
+
+    def save(self, request_id, folded, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(request_id, "folded"), "w") as folded_file:
+            folded_file.write(folded)
+        with open(self._path(request_id, "json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+        self._prune()
+
+    def _prune(self):
+        metas = sorted(
+            (entry for entry in os.scandir(self.directory)
+             if entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in metas[self.keep:]:
+            request_id = entry.name[:-len(".json")]
+            for ext in ("json", "folded"):
+                try:
+                    os.remove(self._path(request_id, ext))
+                except FileNotFoundError:
+                    pass
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        metas = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as meta_file:
+                    metas.append(json.load(meta_file))
+            except (OSError, ValueError):
+                continue
+        return sorted(metas, key=lambda meta: meta["started_at"],
+                      reverse=True)
+
+    def get(self, request_id):
+        try:
+            with open(self._path(request_id, "folded")) as folded_file:
+                return folded_file.read()
+        except FileNotFoundError:
+            return None
+
+
+def _should_profile(app):
+    if request.headers.get(PROFILE_HEADER) == "1" and is_admin_request():
+        return True
+    rate = app.config.get("PROFILE_SAMPLE_RATE") or 0
+    return rate > 0 and random.random() < rate
+
+
+def _start_request(app):
+    g.request_id = uuid.uuid4().hex
+    client_request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if _REQUEST_ID_RE.match(client_request_id):
+        g.client_request_id = client_request_id
+
+    if _should_profile(app):
+        g._profiler = _make_profiler(app)
+        g._profile_started = time.time()
+        g._profiler.start()
+
+
+def _finish_request(app, store, response):
+    response.headers[REQUEST_ID_HEADER] = g.get("request_id", "")
+
+    profiler = g.pop("_profiler", None)
+    if profiler is None:
+        return response
+
+    folded = profiler.stop()
+    started = g.pop("_profile_started")
+    store.save(g.request_id, folded, {
+        "request_id": g.request_id,
+        "client_request_id": g.get("client_request_id"),
+        "method": request.method,
+        "path": request.full_path.rstrip("?"),
+        "status": response.status_code,
+        "duration_ms": round((time.time() - started) * 1000, 3),
+        "profiler": profiler.name,
+        "started_at": started,
+    })
+    return response
+
+
+def _teardown_request(exc):
+    """ Make sure a request that blew up doesn't leave a profiler running. """
+
+    profiler = g.pop("_profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+def init_profiling(app):
+    """ Install the profiling hooks and admin endpoints on `app`. """
+
+    store = ProfileStore(
+        app.config["PROFILE_DIR"], app.config["PROFILE_KEEP"]
+    )
+
+    app.before_request(lambda: _start_request(app))
+    app.after_request(lambda response: _finish_request(app, store, response))
+    app.teardown_request(_teardown_request)
+
+    @app.route("/admin/profiles")
+    @admin_required
+    def profiles_list():
+        """ List stored profiles, newest first.
+            Returns => { profiles: [{
+                            request_id,
+                            client_request_id,
+                            method,
+                            path,
+                            status,
+                            duration_ms,
+                            profiler,
+                            started_at,
+                            }, ...] }
+            Auth required: admin
+        """
+
+        return (jsonify(profiles=store.list()), 200)
+
+    @app.route("/admin/profiles/<request_id>")
+    @admin_required
+    def profile_show(request_id):
+        """ Folded stacks for one profiled request, as text/plain.
+            Auth required: admin
+        """
+
+        if not _REQUEST_ID_RE.match(request_id):
+            abort(404)
+        folded = store.get(request_id)
+        if folded is None:
+            abort(404)
+        return Response(folded, mimetype="text/plain")
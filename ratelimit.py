@@ -0,0 +1,332 @@
+"""Admission control: token-bucket rate limits and concurrency limits.
+
+Every request is checked before its view runs, cheapest rejection first:
+
+    1. token buckets for its route: one per caller (per-user: the JWT
+       identity, or the client address for unauthenticated routes such as
+       /login), then one shared by all callers (per-route), which only
+       callers within their own limit draw on. An empty bucket answers 429
+       with Retry-After set to when the next token arrives.
+    2. concurrency: at most MAX_CONCURRENT_REQUESTS requests in the worker
+       at once, and at most the route's own `concurrency` (so a burst of
+       bcrypt logins can't occupy every thread a cheap listing_show needs).
+       A request over either limit answers 503 with Retry-After at once,
+       instead of queueing behind the ones already running.
+
+Limits are configured per endpoint in RATE_LIMITS (see DEFAULT_LIMITS;
+"*" applies to endpoints without their own entry). Each Limit field left
+as None is not enforced.
+
+Buckets live in this worker's memory by default, so with several workers
+each allows the configured rate. To share them, install a StoreBackend over
+a store every worker can reach (anything with `get` and an atomic
+`compare_and_set`, e.g. Redis with WATCH/MULTI); RATE_LIMIT_BACKEND =
+"local" runs the same code path over LocalStore, an in-process fake.
+Concurrency limits are always per worker.
+
+Decisions are counted per route in sharebnb_admission_total.
+"""
+
+import json
+import math
+import threading
+import time
+
+from flask import g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request_optional
+
+from metrics import _route_label, registry
+
+registry.register(
+    "sharebnb_admission_total", "counter",
+    "Admission decisions by route: admitted, or the limit that refused it.",
+)
+
+# Seconds a refused request is told to wait when no bucket says otherwise.
+DEFAULT_RETRY_AFTER = 1
+# Buckets untouched for this long are full again and get dropped.
+IDLE_BUCKET_SECONDS = 10 * 60
+SWEEP_EVERY = 10000
+# Never limited: the scrape and readiness endpoints have to answer while
+# the app sheds.
+EXEMPT_ENDPOINTS = {"static", "metrics", "ready"}
+# WSGI environ key set on requests the app makes to itself (see warmup.py),
+# which skip admission control.
+INTERNAL_REQUEST = "sharebnb.internal"
+
+
+class Limit:
+    """ Limits for one endpoint. Rates are tokens per second; bursts are
+        bucket sizes.
+    """
+
+    FIELDS = ("route_rate", "route_burst", "user_rate", "user_burst",
+              "concurrency")
+
+    def __init__(self, route_rate=None, route_burst=None, user_rate=None,
+                 user_burst=None, concurrency=None):
+        self.route_rate = route_rate
+        self.route_burst = route_burst or route_rate
+        self.user_rate = user_rate
+        self.user_burst = user_burst or user_rate
+        self.concurrency = concurrency
+
+    def updated(self, overrides):
+        values = {field: getattr(self, field) for field in self.FIELDS}
+        values.update(overrides)
+        return Limit(**values)
+
+
+DEFAULT_LIMITS = {
+    "*": Limit(user_rate=50, user_burst=200),
+    # bcrypt makes these the most expensive routes by far.
+    "login": Limit(route_rate=20, route_burst=40,
+                   user_rate=10 / 60, user_burst=10, concurrency=4),
+    "signup": Limit(route_rate=5, route_burst=10,
+                    user_rate=5 / 60, user_burst=5, concurrency=2),
+    "listings_list": Limit(user_rate=5, user_burst=20, concurrency=8),
+    "listings_export": Limit(user_rate=1 / 60, user_burst=2, concurrency=2),
+    "listings_bulk_create": Limit(user_rate=1 / 60, user_burst=2,
+                                  concurrency=2),
+}
+
+
+def limits_from_json(value):
+    """ DEFAULT_LIMITS with the overrides in a JSON object of
+        {endpoint: {field: value}}.
+    """
+
+    limits = dict(DEFAULT_LIMITS)
+    for endpoint, overrides in json.loads(value).items():
+        limits[endpoint] = limits.get(endpoint, Limit()).updated(overrides)
+    return limits
+
+
+def _refill(tokens, updated, rate, burst, now):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def _take(tokens, rate):
+    """ (tokens left, seconds to wait) after trying to take one token. """
+
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryBackend:
+    """ Token buckets in this process. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [tokens, updated]
+        self._buckets = {}
+        self._calls = 0
+
+    def take(self, key, rate, burst):
+        """ Take a token from bucket `key`. Returns 0 if one was taken,
+            otherwise the seconds until one will be there.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            tokens = burst if bucket is None else _refill(
+                bucket[0], bucket[1], rate, burst, now
+            )
+            tokens, wait = _take(tokens, rate)
+            self._buckets[key] = [tokens, now]
+            self._calls += 1
+            if self._calls % SWEEP_EVERY == 0:
+                self._sweep(now)
+        return wait
+
+    def _sweep(self, now):
+        idle = [key for key, (_, updated) in self._buckets.items()
+                if now - updated > IDLE_BUCKET_SECONDS]
+        for key in idle:
+            del self._buckets[key]
+
+
+class LocalStore:
+    """ In-process stand-in for a shared key-value store. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._values.get(key)
+
+    def compare_and_set(self, key, expected, value, ttl):
+        """ Set `key` to `value` (expiring after `ttl` seconds) if it is
+            still `expected`. Returns whether it was set.
+        """
+
+        with self._lock:
+            if self._values.get(key) != expected:
+                return False
+            self._values[key] = value
+            return True
+
+
+class StoreBackend:
+    """ Token buckets in a store shared by every worker. Buckets are
+        (tokens, updated) pairs on the wall clock, updated with
+        compare-and-set so concurrent takes don't lose tokens.
+    """
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, store, prefix="ratelimit:"):
+        self.store = store
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        key = self.prefix + key
+        for _ in range(self.MAX_ATTEMPTS):
+            now = time.time()
+            stored = self.store.get(key)
+            tokens = burst if stored is None else _refill(
+                stored[0], stored[1], rate, burst, now
+            )
+            tokens, wait = _take(tokens, rate)
+            if self.store.compare_and_set(key, stored, (tokens, now),
+                                          ttl=IDLE_BUCKET_SECONDS):
+                return wait
+        # Too contended to tell; let the request through rather than fail.
+        return 0
+
+
+class ConcurrencyLimiter:
+    """ Counts requests in flight; refuses instead of waiting. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def _client_key():
+    try:
+        verify_jwt_in_request_optional()
+        identity = get_jwt_identity()
+    except Exception:
+        identity = None
+    if identity:
+        return f"user:{identity}"
+    return f"addr:{request.remote_addr}"
+
+
+def _refuse(status, retry_after, message):
+    response = jsonify(errors=[message])
+    response.status_code = status
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class Admission:
+    """ The admission checks for one app. """
+
+    def __init__(self, app, backend):
+        self.backend = backend
+        self.limits = app.config["RATE_LIMITS"]
+        self.global_limiter = ConcurrencyLimiter(
+            app.config["MAX_CONCURRENT_REQUESTS"]
+        ) if app.config["MAX_CONCURRENT_REQUESTS"] else None
+        self.route_limiters = {
+            endpoint: ConcurrencyLimiter(limit.concurrency)
+            for endpoint, limit in self.limits.items()
+            if limit.concurrency and endpoint != "*"
+        }
+
+    def _count(self, decision):
+        registry.inc("sharebnb_admission_total",
+                     (("route", _route_label()), ("decision", decision)))
+
+    def _throttled(self, endpoint, limit):
+        """ Seconds to wait if a bucket is empty, with the bucket kind.
+
+            The caller's own bucket is checked first, so a client over its
+            limit is refused without spending the route's shared tokens.
+        """
+
+        if limit.user_rate:
+            wait = self.backend.take(f"{endpoint}:{_client_key()}",
+                                     limit.user_rate, limit.user_burst)
+            if wait:
+                return wait, "user_rate"
+        if limit.route_rate:
+            wait = self.backend.take(f"route:{endpoint}",
+                                     limit.route_rate, limit.route_burst)
+            if wait:
+                return wait, "route_rate"
+        return 0, None
+
+    def before_request(self):
+        endpoint = request.endpoint
+        if (endpoint is None or endpoint in EXEMPT_ENDPOINTS
+                or request.environ.get(INTERNAL_REQUEST)):
+            return None
+        limit = self.limits.get(endpoint) or self.limits.get("*")
+        if limit is None:
+            return None
+
+        wait, kind = self._throttled(endpoint, limit)
+        if wait:
+            self._count(kind)
+            return _refuse(429, wait, "Too many requests")
+
+        acquired = []
+        for name, limiter in (("concurrency", self.global_limiter),
+                              ("route_concurrency",
+                               self.route_limiters.get(endpoint))):
+            if limiter is None:
+                continue
+            if not limiter.try_acquire():
+                for held in acquired:
+                    held.release()
+                self._count(name)
+                return _refuse(503, DEFAULT_RETRY_AFTER,
+                               "Server busy, retry shortly")
+            acquired.append(limiter)
+
+        g._admission_held = acquired
+        self._count("admitted")
+        return None
+
+    def teardown_request(self, exc):
+        for limiter in g.pop("_admission_held", ()):
+            limiter.release()
+
+
+def init_rate_limits(app, backend=None):
+    """ Check every request against RATE_LIMITS before its view runs.
+        `backend` defaults to RATE_LIMIT_BACKEND ("memory" or "local").
+    """
+
+    if not app.config["RATE_LIMITS_ENABLED"]:
+        return None
+    if backend is None:
+        if app.config["RATE_LIMIT_BACKEND"] == "local":
+            backend = StoreBackend(LocalStore())
+        else:
+            backend = MemoryBackend()
+
+    admission = Admission(app, backend)
+    app.extensions["admission"] = admission
+    app.before_request(admission.before_request)
+    app.teardown_request(admission.teardown_request)
+    return admission
@@ -0,0 +1,336 @@
+"""Soft deletes, and the background reaper that purges them.
+
+Deleting a user or listing through the API only stamps `deleted_at`, which
+is one small UPDATE and returns immediately; every read query filters
+deleted rows out (see User.live, Listing.live and Message.live). Deleting a
+user also soft-deletes their listings with one UPDATE, without loading them
+or their messages.
+
+The reaper then removes the rows for real, in bounded batches, each in its
+own short transaction:
+    1. messages (hot and archived) about deleted listings, or from/to
+       deleted users
+    2. rentals by deleted users (rented_by is cleared)
+    3. deleted listings with no messages left, with their photos' S3 objects
+    4. deleted users with nothing left pointing at them, with their images
+
+so no step ever cascades over an unbounded number of rows or holds locks
+for long. It also deletes images nothing references any more from S3
+(see image_store.py), clears out expired idempotency keys (see
+idempotency.py), old change log entries (see sync.py) and published
+outbox events (see outbox.py), and keeps the coming months' message
+partitions created (see partitions.py). Run it next to the web workers:
+
+    python reaper.py            # poll forever
+    python reaper.py --once     # one batch of each step, then exit
+"""
+
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import exists, or_
+
+from image_store import purge_unreferenced, release_key, release_object
+from partitions import PARTITION_CHECK_INTERVAL, ensure_partitions
+from models import (
+    db, User, Listing, ListingPhoto, Message, ArchivedMessage, ChangeLog,
+    IdempotencyKey, OutboxEvent
+)
+from outbox import OUTBOX_RETENTION
+from stats import STATS_COLUMNS, record_listings
+from sync import CHANGE_LOG_RETENTION
+from upload_functions import delete_prefix
+
+logger = logging.getLogger(__name__)
+
+REAP_BATCH_SIZE = 500
+REAP_INTERVAL = 10
+
+
+def soft_delete_listing(listing):
+    """ Mark a listing deleted. Nothing is committed here. """
+
+    listing.deleted_at = datetime.utcnow()
+
+
+def soft_delete_user(user):
+    """ Mark a user and all their live listings deleted.
+
+        The listings are updated with a single statement; their rows are
+        locked first so the area statistics are adjusted for exactly the
+        listings being hidden. Nothing is committed here.
+    """
+
+    now = datetime.utcnow()
+    user.deleted_at = now
+
+    listings = Listing.live().filter(Listing.created_by == user.username)
+    hidden = listings.with_entities(
+        Listing.id, *(getattr(Listing, column) for column in STATS_COLUMNS)
+    ).with_for_update().all()
+    record_listings(hidden, sign=-1)
+    ChangeLog.record(db.session.connection(), "listing", [
+        {"object_id": listing.id, "deleted": True} for listing in hidden
+    ])
+    OutboxEvent.record(db.session.connection(), "listing.deleted", [
+        {"aggregate_id": listing.id, "payload": {"id": listing.id}}
+        for listing in hidden
+    ])
+    listings.update({Listing.deleted_at: now}, synchronize_session=False)
+
+
+def _deleted_listing_ids():
+    return db.session.query(Listing.id).filter(Listing.deleted_at.isnot(None))
+
+
+def _deleted_usernames():
+    return db.session.query(User.username).filter(User.deleted_at.isnot(None))
+
+
+def _purge_hidden_messages(model, batch_size):
+    deleted_users = _deleted_usernames()
+    messages = db.session.query(
+        model.id, model.from_user, model.to_user
+    ).filter(or_(
+        model.listing_id.in_(_deleted_listing_ids()),
+        model.from_user.in_(deleted_users),
+        model.to_user.in_(deleted_users),
+    )).limit(batch_size).all()
+    if messages:
+        model.query.filter(
+            model.id.in_([message.id for message in messages])
+        ).delete(synchronize_session=False)
+        ChangeLog.record(db.session.connection(), "message", [
+            {
+                "object_id": message.id,
+                "deleted": True,
+                "from_user": message.from_user,
+                "to_user": message.to_user,
+            }
+            for message in messages
+        ])
+    return len(messages)
+
+
+def purge_messages(batch_size):
+    """ Delete up to `batch_size` messages, and as many archived messages,
+        hidden by a soft delete.
+    """
+
+    purged = _purge_hidden_messages(Message, batch_size)
+    purged += _purge_hidden_messages(ArchivedMessage, batch_size)
+    db.session.commit()
+    return purged
+
+
+def release_rentals(batch_size):
+    """ Clear rented_by on up to `batch_size` listings rented by deleted
+        users, so purging the user doesn't cascade to the listing.
+    """
+
+    listings = Listing.query.filter(
+        Listing.rented_by.in_(_deleted_usernames())
+    ).limit(batch_size).all()
+    for listing in listings:
+        # Through the ORM, so the occupancy stats see the change.
+        listing.rented_by = None
+    db.session.commit()
+    return len(listings)
+
+
+def purge_listings(batch_size, bucket):
+    """ Delete up to `batch_size` deleted listings whose messages are gone,
+        releasing the S3 objects behind their photos. Objects are only
+        deleted from S3 after the rows' deletion commits (see
+        image_store.py).
+    """
+
+    ids = [
+        listing_id for (listing_id,) in
+        _deleted_listing_ids().filter(
+            ~exists().where(Message.listing_id == Listing.id),
+            ~exists().where(ArchivedMessage.listing_id == Listing.id),
+        ).limit(batch_size)
+    ]
+    if not ids:
+        return 0
+
+    photos = ListingPhoto.query.filter(ListingPhoto.listing_id.in_(ids))
+    keys = [photo.object_name for photo in photos]
+    photos.delete(synchronize_session=False)
+    Listing.query.filter(Listing.id.in_(ids)).delete(
+        synchronize_session=False
+    )
+    for key in keys:
+        release_key(key, bucket)
+    db.session.commit()
+    return len(ids)
+
+
+def purge_users(batch_size, bucket):
+    """ Delete up to `batch_size` deleted users that nothing references any
+        more, along with their profile images and direct uploads, which
+        are deleted from S3 only after the rows' deletion commits.
+    """
+
+    users = db.session.query(User.username, User.image_key).filter(
+        User.deleted_at.isnot(None),
+        ~exists().where(Listing.created_by == User.username),
+        ~exists().where(Listing.rented_by == User.username),
+        ~exists().where(Message.from_user == User.username),
+        ~exists().where(Message.to_user == User.username),
+        ~exists().where(ArchivedMessage.from_user == User.username),
+        ~exists().where(ArchivedMessage.to_user == User.username),
+    ).limit(batch_size).all()
+    if not users:
+        return 0
+
+    usernames = [username for username, _ in users]
+    User.query.filter(User.username.in_(usernames)).delete(
+        synchronize_session=False
+    )
+    for _, image_key in users:
+        release_object(image_key)
+    db.session.commit()
+    # Only once the rows are gone: at worst a failure here orphans uploads.
+    for username in usernames:
+        delete_prefix(bucket, f"uploads/{username}/user/")
+    return len(users)
+
+
+def purge_idempotency_keys(batch_size):
+    """ Delete up to `batch_size` expired idempotency keys. """
+
+    key_hashes = [
+        key_hash for (key_hash,) in
+        db.session.query(IdempotencyKey.key_hash).filter(
+            IdempotencyKey.expires_at <= datetime.utcnow()
+        ).limit(batch_size)
+    ]
+    if key_hashes:
+        IdempotencyKey.query.filter(
+            IdempotencyKey.key_hash.in_(key_hashes)
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return len(key_hashes)
+
+
+def create_partitions():
+    """ Create any missing message partitions for the coming months.
+        Returns False if that failed.
+    """
+
+    try:
+        created = ensure_partitions(db.session.connection())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("creating message partitions failed")
+        return False
+    if created:
+        logger.info("created %s message partitions", created)
+    return True
+
+
+def purge_change_log(batch_size):
+    """ Delete up to `batch_size` change log entries older than
+        CHANGE_LOG_RETENTION. Clients with older sync tokens resync fully.
+    """
+
+    cutoff = datetime.utcnow() - CHANGE_LOG_RETENTION
+    ids = [
+        entry_id for (entry_id,) in
+        db.session.query(ChangeLog.id).filter(
+            ChangeLog.changed_at < cutoff
+        ).order_by(ChangeLog.id).limit(batch_size)
+    ]
+    if ids:
+        ChangeLog.query.filter(ChangeLog.id.in_(ids)).delete(
+            synchronize_session=False
+        )
+    db.session.commit()
+    return len(ids)
+
+
+def purge_outbox(batch_size):
+    """ Delete up to `batch_size` outbox events published longer than
+        OUTBOX_RETENTION ago.
+    """
+
+    cutoff = datetime.utcnow() - OUTBOX_RETENTION
+    ids = [
+        event_id for (event_id,) in
+        db.session.query(OutboxEvent.id).filter(
+            OutboxEvent.published_at < cutoff
+        ).limit(batch_size)
+    ]
+    if ids:
+        OutboxEvent.query.filter(OutboxEvent.id.in_(ids)).delete(
+            synchronize_session=False
+        )
+    db.session.commit()
+    return len(ids)
+
+
+def reap_once(bucket, batch_size=REAP_BATCH_SIZE):
+    """ Run one batch of every purge step. Returns rows purged per step. """
+
+    return {
+        "messages": purge_messages(batch_size),
+        "rentals": release_rentals(batch_size),
+        "listings": purge_listings(batch_size, bucket),
+        "users": purge_users(batch_size, bucket),
+        "objects": purge_unreferenced(bucket, batch_size),
+        "idempotency_keys": purge_idempotency_keys(batch_size),
+        "change_log": purge_change_log(batch_size),
+        "outbox": purge_outbox(batch_size),
+    }
+
+
+def run(bucket, batch_size=REAP_BATCH_SIZE, interval=REAP_INTERVAL):
+    """ Reap forever, sleeping `interval` seconds whenever idle. """
+
+    partitions_checked = None
+    while True:
+        if (partitions_checked is None or time.monotonic()
+                - partitions_checked >= PARTITION_CHECK_INTERVAL):
+            if create_partitions():
+                partitions_checked = time.monotonic()
+
+        try:
+            purged = reap_once(bucket, batch_size)
+        except Exception:
+            db.session.rollback()
+            logger.exception("reaper batch failed")
+            purged = {}
+
+        if any(purged.values()):
+            logger.info("reaped %s", purged)
+        else:
+            time.sleep(interval)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Purge soft-deleted users and listings."
+    )
+    parser.add_argument('--once', action='store_true',
+                        help="run one batch of each step and exit")
+    parser.add_argument('--batch-size', type=int, default=REAP_BATCH_SIZE)
+    parser.add_argument('--interval', type=float, default=REAP_INTERVAL,
+                        help="seconds to sleep when there is nothing to do")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from app import app, BUCKET
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with app.app_context():
+        if args.once:
+            print(reap_once(BUCKET, args.batch_size))
+        else:
+            run(BUCKET, args.batch_size, args.interval)
@@ -0,0 +1,270 @@
+"""Validation and coercion of request input.
+
+Each schema maps the keys of a JSON body (or a query string, or a bulk
+import row) to a Field. A Schema is compiled once, at import, into one
+checking function per field, so validating a request is a dict walk of a
+few microseconds:
+
+    values, errors = LISTING_CREATE.validate(request.json.get("listing"))
+    if errors:
+        return errors_response(errors)
+
+`values` holds the coerced value of every field present in the input
+(absent and empty optional fields are left out); `errors` is a flat list of
+messages in field order, which is what every route returns as
+{ errors: [...] }.
+
+Values arriving as strings (query strings, multipart forms, CSV rows) are
+coerced to the field's type; JSON values already of that type are taken as
+they are.
+"""
+
+import math
+from decimal import Decimal, InvalidOperation
+
+from email_validator import EmailNotValidError, validate_email
+from flask import jsonify
+
+REQUIRED = "This field is required."
+NOT_AN_OBJECT = "Expected an object."
+
+
+class Invalid(ValueError):
+    """ Raised by a field check with the message to report. """
+
+
+def _string(value):
+    if not isinstance(value, str):
+        raise Invalid("Not a valid string value")
+    return value
+
+
+def _integer(value):
+    """ Integers; JSON numbers are truncated, as int() does: 2.5 is 2. """
+
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float) and math.isfinite(value):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    raise Invalid("Not a valid integer value")
+
+
+def _truncated_integer(value):
+    """ Integers, also from decimal strings: "2.5" is 2. """
+
+    if isinstance(value, str):
+        value = value.split(".")[0]
+    return _integer(value)
+
+
+def _float(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        result = float(value)
+    elif isinstance(value, str):
+        try:
+            result = float(value)
+        except ValueError:
+            raise Invalid("Not a valid float value")
+    else:
+        raise Invalid("Not a valid float value")
+    if not math.isfinite(result):
+        raise Invalid("Not a valid float value")
+    return result
+
+
+def _decimal(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise Invalid("Not a valid decimal value")
+    try:
+        result = Decimal(str(value))
+    except InvalidOperation:
+        raise Invalid("Not a valid decimal value")
+    if not result.is_finite():
+        raise Invalid("Not a valid decimal value")
+    return result
+
+
+def min_length(length):
+    def check(value):
+        if len(value) < length:
+            raise Invalid(f"Field must be at least {length} characters long.")
+    return check
+
+
+def email(value):
+    try:
+        validate_email(value, check_deliverability=False)
+    except EmailNotValidError:
+        raise Invalid("Invalid email address.")
+
+
+class Field:
+    """ One key of a schema: how its value is coerced, whether it must be
+        present and truthy (so 0 is missing for a required number, and so
+        is a blank string), and any further checks on the coerced value.
+    """
+
+    def __init__(self, required=False, checks=()):
+        self.required = required
+        self.checks = tuple(checks)
+
+    def compile(self):
+        """ A function taking the raw value and returning the coerced value,
+            or None for an absent optional field; raises Invalid.
+        """
+
+        coerce = self.coerce
+        required = self.required
+        checks = self.checks
+
+        def check(value):
+            if value is None or value == "":
+                if required:
+                    raise Invalid(REQUIRED)
+                return None
+            value = coerce(value)
+            if required and (
+                not value or isinstance(value, str) and not value.strip()
+            ):
+                raise Invalid(REQUIRED)
+            for extra in checks:
+                extra(value)
+            return value
+
+        return check
+
+
+class StringField(Field):
+    coerce = staticmethod(_string)
+
+
+class IntegerField(Field):
+    coerce = staticmethod(_integer)
+
+    def __init__(self, truncate=False, **kwargs):
+        super().__init__(**kwargs)
+        if truncate:
+            self.coerce = _truncated_integer
+
+
+class FloatField(Field):
+    coerce = staticmethod(_float)
+
+
+class DecimalField(Field):
+    coerce = staticmethod(_decimal)
+
+
+class Schema:
+    """ A compiled set of fields. """
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self._checks = tuple(
+            (name, field.compile()) for name, field in fields.items()
+        )
+
+    def validate(self, data):
+        """ Returns (values, errors) for the mapping `data`; None counts as
+            an empty body.
+        """
+
+        if data is None:
+            data = {}
+        elif not hasattr(data, "get"):
+            return {}, [NOT_AN_OBJECT]
+
+        values = {}
+        errors = []
+        for name, check in self._checks:
+            try:
+                value = check(data.get(name))
+            except Invalid as e:
+                errors.append(str(e))
+                continue
+            if value is not None:
+                values[name] = value
+        return values, errors
+
+
+def errors_response(errors, status=400):
+    """ The response for input that failed validation. """
+
+    return (jsonify(errors=errors), status)
+
+
+USER_SIGNUP = Schema(
+    username=StringField(required=True),
+    first_name=StringField(required=True),
+    last_name=StringField(required=True),
+    email=StringField(required=True, checks=[email]),
+    password=StringField(required=True, checks=[min_length(6)]),
+    location=StringField(),
+)
+
+USER_LOGIN = Schema(
+    username=StringField(required=True),
+    password=StringField(required=True, checks=[min_length(6)]),
+)
+
+USER_EDIT = Schema(
+    bio=StringField(),
+    first_name=StringField(),
+    last_name=StringField(),
+    email=StringField(required=True, checks=[email]),
+    password=StringField(required=True, checks=[min_length(6)]),
+    location=StringField(),
+)
+
+MESSAGE_CREATE = Schema(
+    body=StringField(required=True),
+    to_user=StringField(required=True),
+    from_user=StringField(required=True),
+    listing_id=IntegerField(required=True),
+)
+
+MESSAGE_BROADCAST = Schema(
+    body=StringField(required=True),
+)
+
+LISTING_CREATE = Schema(
+    title=StringField(required=True),
+    description=StringField(),
+    photo=StringField(),
+    price=DecimalField(required=True),
+    longitude=FloatField(required=True),
+    latitude=FloatField(required=True),
+    beds=IntegerField(required=True),
+    rooms=IntegerField(required=True),
+    bathrooms=IntegerField(required=True),
+    created_by=StringField(required=True),
+)
+
+LISTING_EDIT = Schema(
+    title=StringField(),
+    description=StringField(),
+    photo=StringField(),
+    price=DecimalField(),
+    longitude=FloatField(),
+    latitude=FloatField(),
+    beds=IntegerField(),
+    rooms=IntegerField(),
+    bathrooms=IntegerField(),
+    created_by=StringField(),
+    rented_by=StringField(),
+)
+
+# Query string of GET /listings and /listings/export. Beds and bathrooms
+# may come from a slider as "2.0".
+LISTING_SEARCH = Schema(
+    max_price=IntegerField(),
+    longitude=FloatField(),
+    latitude=FloatField(),
+    beds=IntegerField(truncate=True),
+    bathrooms=IntegerField(truncate=True),
+)
@@ -1,19 +1,50 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+    python seed.py               # the small CSVs checked into generator/
+    python seed.py /tmp/data     # CSVs written by generator/synthetic.py
+
+Rows are streamed in batches, so large generated CSVs load in bounded memory.
+"""
+
+import os
+import sys
 from csv import DictReader
+from itertools import islice
+
 from app import db
 from models import User, Listing, Message
+import clusters
+import stats
+
+SEED_BATCH_SIZE = 10000
+
+csv_dir = sys.argv[1] if len(sys.argv) > 1 else 'generator'
+
+
+def load_csv(model, filename):
+    """ Insert every row of `filename` as `model`, one batch at a time. """
+
+    with open(os.path.join(csv_dir, filename)) as csv_file:
+        rows = DictReader(csv_file)
+        while True:
+            batch = list(islice(rows, SEED_BATCH_SIZE))
+            if not batch:
+                break
+            db.session.bulk_insert_mappings(model, batch)
+            db.session.flush()
+
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+load_csv(User, 'users.csv')
+load_csv(Listing, 'listings.csv')
+load_csv(Message, 'messages.csv')
 
-with open('generator/listings.csv') as listings:
-    db.session.bulk_insert_mappings(Listing, DictReader(listings))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+# Bulk inserts skip the ORM events that maintain the area statistics.
+stats.rebuild()
 
 db.session.commit()
+
+# CSV rows don't carry geo cells.
+clusters.backfill_all()
@@ -0,0 +1,397 @@
+"""Nearest-neighbour "similar listings".
+
+Each listing is a point in feature space:
+    log price, beds, rooms, bathrooms, latitude, longitude
+with every feature divided by its standard deviation across all listings
+and multiplied by FEATURE_WEIGHTS, so no single unit dominates the
+distance.
+
+Every worker holds a SimilarityIndex in memory: a KD-tree over all points
+(built with NumPy, leaves scanned as vectorized blocks), plus a small
+buffer of points added or changed since the tree was built, scanned by
+brute force. Changed and removed listings are tombstoned in the tree
+rather than rebuilding it; once the buffer reaches a fraction of the tree
+the two are compacted into a new tree from the points already in memory.
+
+Workers learn about changes by polling `listings.updated_at` at most every
+SIMILAR_REFRESH_SECONDS, so a change made through any worker shows up in
+all of them within that interval, without rescanning the table. A soft
+delete is a change like any other and removes the listing. Rows deleted
+outright don't show up in that poll; their ids are dropped when the
+matching live rows are fetched, and the tree forgets them at the next full
+reload (every SIMILAR_RELOAD_SECONDS).
+"""
+
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from flask import jsonify, request
+from flask_jwt_extended import jwt_required
+
+from metrics import timed
+from models import db, Listing
+
+FEATURE_COLUMNS = ("price", "beds", "rooms", "bathrooms",
+                   "latitude", "longitude")
+FEATURE_WEIGHTS = np.array([2.0, 1.0, 0.5, 1.0, 1.5, 1.5])
+
+LEAF_SIZE = 64
+# Compact the buffer into the tree once it holds this fraction of the tree.
+COMPACT_RATIO = 0.05
+MIN_COMPACT_SIZE = 256
+
+DEFAULT_SIMILAR = 10
+MAX_SIMILAR = 50
+# Candidates fetched beyond k, to make up for rows deleted since indexing.
+OVERFETCH = 10
+
+LOAD_CHUNK_SIZE = 10000
+# Re-read rows this far behind the newest `updated_at` seen, so slow
+# transactions that commit an older timestamp late aren't missed.
+REFRESH_OVERLAP = timedelta(seconds=60)
+
+
+def raw_features(listing):
+    """ Unscaled feature vector of a listing (or a row of its columns). """
+
+    return np.array([
+        np.log1p(float(listing.price)),
+        listing.beds,
+        listing.rooms,
+        listing.bathrooms,
+        listing.latitude,
+        listing.longitude,
+    ], dtype=np.float64)
+
+
+class KDTree:
+    """ Static KD-tree over `points`, an (n, d) array.
+
+        Nodes are stored in flat lists. Points are reordered so that every
+        node covers a contiguous slice, which lets a leaf be scanned with a
+        single vectorized distance computation.
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE):
+        n = len(points)
+        order = np.arange(n)
+
+        starts, ends, dims, splits, lefts, rights = [], [], [], [], [], []
+
+        def new_node(start, end):
+            starts.append(start)
+            ends.append(end)
+            dims.append(-1)
+            splits.append(0.0)
+            lefts.append(-1)
+            rights.append(-1)
+            return len(starts) - 1
+
+        stack = [new_node(0, n)]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= leaf_size:
+                continue
+            idx = order[start:end]
+            block = points[idx]
+            dim = int(np.argmax(block.max(axis=0) - block.min(axis=0)))
+            mid = (start + end) // 2
+            part = np.argpartition(block[:, dim], mid - start)
+            order[start:end] = idx[part]
+            dims[node] = dim
+            splits[node] = float(points[order[mid], dim])
+            lefts[node] = new_node(start, mid)
+            rights[node] = new_node(mid, end)
+            stack.extend((lefts[node], rights[node]))
+
+        self.order = order
+        self.points = points[order]
+        self.starts = starts
+        self.ends = ends
+        self.dims = dims
+        self.splits = splits
+        self.lefts = lefts
+        self.rights = rights
+
+    def query(self, point, k, alive):
+        """ Squared distances and tree slots of the k nearest live points.
+
+            `alive` is a boolean array over tree slots; dead slots are
+            skipped. A subtree is pruned once its distance bound exceeds the
+            k-th best distance found so far.
+        """
+
+        coords = point.tolist()
+        all_alive = bool(alive.all())
+        best_d = np.empty(0)
+        best_slots = np.empty(0, dtype=np.int64)
+        worst = np.inf
+
+        # Each entry carries a lower bound on the distance to anything in
+        # the node, from the per-dimension offsets to the splitting planes
+        # crossed on the way down.
+        stack = [(0.0, 0, (0.0,) * len(coords))]
+        while stack:
+            bound, node, offsets = stack.pop()
+            if bound >= worst:
+                continue
+
+            dim = self.dims[node]
+            if dim == -1:
+                start, end = self.starts[node], self.ends[node]
+                diff = self.points[start:end] - point
+                dists = np.einsum("ij,ij->i", diff, diff)
+                if not all_alive:
+                    dists[~alive[start:end]] = np.inf
+                near = dists < worst
+                if not near.any():
+                    continue
+                best_d = np.concatenate((best_d, dists[near]))
+                best_slots = np.concatenate(
+                    (best_slots, np.arange(start, end)[near])
+                )
+                if len(best_d) > k:
+                    keep = np.argpartition(best_d, k - 1)[:k]
+                    best_d, best_slots = best_d[keep], best_slots[keep]
+                if len(best_d) == k:
+                    worst = best_d.max()
+                continue
+
+            gap = coords[dim] - self.splits[node]
+            if gap < 0:
+                near_child, far_child = self.lefts[node], self.rights[node]
+            else:
+                near_child, far_child = self.rights[node], self.lefts[node]
+            far_offsets = list(offsets)
+            far_offsets[dim] = gap
+            far_bound = bound - offsets[dim] ** 2 + gap * gap
+            # The near child is pushed last so it is visited first.
+            stack.append((far_bound, far_child, tuple(far_offsets)))
+            stack.append((bound, near_child, offsets))
+
+        ranked = np.argsort(best_d)
+        return best_d[ranked], best_slots[ranked]
+
+
+class SimilarityIndex:
+    """ A KD-tree of listings plus a brute-force buffer of recent changes. """
+
+    def __init__(self, ids, raw):
+        self._set_tree(np.asarray(ids, dtype=np.int64),
+                       np.asarray(raw, dtype=np.float64).reshape(-1, 6))
+        self.buffer = {}
+        self._buffer_ids = None
+        self._buffer_points = None
+
+    def _set_tree(self, ids, raw):
+        std = raw.std(axis=0) if len(raw) else np.ones(raw.shape[1])
+        std[std == 0] = 1.0
+        self.scale = FEATURE_WEIGHTS / std
+
+        self.tree = KDTree(raw * self.scale)
+        self.tree_ids = ids[self.tree.order]
+        self.tree_raw = raw[self.tree.order]
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.slot_of = {
+            int(listing_id): slot
+            for slot, listing_id in enumerate(self.tree_ids)
+        }
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.buffer)
+
+    def _current(self, listing_id):
+        if listing_id in self.buffer:
+            return self.buffer[listing_id]
+        slot = self.slot_of.get(listing_id)
+        if slot is not None and self.alive[slot]:
+            return self.tree_raw[slot]
+        return None
+
+    def upsert(self, listing_id, raw):
+        """ Add or move a listing. No-op if its features are unchanged. """
+
+        current = self._current(listing_id)
+        if current is not None and np.array_equal(current, raw):
+            return
+        self.remove(listing_id)
+        self.buffer[listing_id] = raw
+        self._buffer_ids = None
+        self._maybe_compact()
+
+    def remove(self, listing_id):
+        slot = self.slot_of.get(listing_id)
+        if slot is not None:
+            self.alive[slot] = False
+        if self.buffer.pop(listing_id, None) is not None:
+            self._buffer_ids = None
+
+    def _maybe_compact(self):
+        limit = max(MIN_COMPACT_SIZE, COMPACT_RATIO * len(self.tree_ids))
+        if len(self.buffer) < limit:
+            return
+
+        ids = np.concatenate((
+            self.tree_ids[self.alive],
+            np.fromiter(self.buffer.keys(), dtype=np.int64),
+        ))
+        raw = np.concatenate((
+            self.tree_raw[self.alive],
+            np.array(list(self.buffer.values())).reshape(-1, 6),
+        ))
+        self._set_tree(ids, raw)
+        self.buffer = {}
+        self._buffer_ids = None
+
+    def query(self, raw, k, exclude=None):
+        """ Ids of the k listings nearest to `raw`, nearest first. """
+
+        point = raw * self.scale
+        dists, slots = self.tree.query(point, k + 1, self.alive)
+        ids = self.tree_ids[slots]
+
+        if self.buffer:
+            if self._buffer_ids is None:
+                self._buffer_ids = np.fromiter(self.buffer.keys(),
+                                               dtype=np.int64)
+                self._buffer_points = np.array(
+                    list(self.buffer.values())
+                ).reshape(-1, 6) * self.scale
+            diff = self._buffer_points - point
+            buffer_d = np.einsum("ij,ij->i", diff, diff)
+            buffer_ids = self._buffer_ids
+            if len(buffer_d) > k + 1:
+                keep = np.argpartition(buffer_d, k)[:k + 1]
+                buffer_d, buffer_ids = buffer_d[keep], buffer_ids[keep]
+            dists = np.concatenate((dists, buffer_d))
+            ids = np.concatenate((ids, buffer_ids))
+
+        ranked = ids[np.argsort(dists, kind="stable")]
+        return [
+            int(listing_id) for listing_id in ranked
+            if listing_id != exclude
+        ][:k]
+
+
+class SimilarListings:
+    """ The worker's index, loaded lazily and kept fresh by polling. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.index = None
+        self.last_seen = None
+        self.refreshed_at = 0.0
+        self.loaded_at = 0.0
+
+    def _columns(self):
+        return [Listing.id, Listing.updated_at, Listing.deleted_at] + [
+            getattr(Listing, column) for column in FEATURE_COLUMNS
+        ]
+
+    def load(self):
+        """ Build the index from a full read of `listings`. """
+
+        ids = []
+        raw = []
+        last_seen = None
+        rows = (
+            db.session.query(*self._columns())
+            .yield_per(LOAD_CHUNK_SIZE)
+        )
+        for row in rows:
+            if last_seen is None or row.updated_at > last_seen:
+                last_seen = row.updated_at
+            if row.deleted_at is None:
+                ids.append(row.id)
+                raw.append(raw_features(row))
+
+        self.index = SimilarityIndex(ids, raw)
+        self.last_seen = last_seen
+        self.loaded_at = self.refreshed_at = time.monotonic()
+
+    def refresh(self):
+        """ Apply listings written since the last poll. """
+
+        query = db.session.query(*self._columns())
+        if self.last_seen is not None:
+            query = query.filter(
+                Listing.updated_at > self.last_seen - REFRESH_OVERLAP
+            )
+        for row in query.yield_per(LOAD_CHUNK_SIZE):
+            if row.deleted_at is None:
+                self.index.upsert(row.id, raw_features(row))
+            else:
+                self.index.remove(row.id)
+            if self.last_seen is None or row.updated_at > self.last_seen:
+                self.last_seen = row.updated_at
+        self.refreshed_at = time.monotonic()
+
+    def similar(self, listing, k, refresh_seconds, reload_seconds):
+        with self._lock:
+            now = time.monotonic()
+            if self.index is None or now - self.loaded_at >= reload_seconds:
+                self.load()
+            elif now - self.refreshed_at >= refresh_seconds:
+                self.refresh()
+            return self.index.query(
+                raw_features(listing), k + OVERFETCH, exclude=listing.id
+            )
+
+
+similar_listings = SimilarListings()
+
+
+def init_similar(app):
+    """ Add GET /listings/<id>/similar to `app`. """
+
+    @app.route("/listings/<int:listing_id>/similar")
+    @jwt_required
+    def listing_similar(listing_id):
+        """ Listings most like this one in price, size and location.
+            Optional query parameter k: how many (default 10, at most 50)
+            Returns => {
+                    listings: [
+                        {
+                            id,
+                            title,
+                            description,
+                            photo,
+                            price,
+                            longitude,
+                            latitude,
+                        },
+                        ...]
+                    }
+            Auth required: user logged in
+        """
+
+        try:
+            k = int(request.args.get("k", DEFAULT_SIMILAR))
+        except ValueError:
+            k = 0
+        if not 1 <= k <= MAX_SIMILAR:
+            errors = [f"k must be between 1 and {MAX_SIMILAR}"]
+            return (jsonify(errors=errors), 400)
+
+        listing = Listing.get_live_or_404(listing_id)
+        ids = similar_listings.similar(
+            listing,
+            k,
+            app.config["SIMILAR_REFRESH_SECONDS"],
+            app.config["SIMILAR_RELOAD_SECONDS"],
+        )
+
+        found = {
+            similar.id: similar
+            for similar in Listing.live().filter(Listing.id.in_(ids))
+        } if ids else {}
+        listings = [found[id] for id in ids if id in found][:k]
+
+        with timed("serialize"):
+            serialized = [similar.serialize(
+                            isDetailed=False
+                            ) for similar in listings]
+        return (jsonify(listings=serialized), 200)
@@ -0,0 +1,361 @@
+"""Incrementally maintained listing statistics per geo cell.
+
+Every listing counts towards one cell: the level-STATS_CELL_LEVEL quadkey
+of its coordinates (see geo.py, roughly 10km across). For each cell we keep
+    - listing_count, rented_count and price_sum (ListingCellStats), and
+    - a log-scale price histogram (ListingCellPriceBucket).
+
+The histogram is a mergeable quantile sketch: bucket i holds prices in
+(GAMMA^(i-1), GAMMA^i], so any quantile read back from it is within
+RELATIVE_ACCURACY of a true price. Because counts, sums and histograms all
+add up, coarser areas are served by merging the cells under a quadkey
+prefix.
+
+Only live listings are counted: soft-deleting a listing (setting
+`deleted_at`) removes it from the stats straight away.
+
+Mapper events on Listing apply each insert, update and delete as deltas in
+the same transaction, and the bulk import and user soft-delete call
+record_listings for the rows they write with Core. Anything else that
+writes `listings` without the ORM (seed.py, COPY, ON DELETE CASCADE from
+users) should be followed by `python stats.py` to rebuild the tables from
+scratch.
+"""
+
+import math
+from decimal import Decimal
+
+from flask import jsonify, request
+from flask_jwt_extended import jwt_required
+from sqlalchemy import event, inspect
+
+from geo import quadkey, quadkey_bounds, quadkey_center
+from models import db, Listing, ListingCellStats, ListingCellPriceBucket
+
+STATS_CELL_LEVEL = 12
+
+RELATIVE_ACCURACY = 0.02
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(GAMMA)
+
+REBUILD_CHUNK_SIZE = 10000
+
+# Columns a listing's contribution to the stats depends on.
+STATS_COLUMNS = ("latitude", "longitude", "price", "rented_by")
+
+
+def cell_for(latitude, longitude):
+    """ Stats cell a listing at these coordinates belongs to. """
+
+    return quadkey(latitude, longitude, STATS_CELL_LEVEL)
+
+
+def price_bucket(price):
+    """ Histogram bucket for a price. Prices of 1 or less share bucket 0. """
+
+    price = float(price)
+    if price <= 1:
+        return 0
+    return math.ceil(math.log(price) / _LOG_GAMMA)
+
+
+def bucket_price(bucket):
+    """ Representative price of a bucket, within RELATIVE_ACCURACY of any
+        price in it.
+    """
+
+    return 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+class StatsDelta:
+    """ Pending changes to the cell tables, accumulated then applied. """
+
+    def __init__(self):
+        self.cells = {}
+        self.buckets = {}
+
+    def add(self, latitude, longitude, price, rented_by, sign=1):
+        """ Count (sign=1) or uncount (sign=-1) one listing. """
+
+        cell = cell_for(latitude, longitude)
+        totals = self.cells.setdefault(cell, {
+            "listing_count": 0,
+            "rented_count": 0,
+            "price_sum": Decimal(0),
+        })
+        totals["listing_count"] += sign
+        totals["rented_count"] += sign if rented_by else 0
+        totals["price_sum"] += sign * Decimal(str(price))
+
+        key = (cell, price_bucket(price))
+        self.buckets[key] = self.buckets.get(key, 0) + sign
+
+    def apply(self, connection):
+        """ Add the accumulated deltas to the cell tables. """
+
+        for cell, totals in self.cells.items():
+            if any(totals.values()):
+                _increment(connection, ListingCellStats.__table__,
+                           {"cell": cell}, totals)
+
+        for (cell, bucket), count in self.buckets.items():
+            if count:
+                _increment(connection, ListingCellPriceBucket.__table__,
+                           {"cell": cell, "bucket": bucket}, {"count": count})
+
+
+def _increment(connection, table, key, deltas):
+    """ Add `deltas` to the row at `key`, creating the row if needed. """
+
+    if connection.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        statement = insert(table).values(**key, **deltas)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[column] for column in key],
+            set_={
+                column: table.c[column] + statement.excluded[column]
+                for column in deltas
+            },
+        )
+        connection.execute(statement)
+        return
+
+    where = [table.c[column] == value for column, value in key.items()]
+    result = connection.execute(
+        table.update().where(db.and_(*where)).values({
+            column: table.c[column] + delta
+            for column, delta in deltas.items()
+        })
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(**key, **deltas))
+
+
+def _committed_value(listing, column):
+    """ A column's value as of the last flush, before pending changes. """
+
+    history = inspect(listing).attrs[column].history
+    if history.unchanged:
+        return history.unchanged[0]
+    if history.deleted:
+        return history.deleted[0]
+    if history.added:
+        # Changed from NULL, which the history doesn't record.
+        return None
+    return getattr(listing, column)
+
+
+def _after_insert(mapper, connection, listing):
+    if listing.deleted_at is not None:
+        return
+    delta = StatsDelta()
+    delta.add(*(getattr(listing, column) for column in STATS_COLUMNS))
+    delta.apply(connection)
+
+
+def _after_update(mapper, connection, listing):
+    old = tuple(_committed_value(listing, column) for column in STATS_COLUMNS)
+    new = tuple(getattr(listing, column) for column in STATS_COLUMNS)
+    was_live = _committed_value(listing, "deleted_at") is None
+    is_live = listing.deleted_at is None
+    if old == new and was_live == is_live:
+        return
+
+    delta = StatsDelta()
+    if was_live:
+        delta.add(*old, sign=-1)
+    if is_live:
+        delta.add(*new)
+    delta.apply(connection)
+
+
+def _after_delete(mapper, connection, listing):
+    if _committed_value(listing, "deleted_at") is not None:
+        return
+    delta = StatsDelta()
+    old = (_committed_value(listing, column) for column in STATS_COLUMNS)
+    delta.add(*old, sign=-1)
+    delta.apply(connection)
+
+
+def record_listings(rows, sign=1):
+    """ Count (or with sign=-1, uncount) live listings written without the
+        ORM. `rows` are dicts or named rows of at least STATS_COLUMNS.
+    """
+
+    delta = StatsDelta()
+    for row in rows:
+        if isinstance(row, dict):
+            values = (row.get(column) for column in STATS_COLUMNS)
+        else:
+            values = (getattr(row, column) for column in STATS_COLUMNS)
+        delta.add(*values, sign=sign)
+    delta.apply(db.session.connection())
+
+
+def rebuild():
+    """ Recompute both cell tables from live listings. Nothing is
+        committed.
+    """
+
+    db.session.query(ListingCellPriceBucket).delete()
+    db.session.query(ListingCellStats).delete()
+
+    delta = StatsDelta()
+    listings = (
+        db.session.query(*(getattr(Listing, c) for c in STATS_COLUMNS))
+        .filter(Listing.deleted_at.is_(None))
+        .yield_per(REBUILD_CHUNK_SIZE)
+    )
+    for row in listings:
+        delta.add(*row)
+
+    connection = db.session.connection()
+    cells = [
+        {"cell": cell, **totals} for cell, totals in delta.cells.items()
+    ]
+    buckets = [
+        {"cell": cell, "bucket": bucket, "count": count}
+        for (cell, bucket), count in delta.buckets.items()
+    ]
+    if cells:
+        connection.execute(ListingCellStats.__table__.insert(), cells)
+    if buckets:
+        connection.execute(ListingCellPriceBucket.__table__.insert(), buckets)
+    return len(cells)
+
+
+def _quantile(histogram, total, q):
+    """ Estimate quantile `q` from sorted (bucket, count) pairs. """
+
+    rank = q * (total - 1)
+    seen = 0
+    for bucket, count in histogram:
+        seen += count
+        if seen > rank:
+            return round(bucket_price(bucket), 2)
+    return None
+
+
+def cell_stats(level=STATS_CELL_LEVEL, prefix=""):
+    """ Statistics for every non-empty cell at `level` under `prefix`.
+
+        Cells coarser than STATS_CELL_LEVEL are merged from the stored
+        cells, so this reads each stored cell (and its buckets) once.
+    """
+
+    totals = {}
+    stats_query = ListingCellStats.query.filter(
+        ListingCellStats.listing_count > 0
+    )
+    if prefix:
+        stats_query = stats_query.filter(
+            ListingCellStats.cell.startswith(prefix, autoescape=True)
+        )
+    for stored in stats_query:
+        merged = totals.setdefault(stored.cell[:level], {
+            "listing_count": 0,
+            "rented_count": 0,
+            "price_sum": Decimal(0),
+        })
+        merged["listing_count"] += stored.listing_count
+        merged["rented_count"] += stored.rented_count
+        merged["price_sum"] += stored.price_sum
+
+    histograms = {}
+    bucket_query = db.session.query(
+        ListingCellPriceBucket.cell,
+        ListingCellPriceBucket.bucket,
+        ListingCellPriceBucket.count,
+    ).filter(ListingCellPriceBucket.count > 0)
+    if prefix:
+        bucket_query = bucket_query.filter(
+            ListingCellPriceBucket.cell.startswith(prefix, autoescape=True)
+        )
+    for cell, bucket, count in bucket_query:
+        histogram = histograms.setdefault(cell[:level], {})
+        histogram[bucket] = histogram.get(bucket, 0) + count
+
+    cells = []
+    for cell, merged in sorted(totals.items()):
+        count = merged["listing_count"]
+        histogram = sorted(histograms.get(cell, {}).items())
+        latitude, longitude = quadkey_center(cell)
+        south, west, north, east = quadkey_bounds(cell)
+        cells.append({
+            "cell": cell,
+            "latitude": latitude,
+            "longitude": longitude,
+            "bounds": {
+                "south": south,
+                "west": west,
+                "north": north,
+                "east": east,
+            },
+            "listing_count": count,
+            "rented_count": merged["rented_count"],
+            "occupancy_rate": merged["rented_count"] / count,
+            "avg_price": round(float(merged["price_sum"]) / count, 2),
+            "p25_price": _quantile(histogram, count, 0.25),
+            "median_price": _quantile(histogram, count, 0.5),
+            "p75_price": _quantile(histogram, count, 0.75),
+        })
+    return cells
+
+
+def init_stats(app):
+    """ Keep the cell tables in step with Listing and add the stats route. """
+
+    event.listen(Listing, "after_insert", _after_insert)
+    event.listen(Listing, "after_update", _after_update)
+    event.listen(Listing, "after_delete", _after_delete)
+
+    @app.route("/stats/listings")
+    @jwt_required
+    def listing_stats():
+        """ Price and occupancy statistics by area.
+            Optional query parameters:
+                level: quadkey level to group by, 1 to STATS_CELL_LEVEL
+                cell: only cells inside this quadkey
+            Returns => {
+                    level,
+                    cells: [{
+                        cell,
+                        latitude,
+                        longitude,
+                        bounds: { south, west, north, east },
+                        listing_count,
+                        rented_count,
+                        occupancy_rate,
+                        avg_price,
+                        p25_price,
+                        median_price,
+                        p75_price,
+                        }, ...]
+                    }
+            Auth required: user logged in
+        """
+
+        try:
+            level = int(request.args.get("level", STATS_CELL_LEVEL))
+        except ValueError:
+            level = 0
+        prefix = request.args.get("cell", "")
+        if not 1 <= level <= STATS_CELL_LEVEL:
+            errors = [f"level must be between 1 and {STATS_CELL_LEVEL}"]
+            return (jsonify(errors=errors), 400)
+        if prefix.strip("0123") or len(prefix) > level:
+            errors = ["cell must be a quadkey no longer than level"]
+            return (jsonify(errors=errors), 400)
+
+        return (jsonify(level=level, cells=cell_stats(level, prefix)), 200)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    with app.app_context():
+        count = rebuild()
+        db.session.commit()
+    print(f"Rebuilt listing stats for {count} cells")
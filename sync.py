@@ -0,0 +1,221 @@
+"""Delta sync: what changed since a client last looked.
+
+Every create, update and delete of a listing or message is appended to the
+change log (ChangeLog) in the same transaction: mapper events cover ORM
+writes, and the Core paths (bulk import, user soft-delete, broadcasts, the
+reaper's purges) log their rows themselves. `GET /sync?since=<token>`
+reads only the entries after the token, through an index, and then loads
+just the objects they name. Its cost scales with the number of changes,
+not the size of the tables.
+
+Listings are public, so every listing change is returned; message changes
+only go to their sender and recipient.
+
+A token is the position "<txid>.<id>" of the last entry a client has seen,
+and entries are read in (txid, id) order. Ids are handed out when an entry
+is written, not when its transaction commits, so on their own they could
+let a token move past a long transaction (a bulk import, say) that commits
+a lower id later. On Postgres each entry therefore records its
+transaction's id, and only entries of transactions older than the oldest
+one still running (the snapshot's xmin) are returned: every transaction
+below that has finished, and anything that commits later sorts after
+every token handed out so far. A long transaction holds sync back until it
+finishes rather than being skipped. On SQLite, which runs one writing
+transaction at a time, ids already commit in order and txid is 0.
+"""
+
+from datetime import timedelta
+
+from flask import jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+from sqlalchemy import event
+
+from models import (
+    db, has_changes, txid_finished, ChangeLog, Listing, Message,
+    ArchivedMessage, LISTING_BRIEF_FIELDS
+)
+
+SYNC_PAGE_SIZE = 500
+CHANGE_LOG_RETENTION = timedelta(days=30)
+START_TOKEN = "0.0"
+
+
+def _listing_change(listing, deleted=False):
+    return {
+        "object_id": listing.id,
+        "deleted": deleted or listing.deleted_at is not None,
+    }
+
+
+def _message_change(message, deleted=False):
+    return {
+        "object_id": message.id,
+        "deleted": deleted,
+        "from_user": message.from_user,
+        "to_user": message.to_user,
+    }
+
+
+def _listen(model, kind, change):
+    def after_insert(mapper, connection, target):
+        ChangeLog.record(connection, kind, [change(target)])
+
+    def after_update(mapper, connection, target):
+        if has_changes(target):
+            ChangeLog.record(connection, kind, [change(target)])
+
+    def after_delete(mapper, connection, target):
+        ChangeLog.record(connection, kind, [change(target, deleted=True)])
+
+    event.listen(model, "after_insert", after_insert)
+    event.listen(model, "after_update", after_update)
+    event.listen(model, "after_delete", after_delete)
+
+
+def _position():
+    return db.tuple_(ChangeLog.txid, ChangeLog.id)
+
+
+def parse_token(value):
+    """ (txid, id) from a token, or None if it isn't one. """
+
+    txid, _, entry_id = value.partition(".")
+    if not (txid.isdigit() and entry_id.isdigit()):
+        return None
+    return int(txid), int(entry_id)
+
+
+def format_token(txid, entry_id):
+    return f"{txid}.{entry_id}"
+
+
+def _latest_changes(entries):
+    """ The last entry for each object, as {kind: {object_id: entry}}. """
+
+    latest = {"listing": {}, "message": {}}
+    for entry in entries:
+        latest[entry.kind][entry.object_id] = entry
+    return latest
+
+
+def _serialize_message(message):
+    return {"id": message.id, **message.serialize()}
+
+
+def changes_since(since, username, page_size=SYNC_PAGE_SIZE):
+    """ Listings and messages changed after position `since` (a
+        (txid, id) pair), as seen by `username`, up to `page_size` log
+        entries.
+    """
+
+    entries = ChangeLog.query.filter(
+        _position() > db.tuple_(*since),
+        txid_finished(ChangeLog.txid),
+        db.or_(
+            ChangeLog.kind == "listing",
+            ChangeLog.from_user == username,
+            ChangeLog.to_user == username,
+        ),
+    ).order_by(ChangeLog.txid, ChangeLog.id).limit(page_size + 1).all()
+    has_more = len(entries) > page_size
+    entries = entries[:page_size]
+
+    latest = _latest_changes(entries)
+    listing_ids = [
+        object_id for object_id, entry in latest["listing"].items()
+        if not entry.deleted
+    ]
+    message_ids = [
+        object_id for object_id, entry in latest["message"].items()
+        if not entry.deleted
+    ]
+
+    listings = []
+    if listing_ids:
+        listings = Listing.with_fields(
+            Listing.live().filter(Listing.id.in_(listing_ids)),
+            LISTING_BRIEF_FIELDS,
+        ).all()
+
+    messages = []
+    if message_ids:
+        messages = Message.live().filter(Message.id.in_(message_ids)).all()
+        archived_ids = set(message_ids) - {message.id for message in messages}
+        if archived_ids:
+            messages += ArchivedMessage.live().filter(
+                ArchivedMessage.id.in_(archived_ids)
+            ).all()
+
+    # Anything logged as changed that is no longer visible is gone for the
+    # client too (e.g. deleted by a later change not yet synced).
+    found_listings = {listing.id for listing in listings}
+    found_messages = {message.id for message in messages}
+    return {
+        "listings": [
+            listing.serialize(isDetailed=False) for listing in listings
+        ],
+        "deleted_listings": sorted(
+            set(latest["listing"]) - found_listings
+        ),
+        "messages": [_serialize_message(message) for message in messages],
+        "deleted_messages": sorted(
+            set(latest["message"]) - found_messages
+        ),
+        "next": (format_token(entries[-1].txid, entries[-1].id)
+                 if entries else format_token(*since)),
+        "has_more": has_more,
+    }
+
+
+def current_token():
+    """ Token for "now": every change after it is still to come. """
+
+    head = db.session.query(ChangeLog.txid, ChangeLog.id).filter(
+        txid_finished(ChangeLog.txid)
+    ).order_by(ChangeLog.txid.desc(), ChangeLog.id.desc()).first()
+    return format_token(*head) if head else START_TOKEN
+
+
+def init_sync(app):
+    """ Log listing and message changes and add the sync route. """
+
+    _listen(Listing, "listing", _listing_change)
+    _listen(Message, "message", _message_change)
+
+    @app.route("/sync")
+    @jwt_required
+    def sync():
+        """ Listings, and the logged in user's messages, changed since a
+            sync token.
+            Query parameters:
+                since: token from a previous response's `next`. Without
+                it, only `next` is returned: fetch the data in full, then
+                sync from that token.
+            Returns => {
+                    listings: [{ id, title, ... }, ...],
+                    deleted_listings: [id, ...],
+                    messages: [{ id, body, ... }, ...],
+                    deleted_messages: [id, ...],
+                    next,
+                    has_more,
+                    }
+            410 if the token is older than the retained change log.
+            Auth required: user logged in
+        """
+
+        since = request.args.get("since")
+        if since is None:
+            return (jsonify(next=current_token()), 200)
+        too_old = ["since is too old; fetch everything again"]
+        if since.isdigit():
+            # A token from before positions included the txid.
+            return (jsonify(errors=too_old), 410)
+        since = parse_token(since)
+        if since is None:
+            return (jsonify(errors=["since must be a sync token"]), 400)
+
+        oldest = db.session.query(db.func.min(ChangeLog.id)).scalar()
+        if oldest is not None and since[1] < oldest - 1:
+            return (jsonify(errors=too_old), 410)
+
+        return (jsonify(changes_since(since, get_jwt_identity())), 200)
@@ -0,0 +1,75 @@
+"""The app on a throwaway SQLite database, one fresh schema per test."""
+
+import os
+import tempfile
+
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix="sharebnb-tests-")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{os.path.join(_tmp, 'test.db')}",
+    HOT_KEYS_PATH=os.path.join(_tmp, "hot-keys.json"),
+    PROFILE_DIR=os.path.join(_tmp, "profiles"),
+    WARMUP_ENABLED="0",
+    RATE_LIMITS_ENABLED="0",
+)
+
+from flask_jwt_extended import create_access_token  # noqa: E402
+
+from app import app as flask_app  # noqa: E402
+from models import db, User  # noqa: E402
+
+# hash for "password"
+PASSWORD_HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def make_user(username, is_admin=False):
+    user = User(
+        username=username,
+        first_name=username.title(),
+        last_name="Test",
+        email=f"{username}@example.com",
+        password=PASSWORD_HASH,
+        location="San Francisco",
+        is_admin=is_admin,
+    )
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def alice(app):
+    return make_user("alice")
+
+
+@pytest.fixture
+def auth_for(app):
+    """ Authorization headers for a user. """
+
+    def headers(user):
+        token = create_access_token(identity=user)
+        return {"Authorization": f"Bearer {token}"}
+
+    return headers
+
+
+@pytest.fixture
+def auth(alice, auth_for):
+    """ Authorization headers for alice. """
+
+    return auth_for(alice)
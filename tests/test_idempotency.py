@@ -0,0 +1,153 @@
+"""Idempotency-Key handling on POST /listings."""
+
+from datetime import datetime
+
+import pytest
+from conftest import make_user
+
+import idempotency
+from idempotency import CLAIM_TIMEOUT, REPLAYED_HEADER
+from models import db, IdempotencyKey, Listing
+
+LISTING = {"listing": {
+    "title": "Tent", "price": 100, "longitude": -122.4, "latitude": 37.7,
+    "beds": 1, "rooms": 1, "bathrooms": 1, "created_by": "alice",
+}}
+
+
+@pytest.fixture
+def headers(auth):
+    return {**auth, "Idempotency-Key": "create-tent"}
+
+
+def claim(app, headers, body, **fields):
+    """ Store a claim for `headers`' key on `body`, as _claim would. """
+
+    with app.test_request_context("/listings", method="POST", json=body,
+                                  headers=headers):
+        key_hash = idempotency._key_hash(headers["Idempotency-Key"])
+        request_hash = idempotency._request_hash()
+    now = datetime.utcnow()
+    values = dict(key_hash=key_hash, request_hash=request_hash,
+                  created_at=now, expires_at=now + CLAIM_TIMEOUT * 10)
+    values.update(fields)
+    db.session.add(IdempotencyKey(**values))
+    db.session.commit()
+
+
+def test_replay_returns_the_stored_response(client, headers):
+    first = client.post("/listings", json=LISTING, headers=headers)
+    replay = client.post("/listings", json=LISTING, headers=headers)
+
+    assert first.status_code == 201
+    assert REPLAYED_HEADER not in first.headers
+    assert replay.status_code == 201
+    assert replay.headers[REPLAYED_HEADER] == "true"
+    assert replay.get_data() == first.get_data()
+    assert replay.content_type == first.content_type
+    assert Listing.query.count() == 1
+    assert IdempotencyKey.query.count() == 1
+
+
+def test_response_is_stored_with_the_views_writes(client, headers):
+    client.post("/listings", json=LISTING, headers=headers)
+
+    stored = IdempotencyKey.query.one()
+    assert stored.status_code == 201
+    assert Listing.query.count() == 1
+
+
+def test_without_a_key_every_request_runs(client, auth):
+    client.post("/listings", json=LISTING, headers=auth)
+    client.post("/listings", json=LISTING, headers=auth)
+
+    assert Listing.query.count() == 2
+    assert IdempotencyKey.query.count() == 0
+
+
+def test_same_key_different_body_is_rejected(client, headers):
+    client.post("/listings", json=LISTING, headers=headers)
+    other = {"listing": dict(LISTING["listing"], price=200)}
+
+    response = client.post("/listings", json=other, headers=headers)
+
+    assert response.status_code == 422
+    assert Listing.query.count() == 1
+
+
+def test_request_in_progress_is_rejected(app, client, headers):
+    claim(app, headers, LISTING)
+
+    response = client.post("/listings", json=LISTING, headers=headers)
+
+    assert response.status_code == 409
+    assert Listing.query.count() == 0
+
+
+def test_abandoned_claim_is_taken_over(app, client, headers):
+    claim(app, headers, LISTING,
+          created_at=datetime.utcnow() - CLAIM_TIMEOUT * 2)
+
+    response = client.post("/listings", json=LISTING, headers=headers)
+
+    assert response.status_code == 201
+    assert REPLAYED_HEADER not in response.headers
+    assert Listing.query.count() == 1
+    assert IdempotencyKey.query.one().status_code == 201
+
+
+def test_failed_request_releases_the_key(client, headers):
+    failed = client.post("/listings", json={"listing": {}}, headers=headers)
+
+    assert failed.status_code == 400
+    assert IdempotencyKey.query.count() == 0
+
+    retried = client.post("/listings", json=LISTING, headers=headers)
+
+    assert retried.status_code == 201
+    assert REPLAYED_HEADER not in retried.headers
+    assert Listing.query.count() == 1
+
+
+def test_failed_commit_keeps_neither_response_nor_writes(
+        client, headers, monkeypatch):
+    commits = []
+    commit = db.session.commit
+
+    def fail_final_commit():
+        # The first commit claims the key; the second stores the response.
+        commits.append(1)
+        if len(commits) == 2:
+            raise RuntimeError("database went away")
+        commit()
+
+    monkeypatch.setattr(db.session, "commit", fail_final_commit)
+    monkeypatch.setitem(client.application.config, "PROPAGATE_EXCEPTIONS",
+                        False)
+    response = client.post("/listings", json=LISTING, headers=headers)
+    monkeypatch.undo()
+
+    assert response.status_code == 500
+    assert Listing.query.count() == 0
+    assert IdempotencyKey.query.count() == 0
+
+
+def test_keys_are_scoped_to_the_caller(client, headers, auth_for):
+    bob_headers = {
+        **auth_for(make_user("bob")),
+        "Idempotency-Key": headers["Idempotency-Key"],
+    }
+    client.post("/listings", json=LISTING, headers=headers)
+    response = client.post("/listings", json=LISTING, headers=bob_headers)
+
+    assert REPLAYED_HEADER not in response.headers
+    assert Listing.query.count() == 2
+
+
+def test_overlong_key_is_rejected(client, auth):
+    response = client.post("/listings", json=LISTING, headers={
+        **auth, "Idempotency-Key": "k" * 256,
+    })
+
+    assert response.status_code == 400
+    assert Listing.query.count() == 0
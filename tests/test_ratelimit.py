@@ -0,0 +1,226 @@
+"""Token buckets, the order they are checked in, and concurrency limits."""
+
+import pytest
+from flask import Flask, jsonify
+from flask_jwt_extended import JWTManager
+
+import ratelimit
+from ratelimit import (
+    Limit, LocalStore, MemoryBackend, StoreBackend, init_rate_limits,
+)
+
+
+class Clock:
+    """ Stands in for time.monotonic and time.time. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    monkeypatch.setattr(ratelimit.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "store"])
+def backend(request, clock):
+    if request.param == "memory":
+        return MemoryBackend()
+    return StoreBackend(LocalStore())
+
+
+# Token math
+
+def test_full_bucket_allows_a_burst(backend):
+    waits = [backend.take("k", rate=1, burst=3) for _ in range(3)]
+    assert waits == [0, 0, 0]
+
+
+def test_empty_bucket_says_when_the_next_token_arrives(backend):
+    for _ in range(2):
+        backend.take("k", rate=2, burst=2)
+
+    assert backend.take("k", rate=2, burst=2) == pytest.approx(0.5)
+
+
+def test_tokens_refill_at_the_rate(backend, clock):
+    for _ in range(2):
+        backend.take("k", rate=2, burst=2)
+
+    clock.advance(0.5)
+    assert backend.take("k", rate=2, burst=2) == 0
+    assert backend.take("k", rate=2, burst=2) == pytest.approx(0.5)
+
+
+def test_refill_stops_at_the_burst(backend, clock):
+    backend.take("k", rate=1, burst=2)
+    clock.advance(60)
+
+    waits = [backend.take("k", rate=1, burst=2) for _ in range(3)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(1)
+
+
+def test_refused_takes_cost_nothing(backend, clock):
+    backend.take("k", rate=1, burst=1)
+    for _ in range(5):
+        backend.take("k", rate=1, burst=1)
+
+    clock.advance(1)
+    assert backend.take("k", rate=1, burst=1) == 0
+
+
+def test_buckets_are_separate(backend):
+    backend.take("a", rate=1, burst=1)
+
+    assert backend.take("b", rate=1, burst=1) == 0
+
+
+def test_memory_backend_drops_idle_buckets(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit, "SWEEP_EVERY", 2)
+    backend = MemoryBackend()
+    backend.take("idle", rate=1, burst=1)
+    clock.advance(ratelimit.IDLE_BUCKET_SECONDS + 1)
+    backend.take("busy", rate=1, burst=1)
+
+    assert list(backend._buckets) == ["busy"]
+
+
+def test_store_backend_lets_requests_through_when_contended(clock):
+    class Contended(LocalStore):
+        def compare_and_set(self, key, expected, value, ttl):
+            return False
+
+    backend = StoreBackend(Contended())
+
+    assert [backend.take("k", rate=1, burst=1) for _ in range(3)] == [0] * 3
+
+
+# Admission
+
+def make_app(limits, backend, max_concurrent=0):
+    app = Flask(__name__)
+    app.config.update(
+        JWT_SECRET_KEY="test",
+        RATE_LIMITS_ENABLED=True,
+        RATE_LIMITS=limits,
+        MAX_CONCURRENT_REQUESTS=max_concurrent,
+    )
+    JWTManager(app)
+
+    @app.route("/ping")
+    def ping():
+        return jsonify(ok=True)
+
+    @app.route("/boom")
+    def boom():
+        raise RuntimeError("boom")
+
+    init_rate_limits(app, backend)
+    return app
+
+
+def get(client, path, address):
+    return client.get(path, environ_base={"REMOTE_ADDR": address})
+
+
+def test_caller_over_its_limit_leaves_route_tokens_alone(clock):
+    backend = StoreBackend(LocalStore())
+    app = make_app({"ping": Limit(route_rate=1, route_burst=3,
+                                  user_rate=1, user_burst=1)}, backend)
+    client = app.test_client()
+
+    statuses = [get(client, "/ping", "10.0.0.1").status_code
+                for _ in range(5)]
+    assert statuses == [200, 429, 429, 429, 429]
+
+    # One route token went to the first request; the refusals took none.
+    others = [get(client, "/ping", f"10.0.0.{n}").status_code
+              for n in (2, 3)]
+    assert others == [200, 200]
+
+
+def test_route_bucket_is_shared(clock):
+    app = make_app({"ping": Limit(route_rate=1, route_burst=2)},
+                   MemoryBackend())
+    client = app.test_client()
+
+    statuses = [get(client, "/ping", f"10.0.0.{n}").status_code
+                for n in range(3)]
+    assert statuses == [200, 200, 429]
+
+
+def test_refusal_carries_retry_after(clock):
+    app = make_app({"ping": Limit(user_rate=0.1, user_burst=1)},
+                   MemoryBackend())
+    client = app.test_client()
+    get(client, "/ping", "10.0.0.1")
+
+    response = get(client, "/ping", "10.0.0.1")
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "10"
+
+
+def test_star_applies_to_endpoints_without_limits(clock):
+    app = make_app({"*": Limit(user_rate=1, user_burst=1)}, MemoryBackend())
+    client = app.test_client()
+
+    assert get(client, "/ping", "10.0.0.1").status_code == 200
+    assert get(client, "/ping", "10.0.0.1").status_code == 429
+
+
+# Concurrency
+
+def test_concurrency_slots_are_released_after_each_request(clock):
+    app = make_app({"ping": Limit(concurrency=1)}, MemoryBackend(),
+                   max_concurrent=1)
+    admission = app.extensions["admission"]
+    client = app.test_client()
+
+    for _ in range(3):
+        assert client.get("/ping").status_code == 200
+    assert admission.global_limiter.in_flight == 0
+    assert admission.route_limiters["ping"].in_flight == 0
+
+
+def test_concurrency_slots_are_released_when_the_view_raises(clock):
+    app = make_app({"boom": Limit(concurrency=1)}, MemoryBackend(),
+                   max_concurrent=1)
+    admission = app.extensions["admission"]
+    client = app.test_client()
+
+    assert client.get("/boom").status_code == 500
+    assert admission.global_limiter.in_flight == 0
+    assert admission.route_limiters["boom"].in_flight == 0
+
+
+def test_request_over_the_route_limit_is_shed(clock):
+    app = make_app({"ping": Limit(concurrency=1)}, MemoryBackend(),
+                   max_concurrent=2)
+    admission = app.extensions["admission"]
+    admission.route_limiters["ping"].try_acquire()
+
+    response = app.test_client().get("/ping")
+
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    # The global slot it took on the way is given back.
+    assert admission.global_limiter.in_flight == 0
+
+
+def test_disabled_admission_installs_nothing():
+    app = Flask(__name__)
+    app.config["RATE_LIMITS_ENABLED"] = False
+
+    assert init_rate_limits(app) is None
+    assert "admission" not in app.extensions
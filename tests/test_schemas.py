@@ -0,0 +1,274 @@
+"""Schemas coerce input as the WTForms forms and Listing.convert_inputs
+they replaced did, except that values of the wrong JSON type (true for a
+number, a number for a string) and unparsable numbers are rejected.
+"""
+
+import math
+from decimal import Decimal
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+from schemas import (
+    REQUIRED, NOT_AN_OBJECT, DecimalField, FloatField, IntegerField,
+    Invalid, StringField, USER_SIGNUP, USER_LOGIN, USER_EDIT, MESSAGE_CREATE,
+    MESSAGE_BROADCAST, LISTING_CREATE, LISTING_EDIT, LISTING_SEARCH,
+)
+
+LISTING = {
+    "title": "Tent", "price": 100, "longitude": -122.4, "latitude": 37.7,
+    "beds": 1, "rooms": 1, "bathrooms": 1, "created_by": "alice",
+}
+
+
+def check(field, value):
+    return field.compile()(value)
+
+
+# Fields
+
+@pytest.mark.parametrize("value, expected", [
+    ("abc", "abc"),
+    ("  ", "  "),
+])
+def test_string_field(value, expected):
+    assert check(StringField(), value) == expected
+
+
+@pytest.mark.parametrize("value", [1, 2.5, True, [1], {"a": 1}])
+def test_string_field_rejects_other_types(value):
+    with pytest.raises(Invalid):
+        check(StringField(), value)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (3, 3),
+    ("3", 3),
+    ("-1", -1),
+    # int(): JSON numbers are truncated.
+    (2.7, 2),
+    (-2.7, -2),
+])
+def test_integer_field(value, expected):
+    assert check(IntegerField(), value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "2.5", "abc", "1e2", True, False, math.nan, math.inf, [1],
+])
+def test_integer_field_rejects(value):
+    with pytest.raises(Invalid, match="Not a valid integer value"):
+        check(IntegerField(), value)
+
+
+@pytest.mark.parametrize("value, expected", [
+    # convert_inputs: int(value.split(".")[0])
+    ("2.5", 2),
+    ("2.0", 2),
+    ("3", 3),
+    (2.5, 2),
+])
+def test_truncated_integer_field(value, expected):
+    assert check(IntegerField(truncate=True), value) == expected
+
+
+def test_truncated_integer_field_rejects():
+    with pytest.raises(Invalid):
+        check(IntegerField(truncate=True), "abc")
+
+
+@pytest.mark.parametrize("value, expected", [
+    (2.5, 2.5),
+    (3, 3.0),
+    ("2.5", 2.5),
+    ("1e2", 100.0),
+])
+def test_float_field(value, expected):
+    result = check(FloatField(), value)
+    assert result == expected and isinstance(result, float)
+
+
+@pytest.mark.parametrize("value", [
+    "abc", True, math.nan, "nan", "inf", [1],
+])
+def test_float_field_rejects(value):
+    with pytest.raises(Invalid, match="Not a valid float value"):
+        check(FloatField(), value)
+
+
+@pytest.mark.parametrize("value, expected", [
+    # Through str(), so a JSON 2.7 is exactly 2.7, not its binary float.
+    (2.7, Decimal("2.7")),
+    (100, Decimal("100")),
+    ("19.99", Decimal("19.99")),
+])
+def test_decimal_field(value, expected):
+    assert check(DecimalField(), value) == expected
+
+
+@pytest.mark.parametrize("value", [
+    "abc", True, math.nan, "nan", "inf", [1],
+])
+def test_decimal_field_rejects(value):
+    with pytest.raises(Invalid, match="Not a valid decimal value"):
+        check(DecimalField(), value)
+
+
+@pytest.mark.parametrize("field", [
+    StringField(), IntegerField(), FloatField(), DecimalField(),
+])
+@pytest.mark.parametrize("value", [None, ""])
+def test_optional_field_absent(field, value):
+    assert check(field, value) is None
+
+
+@pytest.mark.parametrize("field, value", [
+    (StringField(required=True), None),
+    (StringField(required=True), ""),
+    # DataRequired: whitespace is missing.
+    (StringField(required=True), "  "),
+    # DataRequired: 0 is missing, however it is written.
+    (IntegerField(required=True), 0),
+    (IntegerField(required=True), "0"),
+    (FloatField(required=True), 0.0),
+    (FloatField(required=True), "0"),
+    (DecimalField(required=True), 0),
+    (DecimalField(required=True), "0.00"),
+])
+def test_required_field_missing(field, value):
+    with pytest.raises(Invalid, match=REQUIRED):
+        check(field, value)
+
+
+def test_optional_zero_is_kept():
+    assert check(IntegerField(), 0) == 0
+    assert check(FloatField(), "0") == 0.0
+
+
+# Schemas
+
+def test_schema_rejects_non_objects():
+    assert LISTING_CREATE.validate(["title"]) == ({}, [NOT_AN_OBJECT])
+
+
+def test_schema_treats_none_as_empty():
+    values, errors = LISTING_EDIT.validate(None)
+    assert (values, errors) == ({}, [])
+
+
+def test_schema_leaves_out_absent_fields_and_ignores_unknown_ones():
+    values, errors = LISTING_EDIT.validate(
+        {"title": "Tent", "description": "", "unknown": 1}
+    )
+    assert (values, errors) == ({"title": "Tent"}, [])
+
+
+def test_listing_create():
+    values, errors = LISTING_CREATE.validate(
+        dict(LISTING, price="99.50", beds=2.0)
+    )
+    assert errors == []
+    assert values["price"] == Decimal("99.50")
+    assert values["beds"] == 2
+    assert "description" not in values and "photo" not in values
+
+
+def test_listing_create_required():
+    values, errors = LISTING_CREATE.validate({})
+    assert errors == [REQUIRED] * 8
+
+
+def test_listing_create_errors_in_field_order():
+    _, errors = LISTING_CREATE.validate(
+        dict(LISTING, title="", price="abc", bathrooms="x")
+    )
+    assert errors == [
+        REQUIRED, "Not a valid decimal value", "Not a valid integer value",
+    ]
+
+
+def test_listing_edit_everything_optional():
+    values, errors = LISTING_EDIT.validate({"price": 0, "rented_by": "bob"})
+    assert errors == []
+    assert values == {"price": Decimal("0"), "rented_by": "bob"}
+
+
+def test_listing_search_from_query_string():
+    values, errors = LISTING_SEARCH.validate(MultiDict({
+        "max_price": "500", "longitude": "-122.4", "latitude": "37.7",
+        "beds": "2.0", "bathrooms": "1.5",
+    }))
+    assert errors == []
+    assert values == {
+        "max_price": 500, "longitude": -122.4, "latitude": 37.7,
+        "beds": 2, "bathrooms": 1,
+    }
+
+
+def test_listing_search_empty_parameters_are_absent():
+    assert LISTING_SEARCH.validate(MultiDict({"beds": ""})) == ({}, [])
+
+
+def test_listing_search_bad_number():
+    _, errors = LISTING_SEARCH.validate(MultiDict({"max_price": "2.5"}))
+    assert errors == ["Not a valid integer value"]
+
+
+def test_user_signup_from_form():
+    values, errors = USER_SIGNUP.validate(MultiDict({
+        "username": "alice", "first_name": "A", "last_name": "B",
+        "email": "alice@example.com", "password": "secret1",
+    }))
+    assert errors == []
+    assert "location" not in values
+
+
+def test_user_signup_checks():
+    _, errors = USER_SIGNUP.validate(MultiDict({
+        "username": " ", "first_name": "A", "last_name": "B",
+        "email": "not-an-email", "password": "short",
+    }))
+    assert errors == [
+        REQUIRED, "Invalid email address.",
+        "Field must be at least 6 characters long.",
+    ]
+
+
+def test_user_login_required():
+    _, errors = USER_LOGIN.validate({})
+    assert errors == [REQUIRED, REQUIRED]
+
+
+def test_user_edit():
+    values, errors = USER_EDIT.validate({
+        "email": "alice@example.com", "password": "secret1", "bio": "",
+        "image_url": "http://example.com/elsewhere.png",
+    })
+    assert errors == []
+    assert values == {"email": "alice@example.com", "password": "secret1"}
+
+
+def test_user_edit_required():
+    _, errors = USER_EDIT.validate({"bio": "hi"})
+    assert errors == [REQUIRED, REQUIRED]
+
+
+def test_message_create():
+    values, errors = MESSAGE_CREATE.validate({
+        "body": "Hi", "to_user": "bob", "from_user": "alice",
+        "listing_id": "3",
+    })
+    assert errors == []
+    assert values["listing_id"] == 3
+
+
+def test_message_create_required():
+    _, errors = MESSAGE_CREATE.validate(
+        {"body": " ", "to_user": "bob", "from_user": "alice", "listing_id": 0}
+    )
+    assert errors == [REQUIRED, REQUIRED]
+
+
+def test_message_broadcast():
+    assert MESSAGE_BROADCAST.validate({"body": "Hi"}) == ({"body": "Hi"}, [])
+    assert MESSAGE_BROADCAST.validate({}) == ({}, [REQUIRED])
@@ -1,12 +1,45 @@
 # from werkzeug.utils import secure_filename
 # from flask import url_for
+import io
 import logging
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 from botocore.exceptions import ClientError
 
+from metrics import timed
+
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_CONTENT_TYPES = {'image/png', 'image/jpeg', 'image/gif'}
 # UPLOAD_FOLDER = '/path/to/the/uploads'
 
+# Threads shared by all requests for uploading gallery photos in parallel.
+UPLOAD_WORKERS = 8
+_upload_pool = ThreadPoolExecutor(
+    max_workers=UPLOAD_WORKERS,
+    thread_name_prefix="s3-upload",
+)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Return the process-wide S3 client, creating it on first use.
+
+    Clients are thread-safe and expensive to build, so one is shared rather
+    than created per upload (creating clients concurrently is not safe).
+    """
+
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.client('s3')
+    return _s3_client
+
 
 # Checks that file has allowed extension
 def allowed_file(filename):
@@ -14,28 +47,146 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def upload_file_obj(file_obj, bucket, object_name):
+def image_dimensions(file_obj):
+    """Read the width and height of a PNG, GIF or JPEG from its header
+
+    Only the first few KB of the file are read, and the stream is rewound
+    afterwards so it can still be uploaded.
+
+    :param file_obj: binary file-like object
+    :return: (width, height), or (None, None) if the format isn't recognized
+    """
+
+    start = file_obj.tell()
+    try:
+        head = file_obj.read(26)
+
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+
+        if head.startswith(b'\xff\xd8'):
+            # Walk the JPEG segments until a start-of-frame marker.
+            file_obj.seek(start + 2)
+            while True:
+                marker = file_obj.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length_bytes = file_obj.read(2)
+                if len(length_bytes) < 2:
+                    break
+                (length,) = struct.unpack('>H', length_bytes)
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (
+                        0xC4, 0xC8, 0xCC):
+                    frame = file_obj.read(5)
+                    if len(frame) < 5:
+                        break
+                    height, width = struct.unpack('>HH', frame[1:5])
+                    return width, height
+                file_obj.seek(length - 2, 1)
+
+        return None, None
+    finally:
+        file_obj.seek(start)
+
+
+def upload_file_obj(file_obj, bucket, object_name, content_type=None):
     """Upload a file to an S3 bucket
 
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
+    :param content_type: Content-Type to store with the object
     :return: True if file was uploaded, else False
     """
 
-    # If S3 object_name was not specified, use file_name
-    # TODO: Name objects using some logic: listing_id+photos_1, etc.
+    extra_args = {'ContentType': content_type} if content_type else None
 
     # Upload the file
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
+    try:
+        with timed("s3"):
+            s3_client.upload_fileobj(
+                file_obj, bucket, object_name, ExtraArgs=extra_args
+            )
+    except ClientError as e:
+        logging.error(e)
+        return False
+    return True
+
+
+def upload_file_objs(uploads, bucket):
+    """Upload several files to an S3 bucket concurrently
+
+    :param uploads: list of (file_obj, object_name, content_type) tuples
+    :param bucket: Bucket to upload to
+    :return: list of booleans, True where that file was uploaded
+    """
+
+    with timed("s3"):
+        futures = [
+            _upload_pool.submit(
+                upload_file_obj, file_obj, bucket, name, content_type
+            )
+            for file_obj, name, content_type in uploads
+        ]
+        return [future.result() for future in futures]
+
+
+def delete_object(bucket_name, object_name):
+    """Delete an object from an S3 bucket
+
+    :param bucket_name: string
+    :param object_name: string
+    :return: True if the object was deleted (or didn't exist), else False
+    """
+
+    s3_client = get_s3_client()
     try:
-        s3_client.upload_fileobj(file_obj, bucket, object_name)
+        with timed("s3"):
+            s3_client.delete_object(Bucket=bucket_name, Key=object_name)
     except ClientError as e:
         logging.error(e)
         return False
     return True
 
 
+def delete_prefix(bucket_name, prefix):
+    """Delete every object under a key prefix in an S3 bucket
+
+    Objects are listed and deleted a page (up to 1000 keys) at a time.
+
+    :param bucket_name: string
+    :param prefix: key prefix, e.g. "uploads/alice/"
+    :return: number of objects deleted, or None on error
+    """
+
+    s3_client = get_s3_client()
+    deleted = 0
+    try:
+        with timed("s3"):
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                keys = [
+                    {'Key': obj['Key']} for obj in page.get('Contents', [])
+                ]
+                if not keys:
+                    continue
+                s3_client.delete_objects(
+                    Bucket=bucket_name,
+                    Delete={'Objects': keys, 'Quiet': True},
+                )
+                deleted += len(keys)
+    except ClientError as e:
+        logging.error(e)
+        return None
+    return deleted
+
+
 def create_presigned_url(bucket_name, object_name, expiration=None):
     """Generate a presigned URL to share an S3 object
 
@@ -46,19 +197,97 @@ def create_presigned_url(bucket_name, object_name, expiration=None):
     """
 
     # Generate a presigned URL for the S3 object
-    s3_client = boto3.client('s3')
+    s3_client = get_s3_client()
+    params = {
+        'Params': {
+            'Bucket': bucket_name,
+            'Key': object_name
+        },
+    }
+    if expiration is not None:
+        params['ExpiresIn'] = expiration
+
     try:
-        response = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                    'Bucket': bucket_name,
-                    'Key': object_name
-                    },
-            ExpiresIn=expiration
-            )
+        with timed("s3"):
+            response = s3_client.generate_presigned_url(
+                'get_object',
+                **params
+                )
     except ClientError as e:
         logging.error(e)
         return None
 
     # The response contains the presigned URL
     return response
+
+
+def create_presigned_post(bucket_name, object_name, content_type, max_size,
+                          expiration=600):
+    """Generate a presigned POST so a browser can upload straight to S3
+
+    S3 itself enforces the policy: the upload must go to exactly
+    `object_name`, declare `content_type`, and be at most `max_size` bytes.
+
+    :param bucket_name: string
+    :param object_name: string
+    :param content_type: required Content-Type of the upload
+    :param max_size: maximum object size in bytes
+    :param expiration: Time in seconds for the policy to remain valid
+    :return: { url, fields } to build the multipart form from. If error,
+             returns None.
+    """
+
+    s3_client = get_s3_client()
+    try:
+        with timed("s3"):
+            response = s3_client.generate_presigned_post(
+                bucket_name,
+                object_name,
+                Fields={'Content-Type': content_type},
+                Conditions=[
+                    {'Content-Type': content_type},
+                    ['content-length-range', 1, max_size],
+                ],
+                ExpiresIn=expiration,
+            )
+    except ClientError as e:
+        logging.error(e)
+        return None
+
+    return response
+
+
+def head_object(bucket_name, object_name, head_bytes=0):
+    """Check an S3 object exists and fetch its metadata
+
+    :param bucket_name: string
+    :param object_name: string
+    :param head_bytes: also download this many leading bytes of the object
+    :return: { size, content_type, head } (head is a file-like object of the
+             leading bytes, or None), or None if the object doesn't exist
+    """
+
+    s3_client = get_s3_client()
+    try:
+        with timed("s3"):
+            response = s3_client.head_object(
+                Bucket=bucket_name,
+                Key=object_name,
+            )
+            head = None
+            if head_bytes:
+                ranged = s3_client.get_object(
+                    Bucket=bucket_name,
+                    Key=object_name,
+                    Range=f"bytes=0-{head_bytes - 1}",
+                )
+                head = io.BytesIO(ranged['Body'].read())
+    except ClientError as e:
+        logging.info(e)
+        return None
+
+    return {
+        'size': response['ContentLength'],
+        'content_type': response.get('ContentType'),
+        'head': head,
+    }
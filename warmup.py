@@ -0,0 +1,229 @@
+"""Warm a new worker's caches before it takes traffic, and GET /ready.
+
+A freshly started worker has an empty response cache, cold database
+buffers and no pooled connections, so its first requests for the popular
+listings and searches are its slowest. Each worker therefore counts which
+cacheable GETs (WARM_ENDPOINTS) it serves successfully, and every
+HOT_KEYS_SAVE_SECONDS merges its counts into the hot-key list at
+HOT_KEYS_PATH (older counts decay by HOT_KEYS_DECAY per save, so the list
+follows what is popular now). The file outlives deploys.
+
+On its first request (normally the load balancer's readiness probe), a
+worker starts replaying the top WARMUP_KEYS entries of that list in the
+background, through the app itself: that fills the response cache (when
+RESPONSE_CACHE_TTL is set) and pulls the rows and indexes they read into
+the database's buffers. GET /ready answers 503 until the replay finishes
+or WARMUP_BUDGET_SECONDS passes, then 200, so traffic only arrives once
+the worker is warm.
+
+    python warmup.py           # print the hot-key list
+    python warmup.py --run     # time a warm-up of this app
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, jsonify, request
+from flask_jwt_extended import create_access_token
+
+from models import User
+from ratelimit import INTERNAL_REQUEST
+
+logger = logging.getLogger(__name__)
+
+WARM_ENDPOINTS = {"listings_list", "listing_show", "user_show",
+                  "user_listings"}
+# Warmed when there is no hot-key list yet.
+DEFAULT_HOT_KEYS = ["/listings"]
+HOT_KEYS_LIMIT = 1000
+HOT_KEYS_DECAY = 0.5
+# Who warm-up requests are made as.
+WARMUP_IDENTITY = "warmup"
+
+
+def _read_counts(path):
+    try:
+        with open(path) as hot_keys_file:
+            return Counter(json.load(hot_keys_file)["counts"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return Counter()
+
+
+def load_hot_keys(path):
+    """ The saved hot keys (path and query string), most requested first.
+        Empty if there is no usable list.
+    """
+
+    return [key for key, _ in _read_counts(path).most_common()]
+
+
+def save_hot_keys(path, counts):
+    """ Merge `counts` into the list at `path`, decaying what was there.
+        Written to a temporary file and renamed, so readers never see half
+        a list; concurrent saves from other workers may overwrite it.
+    """
+
+    merged = Counter({
+        key: count * HOT_KEYS_DECAY
+        for key, count in _read_counts(path).items()
+    })
+    merged.update(counts)
+    top = dict(merged.most_common(HOT_KEYS_LIMIT))
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as hot_keys_file:
+        json.dump({"saved_at": time.time(), "counts": top}, hot_keys_file)
+    os.replace(temporary, path)
+
+
+class HotKeys:
+    """ Counts of warmable requests served by this worker since the last
+        save.
+    """
+
+    def __init__(self, path, save_seconds):
+        self.path = path
+        self.save_seconds = save_seconds
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._saved = time.monotonic()
+
+    def hit(self, key):
+        with self._lock:
+            self._counts[key] += 1
+            if time.monotonic() - self._saved < self.save_seconds:
+                return
+            counts, self._counts = self._counts, Counter()
+            self._saved = time.monotonic()
+        try:
+            save_hot_keys(self.path, counts)
+        except OSError:
+            logger.exception("saving hot keys to %s failed", self.path)
+
+
+class WarmUp:
+    """ One worker's warm-up, run once on a background thread. """
+
+    def __init__(self, app):
+        self.app = app
+        self.ready = threading.Event()
+        self.warmed = 0
+        self.failed = 0
+        self.seconds = None
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+
+    def run(self):
+        app = self.app
+        started = time.monotonic()
+        try:
+            keys = (load_hot_keys(app.config["HOT_KEYS_PATH"])
+                    or DEFAULT_HOT_KEYS)[:app.config["WARMUP_KEYS"]]
+            self.warm(keys, started + app.config["WARMUP_BUDGET_SECONDS"])
+        except Exception:
+            logger.exception("warm-up failed")
+        finally:
+            self.seconds = time.monotonic() - started
+            self.ready.set()
+            logger.info("warmed %s keys (%s failed) in %.2fs",
+                        self.warmed, self.failed, self.seconds)
+
+    def warm(self, keys, deadline):
+        with self.app.app_context():
+            token = create_access_token(
+                identity=User(username=WARMUP_IDENTITY, is_admin=False)
+            )
+        client = self.app.test_client()
+        headers = {"Authorization": f"Bearer {token}"}
+        for key in keys:
+            if time.monotonic() >= deadline:
+                break
+            response = client.get(key, headers=headers,
+                                  environ_base={INTERNAL_REQUEST: True})
+            if response.status_code == 200:
+                self.warmed += 1
+            else:
+                self.failed += 1
+
+
+def _request_key():
+    query = request.query_string.decode("latin-1")
+    return f"{request.path}?{query}" if query else request.path
+
+
+def ready():
+    """ Whether this worker has finished warming up.
+        Returns => { status: "ready", warmed, failed, seconds }, or 503
+        with { status: "warming" } until then.
+    """
+
+    warm_up = current_app.extensions["warmup"]
+    if warm_up is None:
+        return (jsonify(status="ready"), 200)
+    if not warm_up.ready.is_set():
+        return (jsonify(status="warming"), 503)
+    return (jsonify(status="ready", warmed=warm_up.warmed,
+                    failed=warm_up.failed, seconds=warm_up.seconds), 200)
+
+
+def init_warmup(app):
+    """ Record hot keys, warm up on the first request, and add GET /ready.
+        Without WARMUP_ENABLED, hot keys are still recorded and /ready
+        answers 200 at once.
+    """
+
+    hot_keys = HotKeys(app.config["HOT_KEYS_PATH"],
+                       app.config["HOT_KEYS_SAVE_SECONDS"])
+    warm_up = WarmUp(app) if app.config["WARMUP_ENABLED"] else None
+    app.extensions["warmup"] = warm_up
+
+    if warm_up is not None:
+        app.before_first_request(warm_up.start)
+
+    @app.after_request
+    def record_hot_key(response):
+        if (request.method == "GET" and response.status_code == 200
+                and request.endpoint in WARM_ENDPOINTS
+                and not request.environ.get(INTERNAL_REQUEST)):
+            hot_keys.hit(_request_key())
+        return response
+
+    app.add_url_rule("/ready", "ready", ready)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Show the hot-key list, or time a warm-up."
+    )
+    parser.add_argument('--run', action='store_true',
+                        help="warm up this app and report how long it took")
+    parser.add_argument('--limit', type=int, default=20,
+                        help="hot keys to print")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    from app import app
+
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.run:
+        warm_up = WarmUp(app)
+        warm_up.run()
+        print(f"warmed {warm_up.warmed} keys ({warm_up.failed} failed)"
+              f" in {warm_up.seconds:.2f}s")
+    else:
+        for key in load_hot_keys(app.config["HOT_KEYS_PATH"])[:args.limit]:
+            print(key)